@@ -15,23 +15,51 @@ else:
     import xml.etree.ElementTree as etree
     lxml_avail = False
     # end debugging
+try:
+    import zstandard
+    zstd_avail = True
+except ImportError:
+    zstd_avail = False
 import argparse
 import crypt
 import datetime
 import errno
+import gzip
 import ipaddress
 import json
 import getpass
+import glob
+import hashlib
+import lzma
 import os
 import re
 import readline
 import sys
+import time
 import urllib.request as urlrequest
 import urllib.parse as urlparse
 import urllib.response as urlresponse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from ftplib import FTP_TLS
+from io import BytesIO
+# The client does the XML -> config dict conversion (and owns the install plan format); compile reuses it.
+try:
+    import aifclient
+    aifclient_avail = True
+except ImportError:
+    aifclient_avail = False
 
 xsd = 'https://aif.square-r00t.net/aif.xsd'
+# The copy of the schema that ships alongside this script; used unless told to check the remote one.
+localxsd = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aif.xsd')
+# Where we remember validation results, keyed by (schema hash, config hash).
+cachedir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'aif')
+# Compiled schemas, keyed by the hash of their source. Compiling is the slow part, so only do it once per run.
+schemas = {}
+# How much we read/write at a time when fetching.
+fetchchunk = 65536
+# Compressed output formats, and the suffix we give each.
+compressors = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
 
 # Ugh. You kids and your colors and bolds and crap.
 class color(object):
@@ -46,11 +74,54 @@ class color(object):
     UNDERLINE = '\033[4m'
     END = '\033[0m'
 
+# Batch mode workers. Each process in the pool gets its own aifgen and compiles the schema once, in batchInit().
+batchworker = {}
+
+def batchInit(xsddata):
+    batchworker['gen'] = aifgen({'oper': 'batch'})
+    batchworker['xsd'] = False
+    if xsddata:
+        batchworker['xsd'] = batchworker['gen'].getSchema(xsddata)
+
+def batchValidate(path):
+    start = time.monotonic()
+    try:
+        data = batchworker['gen'].webFetch(path)
+        dochash = hashlib.sha256(data).hexdigest()
+        try:
+            batchworker['xsd'].assertValid(etree.fromstring(data))
+            error = False
+        except Exception as e:
+            error = str(e)
+    except Exception as e:
+        # Couldn't even read it; don't remember that.
+        return(path, False, 'Could not read {0}: {1}'.format(path, e), time.monotonic() - start)
+    return(path, dochash, error, time.monotonic() - start)
+
+def batchConvert(path, dest):
+    start = time.monotonic()
+    gen = aifgen({'oper': 'convert', 'inputfile': path, 'cfgfile': dest})
+    try:
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+        gen.genXMLFile(gen.convertJSON())
+        with open(dest, 'rb') as f:
+            data = f.read()
+        error = False
+        if batchworker['xsd']:
+            try:
+                batchworker['xsd'].assertValid(etree.fromstring(data))
+            except Exception as e:
+                error = str(e)
+    except (Exception, SystemExit) as e:
+        return(path, False, str(e), time.monotonic() - start)
+    return(path, hashlib.sha256(data).hexdigest(), error, time.monotonic() - start)
+
 class aifgen(object):
     def __init__(self, args):
         self.args = args
 
-    def webFetch(self, uri, auth = False):  # TODO: add commandline args support for extra auth?
+    def fetchTo(self, uri, fileobj, auth = False):  # TODO: add commandline args support for extra auth?
+        # Streams uri into fileobj, fetchchunk bytes at a time.
         # Sanitize the user specification and find which protocol to use
         prefix = uri.split(':')[0].lower()
         if uri.startswith('/'):
@@ -58,6 +129,7 @@ class aifgen(object):
             prefix = 'file'
         # Use the urllib module
         if prefix in ('http', 'https', 'file', 'ftp'):
+            opener = urlrequest.build_opener()
             if auth:
                 if 'user' in auth.keys() and 'password' in auth.keys():
                     # Set up Basic or Digest auth.
@@ -66,43 +138,109 @@ class aifgen(object):
                         passman.add_password(None, uri, auth['user'], auth['password'])
                     else:
                         passman.add_password(auth['realm'], uri, auth['user'], auth['password'])
-                    if auth['type'] == 'digest':
+                    if auth.get('type') == 'digest':
                         httpauth = urlrequest.HTTPDigestAuthHandler(passman)
                     else:
                         httpauth = urlrequest.HTTPBasicAuthHandler(passman)
-                    httpopener = urlrequest.build_opener(httpauth)
-                    urlrequest.install_opener(httpopener)
-            with urlrequest.urlopen(uri) as f:
-                data = f.read()
+                    opener = urlrequest.build_opener(httpauth)
+            with opener.open(uri) as f:
+                for chunk in iter(lambda: f.read(fetchchunk), b''):
+                    fileobj.write(chunk)
         elif prefix == 'ftps':
+            username = 'anonymous'
+            password = 'anonymous'
             if auth:
                 if 'user' in auth.keys():
                     username = auth['user']
-                else:
-                    username = 'anonymous'
                 if 'password' in auth.keys():
                     password = auth['password']
-                else:
-                    password = 'anonymous'
             filepath = '/'.join(uri.split('/')[3:])
             server = uri.split('/')[2]
-            content = StringIO()
             ftps = FTP_TLS(server)
             ftps.login(username, password)
             ftps.prot_p()
-            ftps.retrlines("RETR " + filepath, content.write)
-            data = content.getvalue()
+            ftps.retrbinary("RETR " + filepath, fileobj.write, blocksize = fetchchunk)
         else:
             exit('{0} is not a recognised URI type specifier. Must be one of http, https, file, ftp, or ftps.'.format(prefix))
+        return()
+
+    def webFetch(self, uri, auth = False):
+        content = BytesIO()
+        self.fetchTo(uri, content, auth)
+        data = content.getvalue()
+        # The client transparently handles compressed configs, so we should too.
+        if data.startswith(b'\x1f\x8b'):
+            data = gzip.decompress(data)
+        elif data.startswith(b'\xfd7zXZ\x00'):
+            data = lzma.decompress(data)
+        elif data.startswith(b'\x28\xb5\x2f\xfd'):
+            if not zstd_avail:
+                exit('{0} is zstd-compressed, but the zstandard python module is not installed.'.format(uri))
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
         return(data)
 
+    def compressFile(self, path, fmt):
+        # Writes a compressed copy of path alongside it (for slow links to the client); returns the new path.
+        dest = path + compressors[fmt]
+        if fmt == 'gzip':
+            out = gzip.open(dest, 'wb', compresslevel = 9)
+        elif fmt == 'xz':
+            out = lzma.open(dest, 'wb', preset = 9)
+        elif fmt == 'zstd':
+            if not zstd_avail:
+                exit('zstd compression requires the zstandard python module (python-zstandard).')
+            out = zstandard.ZstdCompressor(level = 19).stream_writer(open(dest, 'wb'), closefd = True)
+        with open(path, 'rb') as f, out:
+            for chunk in iter(lambda: f.read(fetchchunk), b''):
+                out.write(chunk)
+        return(dest)
+
     def getXSD(self):
-        xsdobj = etree.fromstring(self.webFetch(xsd))
-        return(xsdobj)
-    
+        # Returns the raw XSD. We use the bundled copy unless asked to check it against the remote one,
+        # in which case a differing remote copy wins (it's newer).
+        data = False
+        if os.path.isfile(localxsd):
+            with open(localxsd, 'rb') as f:
+                data = f.read()
+        if self.args.get('xsd_check') or not data:
+            try:
+                remote = self.webFetch(xsd)
+                if data and hashlib.sha256(remote).digest() != hashlib.sha256(data).digest():
+                    print('NOTE: {0} differs from the bundled {1}; using the remote copy.'.format(xsd, localxsd))
+                data = remote
+            except Exception as e:
+                if not data:
+                    exit('\nCould not fetch {0} and there is no bundled copy at {1}: {2}'.format(xsd, localxsd, e))
+                print('NOTE: could not fetch {0} ({1}); using the bundled copy.'.format(xsd, e))
+        return(data)
+
+    def getSchema(self, xsddata):
+        xsdhash = hashlib.sha256(xsddata).hexdigest()
+        if xsdhash not in schemas.keys():
+            schemas[xsdhash] = etree.XMLSchema(etree.fromstring(xsddata))
+        return(schemas[xsdhash])
+
     def getXML(self):
         xmlobj = etree.fromstring(self.webFetch(self.args['cfgfile']))
         return(xmlobj)
+
+    def readResults(self):
+        try:
+            with open(os.path.join(cachedir, 'validated.json'), 'r') as f:
+                return(json.load(f))
+        except (OSError, ValueError):
+            return({})
+
+    def writeResults(self, results):
+        # Best-effort; a read-only or missing home shouldn't stop validation.
+        try:
+            os.makedirs(cachedir, exist_ok = True)
+            tmp = os.path.join(cachedir, '.validated.json.{0}'.format(os.getpid()))
+            with open(tmp, 'w') as f:
+                json.dump(results, f)
+            os.replace(tmp, os.path.join(cachedir, 'validated.json'))
+        except OSError:
+            pass
         
     def getOpts(self):
         # Before anything else... a disclaimer.
@@ -770,7 +908,7 @@ class aifgen(object):
             try:
                 conf = json.load(f)
             except:
-                exit(' !! ERROR: {0} does not seem to be a strict JSON file.'.format(args['inputfile']))
+                exit(' !! ERROR: {0} does not seem to be a strict JSON file.'.format(self.args['inputfile']))
         return(conf)
 
     def validateXML(self):
@@ -779,17 +917,30 @@ class aifgen(object):
             exit('\nXML validation is only supported by LXML.\n' +
                  'If you want to validate the XML, install the lxml python module (python-lxml) ' +
                  'and run:\n\t{0} validate -f {1}.\n'.format(sys.argv[0], self.args['cfgfile']))
+        xsddata = self.getXSD()
         try:
-            xsd = etree.XMLSchema(self.getXSD())
+            xsd = self.getSchema(xsddata)
             print('\nXSD: {0}PASSED{1}'.format(color.BOLD, color.END))
         except Exception as e:
             exit('\nXSD: {0}FAILED{1}: {2}'.format(color.BOLD, color.END, e))
-        # Then we can validate the XML.
-        try:
-            xml = xsd.validate(self.getXML())
+        # Then we can validate the XML. We only fetch it once; the same bytes are hashed and parsed.
+        xmldata = self.webFetch(self.args['cfgfile'])
+        key = '{0}:{1}'.format(hashlib.sha256(xsddata).hexdigest(), hashlib.sha256(xmldata).hexdigest())
+        results = {}
+        if not self.args.get('no_cache'):
+            results = self.readResults()
+        if key not in results.keys():
+            try:
+                xsd.assertValid(etree.fromstring(xmldata))
+                results[key] = False
+            except Exception as e:
+                results[key] = str(e)
+            if not self.args.get('no_cache'):
+                self.writeResults(results)
+        if not results[key]:
             print('XML: {0}PASSED{1}\n'.format(color.BOLD, color.END))
-        except Exception as e:
-            print('XML: {0}FAILED{1}: {2}\n'.format(color.BOLD, color.END, e))
+        else:
+            print('XML: {0}FAILED{1}: {2}\n'.format(color.BOLD, color.END, results[key]))
 
     def genXMLFile(self, conf):
         namespaces = {'aif': 'http://aif.square-r00t.net/', 'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
@@ -827,7 +978,12 @@ class aifgen(object):
                 start = conf['disks'][d]['parts'][p]['start']
                 stop = conf['disks'][d]['parts'][p]['stop']
                 fstype = conf['disks'][d]['parts'][p]['fstype']
-                disk.append(etree.Element('part', num = p, start = start, stop = stop, fstype = fstype))
+                # How it's formatted is optional, hence the splat and fmt dict.
+                fmt = {}
+                for o in ('fs', 'fsopts', 'profile', 'label', 'discard'):
+                    if conf['disks'][d]['parts'][p].get(o) is not None:
+                        fmt[o] = str(conf['disks'][d]['parts'][p][o]).lower() if o == 'discard' else conf['disks'][d]['parts'][p][o]
+                disk.append(etree.Element('part', num = p, start = start, stop = stop, fstype = fstype, **fmt))
             strg.append(disk)
         # /aif/storage/mount
         for m in conf['mounts'].keys():
@@ -1026,13 +1182,155 @@ class aifgen(object):
                 f.write('\n'.join(outstr))
         return(root)
 
+    def findFiles(self):
+        # Expands the directories/globs/files given to batch into a sorted list of files.
+        if self.args['convert']:
+            suffixes = ('.json',)
+        else:
+            suffixes = tuple(['.xml'] + ['.xml' + c for c in compressors.values()])
+        found = set()
+        for p in self.args['paths']:
+            p = os.path.expanduser(p)
+            for m in (glob.glob(p, recursive = True) or [p]):
+                if os.path.isdir(m):
+                    for root, dirs, files in os.walk(m):
+                        found.update([os.path.join(root, f) for f in files if f.endswith(suffixes)])
+                elif os.path.isfile(m):
+                    found.add(m)
+                else:
+                    print('NOTE: {0} matched nothing; skipping.'.format(p), file = sys.stderr)
+        return(sorted([os.path.abspath(f) for f in found]))
+
+    def convertDest(self, path):
+        dest = re.sub('\\.json$', '', path) + '.xml'
+        if self.args['outdir']:
+            dest = os.path.join(os.path.abspath(os.path.expanduser(self.args['outdir'])), os.path.basename(dest))
+        return(dest)
+
+    def batch(self):
+        # Validates (or converts, then validates) many files across a process pool. Files we've already seen
+        # with the same schema are answered from the results cache. Prints a JSON summary on stdout.
+        start = time.monotonic()
+        files = self.findFiles()
+        if not files:
+            exit('No matching files were found in: {0}'.format(', '.join(self.args['paths'])))
+        xsddata = False
+        if lxml_avail:
+            xsddata = self.getXSD()
+            self.getSchema(xsddata)  # Fail early (and once) if the schema itself is bad.
+        elif not self.args['convert']:
+            exit('\nXML validation is only supported by LXML.\n' +
+                 'If you want to validate the XML, install the lxml python module (python-lxml).')
+        xsdhash = hashlib.sha256(xsddata or b'').hexdigest()
+        results = {}
+        if not self.args['no_cache']:
+            results = self.readResults()
+        summary = {}
+        todo = []
+        for f in files:
+            t = time.monotonic()
+            with open(f, 'rb') as fh:
+                dochash = hashlib.sha256(fh.read()).hexdigest()
+            if self.args['convert']:
+                dest = self.convertDest(f)
+                key = 'convert:{0}:{1}:{2}'.format(xsdhash, dochash, dest)
+                cached = results.get(key)
+                # Only skip a conversion if its output is still there, untouched.
+                if cached and os.path.isfile(dest):
+                    with open(dest, 'rb') as fh:
+                        if hashlib.sha256(fh.read()).hexdigest() != cached['hash']:
+                            cached = None
+                else:
+                    cached = None
+                if cached:
+                    summary[f] = {'status': ('failed' if cached['error'] else 'passed'), 'cached': True,
+                                  'output': dest, 'error': cached['error'], 'seconds': time.monotonic() - t}
+                else:
+                    todo.append((f, key, dest))
+            else:
+                key = '{0}:{1}'.format(xsdhash, dochash)
+                if key in results.keys():
+                    summary[f] = {'status': ('failed' if results[key] else 'passed'), 'cached': True,
+                                  'error': results[key], 'seconds': time.monotonic() - t}
+                else:
+                    todo.append((f, key, False))
+        if todo:
+            with ProcessPoolExecutor(max_workers = self.args['jobs'], initializer = batchInit,
+                                     initargs = (xsddata,)) as pool:
+                if self.args['convert']:
+                    futures = dict([(pool.submit(batchConvert, f, dest), (f, key, dest)) for f, key, dest in todo])
+                else:
+                    futures = dict([(pool.submit(batchValidate, f), (f, key, dest)) for f, key, dest in todo])
+                for fut in as_completed(futures):
+                    f, key, dest = futures[fut]
+                    path, outhash, error, secs = fut.result()
+                    summary[f] = {'status': ('failed' if error else 'passed'), 'cached': False,
+                                  'error': error, 'seconds': secs}
+                    if self.args['convert']:
+                        summary[f]['output'] = dest
+                        if outhash:
+                            results[key] = {'hash': outhash, 'error': error}
+                    elif outhash:
+                        # Re-key on what the worker actually read, in case it changed under us.
+                        results['{0}:{1}'.format(xsdhash, outhash)] = error
+            if not self.args['no_cache']:
+                self.writeResults(results)
+        report = {'total': len(files),
+                  'passed': len([f for f in summary.values() if f['status'] == 'passed']),
+                  'failed': len([f for f in summary.values() if f['status'] == 'failed']),
+                  'cached': len([f for f in summary.values() if f['cached']]),
+                  'validated': bool(xsddata),
+                  'seconds': time.monotonic() - start,
+                  'files': dict([(f, summary[f]) for f in files])}
+        print(json.dumps(report, indent = 2))
+        if report['failed']:
+            sys.exit(1)
+
+    def compilePlan(self):
+        # Resolves the XML into an install plan: the config dict the client would build, with every script
+        # fetched and inlined, so the client needs nothing else at boot.
+        if not aifclient_avail:
+            exit('compile needs aifclient.py, which should be alongside {0}.'.format(sys.argv[0]))
+        xmldata = self.webFetch(self.args['cfgfile'])
+        xmlobj = etree.fromstring(xmldata)
+        if lxml_avail:
+            try:
+                self.getSchema(self.getXSD()).assertValid(xmlobj)
+            except Exception as e:
+                exit('\n{0} is not valid, so it was not compiled: {1}'.format(self.args['cfgfile'], e))
+        else:
+            print('NOTE: lxml is not installed, so {0} was not validated before compiling.'.format(self.args['cfgfile']))
+        model = aifclient.aif().buildModel(xmlobj)
+        aifdict = model.toDict()
+        scripts = False
+        if model.scripts is not False:
+            scripts = {'pre': [], 'post': [], 'pkg': []}
+            for d, i, uri, auth in model.scriptOrder():
+                try:
+                    scripts[d].append(self.webFetch(uri, auth))
+                except Exception as e:
+                    exit('Could not fetch {0} script {1}: {2}'.format(d, uri, e))
+        plan = aifclient.planDump(aifdict, scripts, xmldata)
+        tmp = '{0}.tmp.{1}'.format(self.args['planfile'], os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(plan)
+        os.replace(tmp, self.args['planfile'])
+        print('Wrote install plan (version {0}, {1} bytes) to {2}'.format(aifclient.planversion, len(plan),
+                                                                        self.args['planfile']))
+
     def main(self):
+        if self.args['oper'] == 'compile':
+            return(self.compilePlan())
+        if self.args['oper'] == 'batch':
+            return(self.batch())
         if self.args['oper'] == 'create':
             conf = self.getOpts()
         elif self.args['oper'] == 'convert':
             conf = self.convertJSON()
         if self.args['oper'] in ('create', 'convert'):
             self.genXMLFile(conf)
+            if self.args['compress']:
+                print('Wrote compressed copy to {0}'.format(self.compressFile(self.args['cfgfile'], self.args['compress'])))
         if self.args['oper'] in ('create', 'convert', 'validate'):
             self.validateXML()
 
@@ -1046,17 +1344,45 @@ def parseArgs():
                             dest = 'cfgfile',
                             help = 'The file to create/validate. If not specified, defaults to ./aif.xml',
                             default = '{0}/aif.xml'.format(os.getcwd()))
+    xsdargs = argparse.ArgumentParser(add_help = False)
+    xsdargs.add_argument('--xsd-check',
+                         dest = 'xsd_check',
+                         action = 'store_true',
+                         help = ('Check the bundled aif.xsd against {0} and use the remote one if it differs.\n' +
+                                 'By default validation is done offline against the bundled schema.').format(xsd))
+    xsdargs.add_argument('--no-cache',
+                         dest = 'no_cache',
+                         action = 'store_true',
+                         help = 'Don\'t use (or update) the cache of previous validation results in {0}.'.format(cachedir))
     subparsers = args.add_subparsers(help = 'Operation to perform',
                                      dest = 'oper')
     createargs = subparsers.add_parser('create',
                                        help = 'Create an AIF-NG XML configuration file.',
-                                       parents = [commonargs])
+                                       parents = [commonargs, xsdargs])
     validateargs = subparsers.add_parser('validate',
                                          help = 'Validate an AIF-NG XML configuration file.',
-                                         parents = [commonargs])
+                                         parents = [commonargs, xsdargs])
     convertargs = subparsers.add_parser('convert',
                                         help = 'Convert a "more" human-readable JSON configuration file to AIF-NG-compatible XML.',
-                                        parents = [commonargs])
+                                        parents = [commonargs, xsdargs])
+    compileargs = subparsers.add_parser('compile',
+                                        help = 'Compile an AIF-NG XML configuration (and its scripts) into an install plan.',
+                                        parents = [commonargs, xsdargs])
+    compileargs.add_argument('-o',
+                             '--output',
+                             dest = 'planfile',
+                             help = ('Where to write the plan. If not specified, defaults to the XML file\'s path with .plan added.\n' +
+                                     'Point aif_url at it and the client uses it as-is: no XML parsing and no script fetches.'))
+    batchargs = subparsers.add_parser('batch',
+                                      help = 'Validate (or convert) many files at once, in parallel.',
+                                      parents = [xsdargs])
+    for p in (createargs, convertargs):
+        p.add_argument('-z',
+                       '--compress',
+                       dest = 'compress',
+                       choices = list(compressors.keys()),
+                       help = ('Also write a compressed copy of the XML (e.g. aif.xml.gz) that can be served to the client instead.\n' +
+                               'The client detects and decompresses it on the fly.'))
     createargs.add_argument('-v',
                             '--verbose',
                             dest = 'verbose',
@@ -1067,6 +1393,27 @@ def parseArgs():
                             dest = 'verbose_raw',
                             action = 'store_true',
                             help = 'Like -v, but prints the unformatted dict.')
+    batchargs.add_argument('-j',
+                           '--jobs',
+                           dest = 'jobs',
+                           type = int,
+                           default = os.cpu_count(),
+                           help = 'How many files to work on at once. The default is the number of CPUs (%(default)s).')
+    batchargs.add_argument('-c',
+                           '--convert',
+                           dest = 'convert',
+                           action = 'store_true',
+                           help = ('Treat the inputs as JSON and convert each to XML (foo.json -> foo.xml), then validate it.\n' +
+                                   'Without this, XML files are validated.'))
+    batchargs.add_argument('-o',
+                           '--outdir',
+                           dest = 'outdir',
+                           help = 'With -c, write the XML files here instead of alongside the JSON files.')
+    batchargs.add_argument('paths',
+                           nargs = '+',
+                           metavar = 'PATH',
+                           help = ('Files, directories (searched recursively) or globs (quote them; ** works) to process.\n' +
+                                   'A JSON summary with per-file results and timings is printed when done.'))
     convertargs.add_argument('-i',
                              '--input',
                              dest = 'inputfile',
@@ -1075,6 +1422,9 @@ def parseArgs():
     return(args)
     
 def verifyArgs(args):
+    if args['oper'] == 'batch':
+        # Everything batch needs is checked as it goes.
+        return(args)
     args['cfgfile'] = os.path.normpath(os.path.abspath(os.path.expanduser(args['cfgfile'])))
     args['cfgfile'] = re.sub('^/+', '/', args['cfgfile'])
     # Path/file handling - make sure we can create the parent dir if it doesn't exist,
@@ -1094,6 +1444,10 @@ def verifyArgs(args):
             print('\nERROR: {0}: {1}'.format(e.strerror, e.filename))
             exit(('\nWe encountered an error when trying to use path {0}.\n' + 
                   'Please review the output and address any issues present.').format(args['cfgfile']))
+    if args['oper'] == 'compile':
+        if not args['planfile']:
+            args['planfile'] = args['cfgfile'] + '.plan'
+        args['planfile'] = os.path.normpath(os.path.abspath(os.path.expanduser(args['planfile'])))
     if args['oper'] == 'convert':
         # And we need to make sure we have read perms to the JSON input file.
         try:
@@ -16,30 +16,848 @@ try:
 except ImportError:
     import xml.etree.ElementTree as etree  # https://docs.python.org/3/library/xml.etree.elementtree.html
     lxml_avail = False
+try:
+    import zstandard
+    zstd_avail = True
+except ImportError:
+    zstd_avail = False
+import asyncio
+import contextlib
 import datetime
+import time
 import shlex
-import fileinput
+import gzip
+import hashlib
+import json
+import lzma
 import os
+import tempfile
 import shutil
+import random
 import re
 import socket
 import subprocess
 import ipaddress
 import copy
+import base64
+import collections
+import ssl
+import threading
+import http.client as httpclient
+import zlib
+import urllib.error as urlerror
 import urllib.request as urlrequest
 import urllib.parse as urlparse
 import urllib.response as urlresponse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ftplib
 from ftplib import FTP_TLS
-from io import StringIO
+from io import BytesIO
 
 logfile = '/root/aif.log.{0}'.format(int(datetime.datetime.utcnow().timestamp()))
+# How many scripts we fetch at once.
+fetchthreads = 8
+# How much we read/write at a time when fetching; payloads are never held in memory whole.
+fetchchunk = 65536
+# Where fetched scripts are written to (as <scriptdir>/<type>/<n>).
+scriptdir = '/root/scripts'
+# Where a package cache that's a device or NFS export (see archInstall.pkgCacheSetup()) gets mounted on the host.
+pkgcachemnt = '/mnt/aif-pkgcache'
+# The filesystem a partition gets if it doesn't say, by its partition type. Other types aren't formatted.
+fsdefaults = {'ef00': 'vfat', 'ef01': 'vfat', 'ef02': 'vfat', '8200': 'swap'}
+fsdefaults.update(dict([(t, 'ext4') for t in ('8300', '8301', '8302', '8303', '8304', '8305', '8306', '8307')]))
+# The install plan format version we write (and the newest we can read); see planDump().
+planversion = 1
+# What pacstrap installs, and how many cached rootfs images of it we keep; see archInstall.pacstrap().
+basepkgs = ['base']
+rootfskeep = 3
+# The step journal, on the new install and (mirrored) on the host; see installJournal.
+journalfile = '/var/lib/aif/journal.json'
+hostjournal = '/root/aif.journal.json'
+# How much of a mirror's core.db we download to see how fast it is; see archInstall.rankMirrors().
+mirrorsample = 262144
+
+class fetchCache(object):
+    # A content-addressed cache for configs and scripts. Each payload is stored once under objects/ by its SHA256,
+    # and index.json maps every URI to its object along with the HTTP validators (ETag/Last-Modified) we got for it.
+    def __init__(self, cachedir, maxsize = 104857600):
+        self.cachedir = cachedir
+        self.maxsize = int(maxsize)
+        self.objdir = os.path.join(cachedir, 'objects')
+        self.indexfile = os.path.join(cachedir, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(self.objdir, exist_ok = True)
+        try:
+            with open(self.indexfile, 'r') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def copyTo(self, uri, fileobj):
+        # Copies the cached payload for uri into fileobj. Returns False (having written nothing) if we don't have a
+        # (valid) one; it's checked against its hash before any of it is copied.
+        with self.lock:
+            if uri not in self.index.keys():
+                return(False)
+            entry = self.index[uri]
+            objfile = os.path.join(self.objdir, entry['hash'])
+            hasher = hashlib.sha256()
+            try:
+                with open(objfile, 'rb') as f:
+                    for chunk in iter(lambda: f.read(fetchchunk), b''):
+                        hasher.update(chunk)
+                valid = (hasher.hexdigest() == entry['hash'])
+                if valid:
+                    with open(objfile, 'rb') as f:
+                        for chunk in iter(lambda: f.read(fetchchunk), b''):
+                            fileobj.write(chunk)
+            except OSError:
+                valid = False
+            if not valid:
+                # Missing or corrupted; forget about it.
+                del(self.index[uri])
+                self.save()
+                return(False)
+            entry['atime'] = time.time()
+            self.save()
+        return(True)
+
+    def has(self, uri):
+        with self.lock:
+            return(uri in self.index.keys())
+
+    def validators(self, uri):
+        # The conditional request headers to revalidate uri with.
+        headers = {}
+        with self.lock:
+            if uri in self.index.keys():
+                if self.index[uri]['etag']:
+                    headers['If-None-Match'] = self.index[uri]['etag']
+                if self.index[uri]['modified']:
+                    headers['If-Modified-Since'] = self.index[uri]['modified']
+        return(headers)
+
+    def newfile(self):
+        # A file to stream a new payload into; hand it to commit() once it's complete.
+        return(tempfile.NamedTemporaryFile(dir = self.objdir, prefix = '.', suffix = '.tmp', delete = False))
+
+    def commit(self, uri, tmppath, digest, size, headers = None):
+        objfile = os.path.join(self.objdir, digest)
+        with self.lock:
+            if os.path.isfile(objfile):
+                os.remove(tmppath)
+            else:
+                os.replace(tmppath, objfile)
+            entry = {'hash': digest, 'size': size, 'atime': time.time(), 'etag': None, 'modified': None}
+            if headers:
+                entry['etag'] = headers.get('ETag')
+                entry['modified'] = headers.get('Last-Modified')
+            self.index[uri] = entry
+            self.evict()
+            self.save()
+        return(digest)
+
+    def evict(self):
+        # Drop the least-recently-used URIs until the (deduplicated) objects fit in maxsize. Call with the lock held.
+        def objsizes():
+            sizes = {}
+            for entry in self.index.values():
+                sizes[entry['hash']] = entry['size']
+            return(sizes)
+        sizes = objsizes()
+        total = sum(sizes.values())
+        refs = collections.Counter([entry['hash'] for entry in self.index.values()])
+        lru = sorted(self.index.keys(), key = lambda u: self.index[u]['atime'])
+        while lru and total > self.maxsize:
+            digest = self.index.pop(lru.pop(0))['hash']
+            refs[digest] -= 1
+            if not refs[digest]:
+                total -= sizes[digest]
+        live = objsizes().keys()
+        for o in os.listdir(self.objdir):
+            if o not in live and not o.startswith('.'):  # in-flight tempfiles start with a dot
+                os.remove(os.path.join(self.objdir, o))
+        return()
+
+    def save(self):
+        # Call with the lock held.
+        with open(self.indexfile + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.indexfile + '.tmp', self.indexfile)
+        return()
+
+class streamDecoder(object):
+    # Transparently decompresses gzip, xz or zstd payloads as they stream through to write(), going by the
+    # Content-Encoding (if we got one) or the magic bytes at the start. Anything else is passed through untouched.
+    magic = {'gzip': b'\x1f\x8b', 'xz': b'\xfd7zXZ\x00', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+    def __init__(self, write):
+        self.write = write
+        self.encoding = None
+        self.fmt = None
+        self.decomp = None
+        self.head = b''
+
+    def newDecompressor(self):
+        if self.fmt == 'gzip':
+            return(zlib.decompressobj(16 + zlib.MAX_WBITS))
+        elif self.fmt == 'xz':
+            return(lzma.LZMADecompressor())
+        elif self.fmt == 'zstd':
+            if not zstd_avail:
+                exit('Got a zstd-compressed payload, but the zstandard python module is not installed.')
+            return(zstandard.ZstdDecompressor().decompressobj())
+
+    def feed(self, chunk):
+        if self.fmt is None:
+            # Hold on to the first few bytes until we can tell what we're looking at.
+            self.head += chunk
+            if chunk and len(self.head) < max([len(m) for m in self.magic.values()]):
+                return()
+            self.fmt = 'raw'
+            for fmt, magic in self.magic.items():
+                if self.head.startswith(magic):
+                    self.fmt = fmt
+            if self.encoding and self.encoding in self.magic.keys() and self.fmt != self.encoding:
+                raise ValueError('Content-Encoding is {0}, but the payload is not'.format(self.encoding))
+            self.decomp = self.newDecompressor()
+            chunk = self.head
+            self.head = b''
+        if self.fmt == 'raw':
+            if chunk:
+                self.write(chunk)
+            return()
+        while chunk:
+            out = self.decomp.decompress(chunk)
+            if out:
+                self.write(out)
+            chunk = b''
+            if getattr(self.decomp, 'eof', False):
+                # Concatenated streams/members (e.g. cat a.gz b.gz) are valid; keep going.
+                chunk = self.decomp.unused_data
+                if chunk:
+                    self.decomp = self.newDecompressor()
+        return()
+
+    def close(self):
+        if self.fmt is None:
+            self.feed(b'')
+        if hasattr(self.decomp, 'flush'):
+            out = self.decomp.flush()
+            if out:
+                self.write(out)
+        return()
+
+class fetchSession(object):
+    # Every fetch (the config, scripts, etc.) goes through one of these, shared by aif and archInstall.
+    # It keeps connections open per host (HTTP keep-alive, and one FTPS control connection per host/user)
+    # and remembers credentials per realm, so fetching N files from one server costs one handshake instead of N.
+    def __init__(self, cache = False, maxconns = 2):
+        self.cache = cache
+        self.maxconns = maxconns
+        self.timeout = 30  # per connect/read, in seconds
+        self.retries = 5
+        self.backoff = 1.0
+        self.maxbackoff = 30.0
+        self.deadline = False  # a time.monotonic() after which we stop retrying
+        self.lock = threading.Lock()
+        self.pools = {}  # (scheme, host, port): idle HTTP(S)Connections
+        self.slots = {}  # (scheme, host, port): BoundedSemaphore capping open connections
+        self.ftps = {}  # (host, user): [FTP_TLS, Lock]
+        self.creds = {}  # (host, realm): auth dict; realm None is the fallback for a host
+        self.authhdrs = {}  # (scheme, host, port): (realm, Basic Authorization header) to send up front
+        self.digests = {}  # (host, realm): AbstractDigestAuthHandler, so nonce counts carry over
+        self.connects = 0
+        self.requests = 0
+
+    def fetchTo(self, uris, fileobj, auth = False, decompress = True):
+        # Streams uris (one URI, or a list of mirrors of the same thing) into fileobj, fetchchunk bytes at a time.
+        # Returns the number of bytes written. Mirrors are tried fastest-first; each round through them that fails
+        # on something transient (timeouts, resets, 5xx, etc.) is followed by a jittered exponential backoff, for up
+        # to self.retries rounds or until self.deadline. Only after all that do we fall back to a cached copy.
+        # Compressed payloads are decompressed on the way through unless decompress is False.
+        if isinstance(uris, str):
+            uris = [uris]
+        if not uris:
+            raise ValueError('There is nothing to fetch from (no URIs were given).')
+        if len(uris) > 1:
+            uris = self.rankURIs(uris)
+        attempt = 0
+        errors = []
+        while True:
+            failed = []
+            for uri in uris:
+                # One slow round could run well past the deadline, so it's checked before every try but the first.
+                if self.deadline and (errors or failed) and time.monotonic() > self.deadline:
+                    break
+                try:
+                    return(self.fetchOnce(uri, fileobj, auth, decompress))
+                except (urlerror.URLError, httpclient.HTTPException) + ftplib.all_errors as e:
+                    # Throw away anything we got before it broke.
+                    fileobj.seek(0)
+                    fileobj.truncate()
+                    if not self.transient(e):
+                        raise
+                    failed.append((uri, e))
+            if failed:
+                errors = failed
+            attempt += 1
+            delay = random.uniform(0, min(self.maxbackoff, self.backoff * (2 ** attempt)))
+            if attempt > self.retries or (self.deadline and (time.monotonic() + delay) > self.deadline):
+                break
+            with open(logfile, 'a') as log:
+                for uri, e in errors:
+                    log.write('Could not fetch {0} ({1}); retrying in {2:.1f}s.\n'.format(uri, e, delay))
+            time.sleep(delay)
+        # If the server's unreachable (or broken), fall back to what we had last time.
+        if self.cache:
+            for uri, e in errors:
+                if self.cache.has(uri) and self.cache.copyTo(uri, fileobj):
+                    with open(logfile, 'a') as log:
+                        log.write('Could not fetch {0} ({1}); using cached copy.\n'.format(uri, e))
+                    return(fileobj.tell())
+        raise errors[-1][1]
+
+    def transient(self, e):
+        # Whether an error is worth retrying (or trying another mirror for).
+        if isinstance(e, urlerror.HTTPError):
+            return(e.code in (408, 429) or e.code >= 500)
+        if isinstance(e, ftplib.error_perm):
+            return(False)
+        return(True)
+
+    def rankURIs(self, uris):
+        # Sorts mirrors by how long a TCP connect to each takes, probing them all at once. Ones we can't reach
+        # at all go last (rather than being dropped) in case it's just the probe that failed.
+        ports = {'http': 80, 'https': 443, 'ftp': 21, 'ftps': 21}
+        def probe(uri):
+            parsed = urlparse.urlsplit(uri)
+            scheme = parsed.scheme.lower()
+            if scheme not in ports.keys():
+                return(0.0)  # file:// etc. are local
+            start = time.monotonic()
+            try:
+                with socket.create_connection((parsed.hostname, parsed.port or ports[scheme]), timeout = self.timeout):
+                    pass
+            except OSError:
+                return(float('inf'))
+            return(time.monotonic() - start)
+        with ThreadPoolExecutor(max_workers = min(fetchthreads, len(uris))) as pool:
+            latencies = list(pool.map(probe, uris))
+        ranked = [u for l, i, u in sorted(zip(latencies, range(len(uris)), uris))]
+        with open(logfile, 'a') as log:
+            for l, u in sorted(zip(latencies, uris)):
+                log.write('Mirror {0}: {1}\n'.format(u, 'unreachable' if l == float('inf') else '{0:.3f}s'.format(l)))
+        return(ranked)
+
+    def fetchOnce(self, uri, fileobj, auth = False, decompress = True):
+        # A single attempt at streaming uri into fileobj. Returns the number of bytes written.
+        # Sanitize the user specification and find which protocol to use
+        prefix = uri.split(':')[0].lower()
+        stats = {'bytes': 0, 'hash': hashlib.sha256(), 'cachefile': None, 'headers': None}
+        def output(chunk):
+            fileobj.write(chunk)
+            stats['bytes'] += len(chunk)
+            stats['hash'].update(chunk)
+            if stats['cachefile']:
+                stats['cachefile'].write(chunk)
+        write = output
+        decoder = None
+        if decompress:
+            decoder = streamDecoder(output)
+            write = decoder.feed
+        if self.cache:
+            stats['cachefile'] = self.cache.newfile()
+        try:
+            if prefix in ('http', 'https'):
+                headers = {}
+                if self.cache:
+                    # Revalidate; if nothing changed we get a 304 and use our copy.
+                    headers = self.cache.validators(uri)
+                if decoder:
+                    headers['Accept-Encoding'] = 'gzip, zstd' if zstd_avail else 'gzip'
+                stats['headers'] = self.httpGet(uri, write, auth, headers, decoder)
+            elif prefix in ('file', 'ftp'):
+                # Use the urllib module; there's no connection worth keeping for these.
+                opener = urlrequest.build_opener()
+                if auth and 'user' in auth.keys() and 'password' in auth.keys():
+                    passman = urlrequest.HTTPPasswordMgrWithDefaultRealm()
+                    passman.add_password(None, uri, auth['user'], auth['password'])
+                    opener = urlrequest.build_opener(urlrequest.FTPHandler(), urlrequest.HTTPBasicAuthHandler(passman))
+                with opener.open(uri, timeout = self.timeout) as f:
+                    for chunk in iter(lambda: f.read(fetchchunk), b''):
+                        write(chunk)
+            elif prefix == 'ftps':
+                self.ftpsGet(uri, write, auth)
+            else:
+                exit('{0} is not a recognised URI type specifier. Must be one of http, https, file, ftp, or ftps.'.format(prefix))
+            if decoder:
+                decoder.close()
+        except urlerror.HTTPError as e:
+            if stats['cachefile']:
+                stats['cachefile'].close()
+                os.remove(stats['cachefile'].name)
+            if not (e.code == 304 and self.cache and self.cache.has(uri)):
+                raise
+            fileobj.seek(0)
+            fileobj.truncate()
+            if self.cache.copyTo(uri, fileobj):
+                return(fileobj.tell())
+            # Our copy's missing or corrupt (and now forgotten), so there's nothing left to revalidate; ask for the
+            # whole thing instead.
+            return(self.fetchOnce(uri, fileobj, auth, decompress))
+        except BaseException:
+            if stats['cachefile']:
+                stats['cachefile'].close()
+                os.remove(stats['cachefile'].name)
+            raise
+        if stats['cachefile']:
+            stats['cachefile'].close()
+            self.cache.commit(uri, stats['cachefile'].name, stats['hash'].hexdigest(), stats['bytes'], stats['headers'])
+        return(stats['bytes'])
+
+    def webFetch(self, uri, auth = False):
+        # For things we need in memory anyways (e.g. the XML config).
+        content = BytesIO()
+        self.fetchTo(uri, content, auth)
+        return(content.getvalue())
+
+    def fetchFile(self, uri, dest, auth = False):
+        # Streams uri straight to the file dest. Returns the number of bytes written.
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+        try:
+            with open(dest + '.part', 'wb') as f:
+                size = self.fetchTo(uri, f, auth)
+            os.replace(dest + '.part', dest)
+        finally:
+            if os.path.lexists(dest + '.part'):
+                os.remove(dest + '.part')
+        return(size)
+
+    def getConn(self, key):
+        # Hands back an idle connection to key's host if we have one, or a new one. Blocks while the host
+        # already has maxconns connections in use.
+        with self.lock:
+            if key not in self.slots.keys():
+                self.slots[key] = threading.BoundedSemaphore(self.maxconns)
+                self.pools[key] = []
+            slot = self.slots[key]
+        slot.acquire()
+        with self.lock:
+            if self.pools[key]:
+                return(self.pools[key].pop(), True)
+            self.connects += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httpclient.HTTPSConnection(host, port, timeout = self.timeout, context = ssl.create_default_context())
+        else:
+            conn = httpclient.HTTPConnection(host, port, timeout = self.timeout)
+        return(conn, False)
+
+    def putConn(self, key, conn, reuse = True):
+        with self.lock:
+            if reuse:
+                self.pools[key].append(conn)
+            else:
+                conn.close()
+        self.slots[key].release()
+        return()
+
+    def authHeader(self, uri, host, challenge):
+        # Builds an Authorization header from a WWW-Authenticate challenge and whatever credentials we have
+        # for the host/realm. Returns (realm, header), or (None, None) if we can't answer it.
+        scheme, _, params = challenge.partition(' ')
+        chal = urlrequest.parse_keqv_list(urlrequest.parse_http_list(params))
+        realm = chal.get('realm')
+        with self.lock:
+            auth = self.creds.get((host, realm), self.creds.get((host, None)))
+        if not auth or 'user' not in auth.keys() or 'password' not in auth.keys():
+            return(None, None)
+        if scheme.lower() == 'digest':
+            with self.lock:
+                if (host, realm) not in self.digests.keys():
+                    passman = urlrequest.HTTPPasswordMgrWithDefaultRealm()
+                    passman.add_password(None, uri, auth['user'], auth['password'])
+                    self.digests[(host, realm)] = urlrequest.AbstractDigestAuthHandler(passman)
+                handler = self.digests[(host, realm)]
+                hdr = handler.get_authorization(urlrequest.Request(uri), chal)
+            if not hdr:
+                return(None, None)
+            return(realm, 'Digest {0}'.format(hdr))
+        userpass = '{0}:{1}'.format(auth['user'], auth['password']).encode('utf-8')
+        return(realm, 'Basic {0}'.format(base64.b64encode(userpass).decode('ascii')))
+
+    def httpGet(self, uri, write, auth = False, headers = None, decoder = None, redirects = 5):
+        # GETs uri over a pooled keep-alive connection, handing the body to write() in fetchchunk pieces.
+        # Returns the response headers. Errors (including 304) are raised as urllib HTTPErrors.
+        # If we're given a streamDecoder, it's told about the Content-Encoding before the body starts.
+        parsed = urlparse.urlsplit(uri)
+        key = (parsed.scheme.lower(), parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        if auth and 'user' in auth.keys():
+            with self.lock:
+                self.creds[(parsed.hostname, auth.get('realm'))] = auth
+                if (parsed.hostname, None) not in self.creds.keys():
+                    self.creds[(parsed.hostname, None)] = auth
+        reqheaders = dict(headers or {})
+        reqheaders['Connection'] = 'keep-alive'
+        with self.lock:
+            if key in self.authhdrs.keys():
+                # We already know this server wants Basic auth; skip the 401 round-trip.
+                reqheaders['Authorization'] = self.authhdrs[key][1]
+        conn, reused = self.getConn(key)
+        authed = False
+        try:
+            while True:
+                try:
+                    conn.request('GET', path, headers = reqheaders)
+                    resp = conn.getresponse()
+                    with self.lock:
+                        self.requests += 1
+                except (httpclient.RemoteDisconnected, ConnectionError):
+                    # The server dropped an idle keep-alive connection on us; try once more on a fresh one.
+                    conn.close()
+                    if not reused:
+                        raise
+                    reused = False
+                    with self.lock:
+                        self.connects += 1
+                    continue
+                if resp.status == 401 and not authed:
+                    challenge = resp.getheader('WWW-Authenticate', '')
+                    resp.read()
+                    realm, hdr = self.authHeader(uri, parsed.hostname, challenge)
+                    if hdr:
+                        authed = True
+                        reqheaders['Authorization'] = hdr
+                        if hdr.startswith('Basic '):
+                            with self.lock:
+                                self.authhdrs[key] = (realm, hdr)
+                        continue
+                break
+            if resp.status >= 300:
+                resp.read()
+                location = resp.getheader('Location')
+                if resp.status in (301, 302, 303, 307, 308) and location and redirects:
+                    self.putConn(key, conn, not resp.will_close)
+                    conn = None
+                    return(self.httpGet(urlparse.urljoin(uri, location), write, auth, headers, decoder, redirects - 1))
+                raise urlerror.HTTPError(uri, resp.status, resp.reason, resp.headers, None)
+            if decoder:
+                decoder.encoding = (resp.getheader('Content-Encoding') or '').lower() or None
+            for chunk in iter(lambda: resp.read(fetchchunk), b''):
+                write(chunk)
+        except BaseException:
+            if conn:
+                self.putConn(key, conn, False)
+            raise
+        self.putConn(key, conn, not resp.will_close)
+        return(resp.headers)
+
+    def ftpsGet(self, uri, write, auth = False):
+        username = 'anonymous'
+        password = 'anonymous'
+        if auth:
+            if 'user' in auth.keys():
+                username = auth['user']
+            if 'password' in auth.keys():
+                password = auth['password']
+        filepath = '/'.join(uri.split('/')[3:])
+        server = uri.split('/')[2]
+        with self.lock:
+            if (server, username) not in self.ftps.keys():
+                self.ftps[(server, username)] = [None, threading.Lock()]
+            entry = self.ftps[(server, username)]
+        # FTP is one transfer at a time per control connection, so fetches to the same server take turns.
+        with entry[1]:
+            if entry[0] is not None:
+                try:
+                    entry[0].voidcmd('NOOP')
+                except ftplib.all_errors:
+                    entry[0].close()
+                    entry[0] = None
+            if entry[0] is None:
+                ftps = FTP_TLS(server, timeout = self.timeout)
+                ftps.login(username, password)
+                ftps.prot_p()
+                entry[0] = ftps
+                with self.lock:
+                    self.connects += 1
+            entry[0].retrbinary("RETR " + filepath, write, blocksize = fetchchunk)
+            with self.lock:
+                self.requests += 1
+        return()
+
+    def close(self):
+        with self.lock:
+            for key in self.pools.keys():
+                for conn in self.pools[key]:
+                    conn.close()
+                self.pools[key] = []
+            for key in self.ftps.keys():
+                if self.ftps[key][0] is not None:
+                    try:
+                        self.ftps[key][0].quit()
+                    except ftplib.all_errors:
+                        self.ftps[key][0].close()
+                    self.ftps[key][0] = None
+        return()
+
+def xmlbool(val):
+    return(str(val).lower() in ('true', '1'))
+
+# A compact, typed model of an AIF-NG XML configuration, filled in by a single walk of the tree
+# (see aif.buildModel()). cfgModel.toDict() produces the nested dict that archInstall consumes.
+class cfgPart(object):
+    __slots__ = ('num', 'start', 'stop', 'fstype', 'fs', 'fsopts', 'profile', 'label', 'discard', 'extra')
+    def __init__(self, elem):
+        self.num = elem.get('num')
+        self.start = elem.get('start')
+        self.stop = elem.get('stop')
+        self.fstype = elem.get('fstype')
+        # How it gets formatted; see archInstall.mkfsCmd(). None means "the default".
+        self.fs = elem.get('fs')
+        self.fsopts = elem.get('fsopts')
+        self.profile = elem.get('profile')
+        self.label = elem.get('label')
+        self.discard = elem.get('discard')
+        if self.discard is not None:
+            self.discard = xmlbool(self.discard)
+        # Anything else on the <part>, as-is.
+        self.extra = dict([(k, v) for k, v in elem.items() if k not in cfgPart.__slots__])
+
+class cfgDisk(object):
+    __slots__ = ('device', 'fmt', 'parts')
+    def __init__(self, elem):
+        self.device = elem.get('device')
+        self.fmt = elem.get('diskfmt').lower()
+        if not self.fmt in ('gpt', 'bios'):
+            exit('Device {0}\'s format "{1}" is not a valid type (one of gpt, bios).'.format(self.device,
+                                                                                            self.fmt))
+        self.parts = [cfgPart(x) for x in elem if x.tag == 'part']
+
+class cfgMount(object):
+    __slots__ = ('order', 'device', 'mountpt', 'fstype', 'opts')
+    def __init__(self, elem):
+        self.order = int(elem.get('order'))
+        self.device = elem.get('source')
+        self.mountpt = elem.get('target')
+        self.fstype = elem.get('fstype')
+        self.opts = elem.get('opts')
+
+class cfgIface(object):
+    __slots__ = ('device', 'proto', 'address', 'gateway', 'resolvers')
+    def __init__(self, elem):
+        self.device = elem.get('device')
+        self.proto = elem.get('netproto')
+        self.address = elem.get('address')
+        self.gateway = elem.get('gateway', False)
+        self.resolvers = []
+        for ip in filter(None, re.split('[,\s]+', elem.get('resolvers', ''))):
+            if ip not in self.resolvers:
+                self.resolvers.append(ip)
+
+class cfgUser(object):
+    __slots__ = ('name', 'uid', 'group', 'gid', 'password', 'comment', 'sudo', 'home', 'xgroups')
+    def __init__(self, elem):
+        self.name = elem.get('name')
+        for a in ('uid', 'group', 'gid', 'password', 'comment'):
+            setattr(self, a, elem.get(a))
+        self.sudo = xmlbool(elem.get('sudo'))
+        self.home = False
+        self.xgroups = False
+        for x in elem:
+            if x.tag == 'home':
+                self.home = {'path': x.get('path', False), 'create': xmlbool(x.get('create', False))}
+            elif x.tag == 'xgroup':
+                if not self.xgroups:
+                    self.xgroups = {}
+                self.xgroups[x.get('name')] = {'create': xmlbool(x.get('create', False)), 'gid': x.get('gid', False)}
+
+class cfgRepo(object):
+    __slots__ = ('name', 'enabled', 'siglevel', 'mirror')
+    def __init__(self, elem):
+        self.name = elem.get('name')
+        self.enabled = xmlbool(elem.get('enabled'))
+        self.siglevel = elem.get('siglevel')
+        self.mirror = elem.get('mirror')
+
+class cfgPackage(object):
+    __slots__ = ('name', 'repo')
+    def __init__(self, elem):
+        self.name = elem.get('name')
+        self.repo = elem.get('repo')
+
+class cfgScript(object):
+    __slots__ = ('uri', 'order', 'execution', 'auth')
+    def __init__(self, elem):
+        self.uri = elem.get('uri')
+        self.order = elem.get('order')
+        self.execution = elem.get('execution')
+        self.auth = False
+        if elem.get('user') is not None and elem.get('password') is not None:
+            self.auth = {'user': elem.get('user'), 'password': elem.get('password')}
+            if elem.get('realm') is not None:
+                self.auth['realm'] = elem.get('realm')
+            if elem.get('authtype') is not None:
+                self.auth['type'] = elem.get('authtype')
+
+class cfgModel(object):
+    __slots__ = ('disks', 'mounts', 'hostname', 'ifaces', 'rootpass', 'users', 'timezone', 'locale', 'kbd',
+                 'chrootpath', 'reboot', 'services', 'command', 'cachedir', 'cachesize', 'repos', 'mirrors', 'packages', 'bootloader',
+                 'scripts')
+    def __init__(self):
+        self.disks = []
+        self.mounts = []
+        self.hostname = None
+        self.ifaces = []
+        self.rootpass = False
+        self.users = []
+        for a in ('timezone', 'locale', 'kbd', 'chrootpath', 'reboot'):
+            setattr(self, a, False)
+        self.services = False  # or {name: status}
+        self.command = False
+        self.cachedir = False  # A shared package cache; see archInstall.pkgCacheSetup()
+        self.cachesize = False
+        self.repos = []
+        self.mirrors = False  # or a list of URIs
+        self.packages = False  # or a list of cfgPackages
+        self.bootloader = {}
+        self.scripts = False  # or a list of cfgScripts
+
+    def scriptOrder(self):
+        # Returns [(execution, index, uri, auth), ...] in the order the scripts run. Within each execution
+        # type they're sorted by their order attribute (as strings, as they always have been).
+        order = []
+        if self.scripts is not False:
+            bytype = {'pre': {}, 'post': {}, 'pkg': {}}
+            for x in self.scripts:
+                bytype[x.execution][x.order] = (x.uri, x.auth)
+            for d in ('pre', 'post', 'pkg'):
+                keylst = list(bytype[d].keys())
+                keylst.sort()
+                for i, s in enumerate(keylst):
+                    order.append((d, i, bytype[d][s][0], bytype[d][s][1]))
+        return(order)
+
+    def toDict(self):
+        # The nested dict format from before the model existed, for archInstall. Scripts are left for
+        # aif.buildDict() to fill in, since they need fetching.
+        aifdict = {'disk': {}, 'mount': {}, 'network': {'hostname': self.hostname, 'ifaces': {}},
+                   'system': {'bootloader': dict(self.bootloader)},
+                   'users': {'root': {'password': self.rootpass}},
+                   'software': {'command': self.command, 'cachedir': self.cachedir, 'cachesize': self.cachesize,
+                                'repos': {}, 'mirrors': False, 'packages': False},
+                   'scripts': {'pre': False, 'post': False}}
+        for d in self.disks:
+            aifdict['disk'][d.device] = {'fmt': d.fmt, 'parts': {}}
+            for p in d.parts:
+                part = dict([(a, getattr(p, a)) for a in cfgPart.__slots__
+                             if a != 'extra' and getattr(p, a) is not None])
+                part.update(p.extra)
+                aifdict['disk'][d.device]['parts'][p.num] = part
+        for m in self.mounts:
+            aifdict['mount'][m.order] = {'device': m.device, 'mountpt': m.mountpt, 'fstype': m.fstype, 'opts': m.opts}
+        ifaces = aifdict['network']['ifaces']
+        for i in self.ifaces:
+            # Each <iface> replaces the address list and resolvers of the ones before it for the same device,
+            # but the first gateway for a protocol sticks.
+            if i.device not in ifaces.keys():
+                ifaces[i.device] = {}
+            if i.proto not in ifaces[i.device].keys():
+                ifaces[i.device][i.proto] = {'gw': i.gateway}
+            ifaces[i.device][i.proto]['addresses'] = [i.address]
+            ifaces[i.device]['resolvers'] = list(i.resolvers)
+            if not i.resolvers:
+                ifaces[i.device][i.proto]['resolvers'] = False
+        for u in self.users:
+            aifdict['users'][u.name] = {'uid': u.uid, 'group': u.group, 'gid': u.gid, 'password': u.password,
+                                        'comment': u.comment, 'sudo': u.sudo, 'home': False, 'xgroup': False}
+            if u.home:
+                aifdict['users'][u.name]['home'] = dict(u.home)
+            if u.xgroups:
+                aifdict['users'][u.name]['xgroup'] = dict([(g, dict(v)) for g, v in u.xgroups.items()])
+        for a in ('timezone', 'locale', 'kbd', 'chrootpath', 'reboot'):
+            aifdict['system'][a] = getattr(self, a)
+        aifdict['system']['services'] = False
+        if self.services is not False:
+            aifdict['system']['services'] = dict([(k, {'status': v}) for k, v in self.services.items()])
+        if self.mirrors is not False:
+            aifdict['software']['mirrors'] = list(self.mirrors)
+        for r in self.repos:
+            aifdict['software']['repos'][r.name] = {'enabled': r.enabled, 'siglevel': r.siglevel, 'mirror': r.mirror}
+        if self.packages is not False:
+            aifdict['software']['packages'] = dict([(p.name, {'repo': p.repo}) for p in self.packages])
+        return(aifdict)
+
+# Install plans are the fully-resolved configuration (as from cfgModel.toDict()) plus the bodies of its
+# scripts, as gzipped JSON. They're written by aif-config.py compile, and let the client skip XML parsing and
+# every secondary fetch at boot.
+def planChecksum(plan):
+    # sha256 over the canonical JSON of everything but the checksum itself.
+    body = dict([(k, v) for k, v in plan.items() if k != 'sha256'])
+    return(hashlib.sha256(json.dumps(body, sort_keys = True, separators = (',', ':')).encode('utf-8')).hexdigest())
+
+def planDump(aifdict, scripts = False, source = False):
+    # scripts is False or {'pre': [bytes, ...], 'post': [...], 'pkg': [...]}, in run order.
+    # source, if given, is the raw XML the plan was built from (only its hash is kept).
+    plan = {'aifplan': planversion,
+            'created': int(datetime.datetime.utcnow().timestamp()),
+            'source': (hashlib.sha256(source).hexdigest() if source else False),
+            'config': aifdict,
+            'scripts': False}
+    if scripts is not False:
+        plan['scripts'] = {}
+        for d in ('pre', 'post', 'pkg'):
+            plan['scripts'][d] = [{'sha256': hashlib.sha256(b).hexdigest(),
+                                   'size': len(b),
+                                   'body': base64.b64encode(b).decode('ascii')} for b in scripts.get(d, [])]
+    plan['sha256'] = planChecksum(plan)
+    return(gzip.compress(json.dumps(plan, sort_keys = True, separators = (',', ':')).encode('utf-8'), 9))
+
+def isPlan(data):
+    # The fetch already undid the gzip; plans are JSON objects, configs are XML.
+    return(data.lstrip()[:1] == b'{')
+
+def planLoad(data):
+    # Returns (aifdict, scripts) from a plan (gzipped or not), checking its version and checksums.
+    # Raises ValueError if anything's off.
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    plan = json.loads(data.decode('utf-8'))
+    if not isinstance(plan, dict) or 'aifplan' not in plan.keys():
+        raise ValueError('not an install plan')
+    if not isinstance(plan['aifplan'], int) or plan['aifplan'] > planversion:
+        raise ValueError('plan version {0} is newer than this client supports ({1})'.format(plan['aifplan'],
+                                                                                          planversion))
+    if plan.get('sha256') != planChecksum(plan):
+        raise ValueError('checksum mismatch; the plan is corrupt or was modified')
+    aifdict = plan['config']
+    # JSON only has string keys; the mount order is an int.
+    aifdict['mount'] = dict([(int(k), v) for k, v in aifdict['mount'].items()])
+    scripts = False
+    if plan['scripts'] is not False:
+        scripts = {}
+        for d in ('pre', 'post', 'pkg'):
+            scripts[d] = []
+            for i, s in enumerate(plan['scripts'][d]):
+                body = base64.b64decode(s['body'])
+                if hashlib.sha256(body).hexdigest() != s['sha256']:
+                    raise ValueError('checksum mismatch for {0} script {1}'.format(d, i))
+                scripts[d].append(body)
+    return(aifdict, scripts)
 
 class aif(object):
     
     def __init__(self):
-        pass
+        self.session = fetchSession()
+        # The kernel args we were run with, once getConfig() has read them (archInstall uses some).
+        self.args = False
     
-    def kernelargs(self):
+    def kernelargs(self, cmdline = False):
+        # cmdline, if given, is used instead of reading the kernel's (e.g. for testing/benchmarking).
         if 'DEBUG' in os.environ.keys():
             kernelparamsfile = '/tmp/cmdline'
         else:
@@ -52,14 +870,47 @@ class aif(object):
         args['aif_auth'] = False
         args['aif_realm'] = False
         args['aif_auth'] = 'basic'
-        with open(kernelparamsfile, 'r') as f:
-            cmdline = f.read()
-            for p in shlex.split(cmdline):
-                if p.startswith('aif'):
-                    param = p.split('=')
-                    if len(param) == 1:
-                        param.append(True)
-                    args[param[0]] = param[1]
+        # Local fetch cache
+        args['aif_cache'] = False
+        args['aif_cachesize'] = 104857600
+        # How many connections we keep open to any one server
+        args['aif_hostconns'] = 2
+        # Retries/backoff (in seconds) for fetches, and how long (in seconds) we keep trying altogether
+        args['aif_retries'] = 5
+        args['aif_backoff'] = 1
+        args['aif_deadline'] = 600
+        # How many disks we partition/format at once
+        args['aif_diskjobs'] = 4
+        # How many install tasks may run at once
+        args['aif_jobs'] = 4
+        # How many commands may run at once, across all of them
+        args['aif_cmdjobs'] = 8
+        # A Prometheus textfile to write the install's timings to (the JSON report is always written)
+        args['aif_promfile'] = False
+        # A shared package cache (and the size, in bytes, it's pruned to); these override the config's
+        args['aif_pkgcache'] = False
+        args['aif_pkgcachesize'] = False
+        # A directory to keep prebuilt base rootfs images in
+        args['aif_rootfscache'] = False
+        # Pick up a failed install where it left off (see installJournal)
+        args['aif_resume'] = False
+        # Where to send progress events (see eventEmitter)
+        args['aif_events'] = False
+        # Rank the configured mirrors by speed (optionally with how long, in seconds, each gets to answer)
+        args['aif_rankmirrors'] = False
+        # How commands are run: live, dryrun (nothing is run; the report has the plan) or replay:<report.json>
+        # (a dry run answered from a real install's report), and how much faster than it really was to replay it
+        args['aif_exec'] = False
+        args['aif_execspeed'] = False
+        if not cmdline:
+            with open(kernelparamsfile, 'r') as f:
+                cmdline = f.read()
+        for p in shlex.split(cmdline):
+            if p.startswith('aif'):
+                param = p.split('=', 1)  # URLs can have ='s in them
+                if len(param) == 1:
+                    param.append(True)
+                args[param[0]] = param[1]
         if not args['aif']:
             exit('You do not have AIF enabled. Exiting.')
         args['aif_auth'] = args['aif_auth'].lower()
@@ -68,88 +919,65 @@ class aif(object):
     def getConfig(self, args = False):
         if not args:
             args = self.kernelargs()
-        # Sanitize the user specification and find which protocol to use
-        prefix = args['aif_url'].split(':')[0].lower()
-        # Use the urllib module
-        if prefix in ('http', 'https', 'file', 'ftp'):
-            if args['aif_user'] and args['aif_password']:
-                # Set up Basic or Digest auth.
-                passman = urlrequest.HTTPPasswordMgrWithDefaultRealm()
-                if not args['aif_realm']:
-                    passman.add_password(None, args['aif_url'], args['aif_user'], args['aif_password'])
-                else:
-                    passman.add_password(args['aif_realm'], args['aif_url'], args['aif_user'], args['aif_password'])
-                if args['aif_auth'] == 'digest':
-                    httpauth = urlrequest.HTTPDigestAuthHandler(passman)
-                else:
-                    httpauth = urlrequest.HTTPBasicAuthHandler(passman)
-                httpopener = urlrequest.build_opener(httpauth)
-                urlrequest.install_opener(httpopener)
-            with urlrequest.urlopen(args['aif_url']) as f:
-                conf = f.read()
-        elif prefix == 'ftps':
-            if args['aif_user']:
-                username = args['aif_user']
-            else:
-                username = 'anonymous'
-            if args['aif_password']:
-                password = args['aif_password']
-            else:
-                password = 'anonymous'
-            filepath = '/'.join(args['aif_url'].split('/')[3:])
-            server = args['aif_url'].split('/')[2]
-            content = StringIO()
-            ftps = FTP_TLS(server)
-            ftps.login(username, password)
-            ftps.prot_p()
-            ftps.retrlines("RETR " + filepath, content.write)
-            conf = content.getvalue()
-        else:
-            exit('{0} is not a recognised URI type specifier. Must be one of http, https, file, ftp, or ftps.'.format(prefix))
+        self.args = args
+        self.session.maxconns = int(args['aif_hostconns'])
+        if args['aif_cache']:
+            self.session.cache = fetchCache(args['aif_cache'], args['aif_cachesize'])
+        auth = {}
+        if args['aif_user']:
+            auth['user'] = args['aif_user']
+        if args['aif_password']:
+            auth['password'] = args['aif_password']
+        if args['aif_realm']:
+            auth['realm'] = args['aif_realm']
+        auth['type'] = args['aif_auth']
+        self.session.retries = int(args['aif_retries'])
+        self.session.backoff = float(args['aif_backoff'])
+        self.session.deadline = time.monotonic() + float(args['aif_deadline'])
+        # aif_url can be a comma-separated list of mirrors.
+        urls = [u for u in re.split(',', args['aif_url']) if u != '']
+        try:
+            conf = self.webFetch(urls, auth)
+        except (urlerror.URLError, httpclient.HTTPException, ValueError, zlib.error, lzma.LZMAError) + ftplib.all_errors as e:
+            exit('Could not fetch the configuration from {0}: {1}'.format(', '.join(urls), e))
         return(conf)
 
     def webFetch(self, uri, auth = False):
-        # Sanitize the user specification and find which protocol to use
-        prefix = uri.split(':')[0].lower()
-        # Use the urllib module
-        if prefix in ('http', 'https', 'file', 'ftp'):
-            if auth:
-                if 'user' in auth.keys() and 'password' in auth.keys():
-                    # Set up Basic or Digest auth.
-                    passman = urlrequest.HTTPPasswordMgrWithDefaultRealm()
-                    if not 'realm' in auth.keys():
-                        passman.add_password(None, uri, auth['user'], auth['password'])
-                    else:
-                        passman.add_password(auth['realm'], uri, auth['user'], auth['password'])
-                    if auth['type'] == 'digest':
-                        httpauth = urlrequest.HTTPDigestAuthHandler(passman)
-                    else:
-                        httpauth = urlrequest.HTTPBasicAuthHandler(passman)
-                    httpopener = urlrequest.build_opener(httpauth)
-                    urlrequest.install_opener(httpopener)
-            with urlrequest.urlopen(uri) as f:
-                data = f.read()
-        elif prefix == 'ftps':
-            if auth:
-                if 'user' in auth.keys():
-                    username = auth['user']
-                else:
-                    username = 'anonymous'
-                if 'password' in auth.keys():
-                    password = auth['password']
+        return(self.session.webFetch(uri, auth))
+
+    def fetchFile(self, uri, dest, auth = False):
+        return(self.session.fetchFile(uri, dest, auth))
+
+    def fetchScripts(self, scripts):
+        # scripts is a list of (uri, auth, dest) tuples. They're all fetched at once (up to fetchthreads at a time)
+        # instead of one round-trip after another, each streamed straight to its dest.
+        # Failures are collected and reported together rather than dying on the first one.
+        def fetch(uri, auth, dest):
+            start = time.monotonic()
+            try:
+                size = self.fetchFile(uri, dest, auth)
+                err = None
+            except (Exception, SystemExit) as e:  # fetchTo() exit()s on bad URI types
+                size = 0
+                err = e
+            return((size, err, time.monotonic() - start))
+        results = []
+        if scripts:
+            with ThreadPoolExecutor(max_workers = min(fetchthreads, len(scripts))) as pool:
+                futures = [pool.submit(fetch, uri, auth, dest) for uri, auth, dest in scripts]
+                results = [f.result() for f in futures]
+        failures = []
+        with open(logfile, 'a') as log:
+            for (uri, auth, dest), (size, err, elapsed) in zip(scripts, results):
+                if err is not None:
+                    failures.append('{0}: {1}'.format(uri, err))
+                    status = 'FAILED: {0}'.format(err)
                 else:
-                    password = 'anonymous'
-            filepath = '/'.join(uri.split('/')[3:])
-            server = uri.split('/')[2]
-            content = StringIO()
-            ftps = FTP_TLS(server)
-            ftps.login(username, password)
-            ftps.prot_p()
-            ftps.retrlines("RETR " + filepath, content.write)
-            data = content.getvalue()
-        else:
-            exit('{0} is not a recognised URI type specifier. Must be one of http, https, file, ftp, or ftps.'.format(prefix))
-        return(data)
+                    status = '{0} bytes, {1:.0f} bytes/sec'.format(size, size / max(elapsed, 0.000001))
+                log.write('Fetched {0} in {1:.3f}s ({2})\n'.format(uri, elapsed, status))
+        if failures:
+            exit('Could not fetch the following script(s):\n\t{0}'.format('\n\t'.join(failures)))
+        return([dest for uri, auth, dest in scripts])
 
     def getXML(self, confobj = False):
         if not confobj:
@@ -157,309 +985,1126 @@ class aif(object):
         xmlobj = etree.fromstring(confobj)
         return(xmlobj)
     
-    def buildDict(self, xmlobj = False):
+    def buildModel(self, xmlobj = False):
+        # One walk over the tree; each element is looked at exactly once.
         if not xmlobj:
             xmlobj = self.getXML()
-        # Set up the skeleton dicts
-        aifdict = {}
-        for i in ('disk', 'mount', 'network', 'system', 'users', 'software', 'scripts'):
-            aifdict[i] = {}
-        for i in ('network.ifaces', 'system.bootloader', 'system.services', 'users.root'):
-            i = i.split('.')
-            dictname = i[0]
-            keyname = i[1]
-            aifdict[dictname][keyname] = {}
-        aifdict['scripts']['pre'] = False
-        aifdict['scripts']['post'] = False
-        aifdict['users']['root']['password'] = False
-        for i in ('repos', 'mirrors', 'packages'):
-            aifdict['software'][i] = {}
-        # Set up the dict elements for disk partitioning
-        for i in xmlobj.findall('storage/disk'):
-            disk = i.attrib['device']
-            fmt = i.attrib['diskfmt'].lower()
-            if not fmt in ('gpt', 'bios'):
-                exit('Device {0}\'s format "{1}" is not a valid type (one of gpt, bios).'.format(disk,
-                                                                                                fmt))
-            aifdict['disk'][disk] = {}
-            aifdict['disk'][disk]['fmt'] = fmt
-            aifdict['disk'][disk]['parts'] = {}
-            for x in i:
-                if x.tag == 'part':
-                    partnum = x.attrib['num']
-                    aifdict['disk'][disk]['parts'][partnum] = {}
-                    for a in x.attrib:
-                        aifdict['disk'][disk]['parts'][partnum][a] = x.attrib[a]
-        # Set up mountpoint dicts
-        for i in xmlobj.findall('storage/mount'):
-            device = i.attrib['source']
-            mntpt = i.attrib['target']
-            order = int(i.attrib['order'])
-            if 'fstype' in i.keys():
-                fstype = i.attrib['fstype']
-            else:
-                fstype = None
-            if 'opts' in i.keys():
-                opts = i.attrib['opts']
-            else:
-                opts = None
-            aifdict['mount'][order] = {}
-            aifdict['mount'][order]['device'] = device
-            aifdict['mount'][order]['mountpt'] = mntpt
-            aifdict['mount'][order]['fstype'] = fstype
-            aifdict['mount'][order]['opts'] = opts
-        # Set up networking dicts
-        aifdict['network']['hostname'] = xmlobj.find('network').attrib['hostname']
-        for i in xmlobj.findall('network/iface'):
-            # Create a dict for the iface name.
-            iface = i.attrib['device']
-            proto = i.attrib['netproto']
-            address = i.attrib['address']
-            if 'gateway' in i.attrib.keys():
-                gateway = i.attrib['gateway']
-            else:
-                gateway = False
-            if 'resolvers' in i.attrib.keys():
-                resolvers = i.attrib['resolvers']
-            else:
-                resolvers = False
-            if iface not in aifdict['network']['ifaces'].keys():
-                aifdict['network']['ifaces'][iface] = {}
-            if proto not in aifdict['network']['ifaces'][iface].keys():
-                aifdict['network']['ifaces'][iface][proto] = {}
-            if 'gw' not in aifdict['network']['ifaces'][iface][proto].keys():
-                aifdict['network']['ifaces'][iface][proto]['gw'] = gateway
-            aifdict['network']['ifaces'][iface][proto]['addresses'] = []
-            aifdict['network']['ifaces'][iface][proto]['addresses'].append(address)
-            aifdict['network']['ifaces'][iface]['resolvers'] = []
-            if resolvers:
-                for ip in filter(None, re.split('[,\s]+', resolvers)):
-                    if ip not in aifdict['network']['ifaces'][iface]['resolvers']:
-                        aifdict['network']['ifaces'][iface]['resolvers'].append(ip)
-            else:
-                aifdict['network']['ifaces'][iface][proto]['resolvers'] = False
-        # Set up the users dicts
-        aifdict['users']['root']['password'] = xmlobj.find('system/users').attrib['rootpass']
-        for i in xmlobj.findall('system/users'):
-            for x in i:
-                username = x.attrib['name']
-                aifdict['users'][username] = {} 
-                for a in ('uid', 'group', 'gid', 'password', 'comment', 'sudo'):
-                    if a in x.attrib.keys():
-                        aifdict['users'][username][a] = x.attrib[a]
-                    else:
-                        aifdict['users'][username][a] = None
-                sudo = (x.attrib['sudo']).lower() in ('true', '1')
-                aifdict['users'][username]['sudo'] = sudo
-                # And we also need to handle the homedir and xgroup situation
-                for n in ('home', 'xgroup'):
-                    aifdict['users'][username][n] = False
-                for a in x:
-                    if not aifdict['users'][username][a.tag]:
-                        aifdict['users'][username][a.tag] = {}
-                    for b in a.attrib:
-                        if a.tag == 'xgroup':
-                            if b == 'name':
-                                groupname = a.attrib[b]
-                                if groupname not in aifdict['users'][username]['xgroup'].keys():
-                                    aifdict['users'][username]['xgroup'][a.attrib[b]] = {}
-                            else:
-                                aifdict['users'][username]['xgroup'][a.attrib['name']][b] = a.attrib[b]
-                        else:
-                            aifdict['users'][username][a.tag][b] = a.attrib[b]
-                # And fill in any missing values. We could probably use the XSD and use of defaults to do this, but... oh well.
-                if isinstance(aifdict['users'][username]['xgroup'], dict):
-                    for g in aifdict['users'][username]['xgroup'].keys():
-                        for k in ('create', 'gid'):
-                            if k not in aifdict['users'][username]['xgroup'][g].keys():
-                                aifdict['users'][username]['xgroup'][g][k] = False
-                            elif k == 'create':
-                                aifdict['users'][username]['xgroup'][g][k] = aifdict['users'][username]['xgroup'][g][k].lower() in ('true', '1')
-                if isinstance(aifdict['users'][username]['home'], dict):
-                    for k in ('path', 'create'):
-                        if k not in aifdict['users'][username]['home'].keys():
-                            aifdict['users'][username]['home'][k] = False
-                        elif k == 'create':
-                            aifdict['users'][username]['home'][k] = aifdict['users'][username]['home'][k].lower() in ('true', '1')
-        # Set up the system settings, if applicable.
-        aifdict['system']['timezone'] = False
-        aifdict['system']['locale'] = False
-        aifdict['system']['kbd'] = False
-        aifdict['system']['chrootpath'] = False
-        aifdict['system']['reboot'] = False
-        for i in ('locale', 'timezone', 'kbd', 'chrootpath', 'reboot'):
-            if i in xmlobj.find('system').attrib:
-                aifdict['system'][i] = xmlobj.find('system').attrib[i]
-        aifdict['system']['reboot'] = aifdict['system']['reboot'].lower() in ('true', '1')
-        # And now services...
-        if xmlobj.find('system/service') is None:
-            aifdict['system']['services'] = False
-        else:
-            for x in xmlobj.findall('system/service'):
-                svcname = x.attrib['name']
-                state = x.attrib['status'].lower() in ('true', '1')
-                aifdict['system']['services'][svcname] = {}
-                aifdict['system']['services'][svcname]['status'] = state
-        # And software. First the mirror list.
-        if xmlobj.find('pacman/mirrorlist') is None:
-            aifdict['software']['mirrors'] = False
-        else:
-            aifdict['software']['mirrors'] = []
-            for x in xmlobj.findall('pacman/mirrorlist'):
-                for i in x:
-                    aifdict['software']['mirrors'].append(i.text)
-        # Then the command
-        if 'command' in xmlobj.find('pacman').attrib:
-            aifdict['software']['command'] = xmlobj.find('pacman').attrib['command']
-        else:
-            aifdict['software']['command'] = False
-        # And then the repo list.
-        for x in xmlobj.findall('pacman/repos/repo'):
-            repo = x.attrib['name']
-            aifdict['software']['repos'][repo] = {}
-            aifdict['software']['repos'][repo]['enabled'] = x.attrib['enabled'].lower() in ('true', '1')
-            aifdict['software']['repos'][repo]['siglevel'] = x.attrib['siglevel']
-            aifdict['software']['repos'][repo]['mirror'] = x.attrib['mirror']
-        # And packages.
-        if xmlobj.find('pacman/software') is None:
-            aifdict['software']['packages'] = False
-        else:
-            aifdict['software']['packages'] = {}
-            for x in xmlobj.findall('pacman/software/package'):
-                aifdict['software']['packages'][x.attrib['name']] = {}
-                if 'repo' in x.attrib:
-                    aifdict['software']['packages'][x.attrib['name']]['repo'] = x.attrib['repo']
-                else:
-                    aifdict['software']['packages'][x.attrib['name']]['repo'] = None
-        # The bootloader setup...
-        for x in xmlobj.find('bootloader').attrib:
-            aifdict['system']['bootloader'][x] = xmlobj.find('bootloader').attrib[x]
+        model = cfgModel()
+        for section in xmlobj:
+            if not isinstance(section.tag, str):
+                continue  # comments, processing instructions, etc.
+            if section.tag == 'storage':
+                for x in section:
+                    if x.tag == 'disk':
+                        model.disks.append(cfgDisk(x))
+                    elif x.tag == 'mount':
+                        model.mounts.append(cfgMount(x))
+            elif section.tag == 'network':
+                model.hostname = section.get('hostname')
+                model.ifaces = [cfgIface(x) for x in section if x.tag == 'iface']
+            elif section.tag == 'system':
+                for a in ('locale', 'timezone', 'kbd', 'chrootpath', 'reboot'):
+                    if a in section.keys():
+                        setattr(model, a, section.get(a))
+                model.reboot = xmlbool(model.reboot)
+                for x in section:
+                    if x.tag == 'users':
+                        model.rootpass = x.get('rootpass', False)
+                        model.users.extend([cfgUser(u) for u in x if u.tag == 'user'])
+                    elif x.tag == 'service':
+                        if model.services is False:
+                            model.services = {}
+                        model.services[x.get('name')] = xmlbool(x.get('status'))
+            elif section.tag == 'pacman':
+                model.command = section.get('command', False)
+                model.cachedir = section.get('cachedir', False)
+                model.cachesize = section.get('cachesize', False)
+                for x in section:
+                    if x.tag == 'repos':
+                        model.repos = [cfgRepo(r) for r in x if r.tag == 'repo']
+                    elif x.tag == 'mirrorlist':
+                        if model.mirrors is False:
+                            model.mirrors = []
+                        model.mirrors.extend([m.text for m in x if isinstance(m.tag, str)])
+                    elif x.tag == 'software':
+                        model.packages = [cfgPackage(p) for p in x if p.tag == 'package']
+            elif section.tag == 'bootloader':
+                model.bootloader = dict(section.items())
+            elif section.tag == 'scripts':
+                model.scripts = [cfgScript(x) for x in section if x.tag == 'script']
+        return(model)
+
+    def buildDict(self, xmlobj = False):
+        if not xmlobj:
+            confobj = self.getConfig()
+            # A precompiled install plan (aif-config.py compile) already has everything, scripts included.
+            if isPlan(confobj):
+                return(self.loadPlan(confobj))
+            xmlobj = self.getXML(confobj)
+        model = self.buildModel(xmlobj)
+        aifdict = model.toDict()
         # The script setup...
-        if xmlobj.find('scripts') is not None:
+        if model.scripts is not False:
             aifdict['scripts']['pre'] = []
             aifdict['scripts']['post'] = []
             aifdict['scripts']['pkg'] = []
-            tempscriptdict = {'pre': {}, 'post': {}, 'pkg': {}}
-            for x in xmlobj.find('scripts'):
-                if all(keyname in list(x.attrib.keys()) for keyname in ('user', 'password')):
-                    auth = {}
-                    auth['user'] = x.attrib['user']
-                    auth['password'] = x.attrib['password']
-                    if 'realm' in x.attrib.keys():
-                        auth['realm'] = x.attrib['realm']
-                    if 'authtype' in x.attrib.keys():
-                        auth['type'] = x.attrib['authtype']
-                    scriptcontents = self.webFetch(x.attrib['uri'], auth).decode('utf-8')
-                else:
-                    scriptcontents = self.webFetch(x.attrib['uri']).decode('utf-8')
-                tempscriptdict[x.attrib['execution']][x.attrib['order']] = scriptcontents
+            # Fetch them all in one go; we only keep the paths around, the contents go straight to disk.
+            scriptorder = model.scriptOrder()
+            dests = self.fetchScripts([(uri, auth, '{0}/{1}/{2}'.format(scriptdir, d, i))
+                                       for d, i, uri, auth in scriptorder])
+            for (d, i, uri, auth), path in zip(scriptorder, dests):
+                aifdict['scripts'][d].append(path)
+        return(aifdict)
+
+    def loadPlan(self, data):
+        try:
+            aifdict, scripts = planLoad(data)
+        except ValueError as e:
+            exit('Could not load the install plan: {0}'.format(e))
+        # Write the inlined scripts out to where buildDict() would have fetched them to.
+        if scripts is not False:
             for d in ('pre', 'post', 'pkg'):
-                keylst = list(tempscriptdict[d].keys())
-                keylst.sort()
-                for s in keylst:
-                    aifdict['scripts'][d].append(tempscriptdict[d][s])
+                aifdict['scripts'][d] = []
+                for i, body in enumerate(scripts[d]):
+                    path = '{0}/{1}/{2}'.format(scriptdir, d, i)
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                    with open(path, 'wb') as f:
+                        f.write(body)
+                    aifdict['scripts'][d].append(path)
+        with open(logfile, 'a') as log:
+            log.write('Loaded install plan (version {0}).\n'.format(planversion))
         return(aifdict)
 
+class eventEmitter(object):
+    # Sends progress events (phases starting and ending, commands exiting) to a collector, so a fleet of installs
+    # can be watched from one place; see extras/aif-collector.py. The sink is a URI:
+    #   http(s)://host[:port]/path  batches are POSTed as JSON ({"host": ..., "events": [...]})
+    #   udp://host:port             one JSON event per datagram
+    #   syslog://host[:port]        one RFC 5424 message (with the JSON event as its message) per datagram
+    # emit() never blocks on the network: events go in a bounded queue (the oldest are dropped if it fills up)
+    # that a background thread sends in batches. Anything that can't be sent is dropped, not retried.
+    def __init__(self, maxqueue = 1000, batch = 50, interval = 1.0, timeout = 2):
+        self.maxqueue = maxqueue
+        self.batch = batch
+        self.interval = interval
+        self.timeout = timeout
+        self.sink = False
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closing = False
+        self.seq = 0
+        self.dropped = 0
+        self.sent = 0
+        self.host = socket.gethostname()
+        self.install = '{0:016x}'.format(random.getrandbits(64))
+
+    def configure(self, uri):
+        # Starts sending to uri. The address (and, for https, the CA certificates) are looked up now, since we can't
+        # count on being able to later (e.g. from inside the chroot).
+        if not uri or self.sink:
+            return()
+        parsed = urlparse.urlsplit(uri)
+        scheme = parsed.scheme.lower()
+        ports = {'http': 80, 'https': 443, 'udp': None, 'syslog': 514}
+        if scheme not in ports.keys() or not parsed.hostname or not (parsed.port or ports[scheme]):
+            with open(logfile, 'a') as log:
+                log.write('WARNING: {0} is not a usable event sink; not sending events.\n'.format(uri))
+            return()
+        port = parsed.port or ports[scheme]
+        try:
+            family, socktype, proto, canon, addr = socket.getaddrinfo(parsed.hostname, port, 0,
+                                                                      (socket.SOCK_STREAM if scheme.startswith('http')
+                                                                       else socket.SOCK_DGRAM))[0]
+        except OSError as e:
+            with open(logfile, 'a') as log:
+                log.write('WARNING: could not look up event sink {0} ({1}); not sending events.\n'.format(uri, e))
+            return()
+        self.sink = {'scheme': scheme, 'host': parsed.hostname, 'port': port, 'family': family, 'addr': addr,
+                     'path': (parsed.path or '/') + ('?' + parsed.query if parsed.query else ''),
+                     'ssl': (ssl.create_default_context() if scheme == 'https' else None)}
+        self.thread = threading.Thread(target = self.sender, name = 'aif-events', daemon = True)
+        self.thread.start()
+        return()
+
+    def emit(self, evtype, **fields):
+        if not self.sink:
+            return()
+        fields.update({'type': evtype, 'ts': time.time()})
+        with self.cond:
+            self.seq += 1
+            fields['seq'] = self.seq
+            if len(self.queue) >= self.maxqueue:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(fields)
+            if len(self.queue) >= self.batch:
+                self.cond.notify()
+        return()
+
+    def sender(self):
+        while True:
+            with self.cond:
+                if not self.queue and not self.closing:
+                    self.cond.wait(self.interval)
+                batch = [self.queue.popleft() for i in range(min(self.batch, len(self.queue)))]
+                if not batch and self.closing:
+                    return()
+            if batch:
+                try:
+                    self.send(batch)
+                    self.sent += len(batch)
+                except (OSError, httpclient.HTTPException):
+                    with self.cond:
+                        self.dropped += len(batch)
+
+    def send(self, batch):
+        sink = self.sink
+        if sink['scheme'].startswith('http'):
+            body = json.dumps({'host': self.host, 'install': self.install, 'events': batch}).encode('utf-8')
+            sock = socket.create_connection(sink['addr'][:2], timeout = self.timeout)
+            if sink['ssl']:
+                sock = sink['ssl'].wrap_socket(sock, server_hostname = sink['host'])
+            conn = httpclient.HTTPConnection(sink['host'], sink['port'], timeout = self.timeout)
+            conn.sock = sock  # Already connected, to the address we looked up before.
+            try:
+                conn.request('POST', sink['path'], body = body, headers = {'Content-Type': 'application/json'})
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status >= 300:
+                    raise httpclient.HTTPException('HTTP {0}'.format(resp.status))
+            finally:
+                conn.close()
+            return()
+        with socket.socket(sink['family'], socket.SOCK_DGRAM) as sock:
+            for e in batch:
+                msg = json.dumps(dict(e, host = self.host, install = self.install))
+                if sink['scheme'] == 'syslog':
+                    # local0.info (or .err for failures)
+                    pri = (16 * 8) + (3 if (e.get('status') or e.get('error')) else 6)
+                    msg = '<{0}>1 {1} {2} aif {3} {4} - {5}'.format(pri,
+                                                                 datetime.datetime.utcfromtimestamp(e['ts']).isoformat() + 'Z',
+                                                                 self.host, os.getpid(), e['type'], msg)
+                sock.sendto(msg.encode('utf-8'), sink['addr'])
+        return()
+
+    def close(self, wait = 5):
+        # Sends what's left, giving up after wait seconds.
+        if not self.thread:
+            return()
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(wait)
+        with open(logfile, 'a') as log:
+            log.write('Sent {0} event(s) to {1}://{2}:{3}; {4} dropped.\n'.format(self.sent, self.sink['scheme'],
+                                                                                 self.sink['host'], self.sink['port'],
+                                                                                 self.dropped + len(self.queue)))
+        return()
+
+# Where progress events go, if anywhere; runInstall() configures it from the aif_events kernel arg.
+events = eventEmitter()
+
+# The install phase (a taskGraph task, or a step within one) each thread is working on; see inPhase() and executor.
+phaselocal = threading.local()
+
+def currentPhase():
+    return(getattr(phaselocal, 'phase', None) or 'other')
+
+@contextlib.contextmanager
+def inPhase(name):
+    # Commands run by this thread (see executor) count towards phase name until we're done.
+    prev = getattr(phaselocal, 'phase', None)
+    phaselocal.phase = name
+    start = time.monotonic()
+    events.emit('phase-start', phase = name, parent = prev)
+    try:
+        yield(name)
+    except BaseException as e:
+        events.emit('phase-end', phase = name, seconds = time.monotonic() - start, error = str(e) or type(e).__name__)
+        raise
+    else:
+        events.emit('phase-end', phase = name, seconds = time.monotonic() - start)
+    finally:
+        phaselocal.phase = prev
+
+class logWriter(object):
+    # Every line a command (or the executor, about a command) puts in a log goes through here, so lines from
+    # commands running at the same time come out whole, timestamped, and in the order they arrived.
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def line(self, log, text):
+        with self.lock:
+            log.write('[{0}] {1}\n'.format(datetime.datetime.utcnow().isoformat(timespec = 'seconds'), text))
+            log.flush()
+        return()
+
+class commandRunner(object):
+    # Runs commands from an asyncio event loop in a thread of its own (started when it's first needed), at most
+    # maxprocs at once. Output headed for a log is read from pipes and handed to the logWriter a line at a time,
+    # prefixed with the phase it's for and the command (and PID) it came from. Children are reaped with os.wait4()
+    # (in the loop's thread pool) rather than by asyncio, so we still get their rusage.
+    def __init__(self, writer, maxprocs = 8):
+        self.writer = writer
+        self.maxprocs = max(1, int(maxprocs))
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.sem = None
+
+    def start(self):
+        with self.lock:
+            if not self.loop:
+                self.loop = asyncio.new_event_loop()
+                self.loop.set_default_executor(ThreadPoolExecutor(max_workers = self.maxprocs))
+                self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+                self.thread.start()
+            return(self.loop)
+
+    def close(self):
+        with self.lock:
+            if self.loop:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                self.loop = self.thread = self.sem = None
+        return()
+
+    def run(self, cmd, stdout, stderr, phase):
+        # Runs cmd (from any thread but the loop's) and waits for it; returns (exit status, stdout if it was a PIPE,
+        # rusage). stdout and stderr are as for subprocess.Popen(), except that an open file is written to through
+        # the logWriter instead of being handed to the command.
+        return(asyncio.run_coroutine_threadsafe(self.spawn(cmd, stdout, stderr, phase), self.start()).result())
+
+    async def spawn(self, cmd, stdout, stderr, phase):
+        loop = asyncio.get_running_loop()
+        if not self.sem:
+            self.sem = asyncio.Semaphore(self.maxprocs)
+        # An open os.devnull is handed over as it is; there's nothing to log.
+        outlog = (stdout if hasattr(stdout, 'write') and getattr(stdout, 'name', None) != os.devnull else None)
+        errlog = (stderr if hasattr(stderr, 'write') and getattr(stderr, 'name', None) != os.devnull else None)
+        async with self.sem:
+            proc = subprocess.Popen(cmd,
+                                    stdout = (subprocess.PIPE if outlog else stdout),
+                                    stderr = (subprocess.PIPE if errlog else stderr))
+            prefix = '{0}: {1}[{2}]: '.format(phase, os.path.basename(str(cmd[0])), proc.pid)
+            reads = []
+            if proc.stdout:
+                reads.append(asyncio.ensure_future(self.pump(proc.stdout, outlog, prefix)))
+            if proc.stderr:
+                reads.append(asyncio.ensure_future(self.pump(proc.stderr, errlog, prefix)))
+            pid, status, usage = await loop.run_in_executor(None, os.wait4, proc.pid, 0)
+            if reads:
+                # Something it left running in the background may still have its output open; don't wait on that.
+                done, pending = await asyncio.wait(reads, timeout = 5)
+                for r in pending:
+                    r.cancel()
+                if pending and (outlog or errlog):
+                    self.writer.line(outlog or errlog, '{0}(exited, but its output is still open; not reading it)'.format(prefix))
+        if os.WIFSIGNALED(status):
+            status = -os.WTERMSIG(status)
+        else:
+            status = os.WEXITSTATUS(status)
+        proc.returncode = status  # So the Popen doesn't try to wait on it again.
+        out = None
+        if stdout == subprocess.PIPE:
+            out = (reads[0].result() if reads[0].done() and not reads[0].cancelled() else b'')
+        return(status, out, usage)
+
+    async def pump(self, pipe, log, prefix):
+        # Reads pipe until it's closed. If log is given, each line goes to it as it comes; if not, it's all returned.
+        reader = asyncio.StreamReader()
+        transport, protocol = await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                                                 pipe)
+        try:
+            if not log:
+                return(await reader.read())
+            partial = b''
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for l in lines:
+                    self.writer.line(log, prefix + l.decode('utf-8', 'replace').rstrip('\r'))
+            if partial:
+                self.writer.line(log, prefix + partial.decode('utf-8', 'replace').rstrip('\r'))
+            return(None)
+        finally:
+            transport.close()
+
+class executor(object):
+    # Everything the install does to the system goes through one of these: running commands, and writing, linking,
+    # moving and removing files. This one does it for real; see dryRunExecutor and replayExecutor for the others.
+    # It also keeps track of each command: when it ran, how it exited, the CPU time it used and how much it wrote
+    # (both from its rusage, via os.wait4()), what it printed (if we asked for its output), and which phase it was
+    # part of. Each command is also logged with a timestamp and its exit status. Commands are run by a
+    # commandRunner, at most maxprocs at once.
+    live = True  # Whether we're really touching the system.
+
+    def __init__(self, maxprocs = 8):
+        self.lock = threading.Lock()
+        self.commands = []
+        self.started = time.time()
+        self.logger = logWriter()
+        self.runner = commandRunner(self.logger, maxprocs)
+
+    def execute(self, cmd, stdout, stderr):
+        # Runs cmd; returns (exit status, stdout if it was a PIPE, rusage).
+        return(self.runner.run(cmd, stdout, stderr, currentPhase()))
+
+    def close(self):
+        self.runner.close()
+        return()
+
+    def run(self, cmd, log, stdout, stderr):
+        entry = {'phase': currentPhase(), 'cmd': [str(c) for c in cmd], 'start': time.time()}
+        if log:
+            self.logger.line(log, '{0}: {1}'.format(entry['phase'], ' '.join([shlex.quote(c) for c in entry['cmd']])))
+        status, out, usage = self.execute(cmd, stdout, stderr)
+        entry['end'] = time.time()
+        entry['status'] = status
+        entry['seconds'] = entry['end'] - entry['start']
+        entry['cpu'] = (usage.ru_utime + usage.ru_stime) if usage else 0.0
+        entry['maxrss'] = (usage.ru_maxrss * 1024) if usage else 0
+        entry['written'] = (usage.ru_oublock * 512) if usage else 0
+        if out is not None:
+            entry['output'] = out.decode('utf-8', 'replace')
+        with self.lock:
+            self.commands.append(entry)
+        events.emit('command-exit', phase = entry['phase'], cmd = entry['cmd'], status = entry['status'],
+                    seconds = entry['seconds'])
+        if log:
+            self.logger.line(log, '{0}: exited {1} after {2:.3f}s'.format(entry['phase'], entry['status'], entry['seconds']))
+        return(status, out)
+
+    def call(self, cmd, log = None, stderr = subprocess.STDOUT):
+        # Like subprocess.call(cmd, stdout = log, stderr = subprocess.STDOUT).
+        if not log and stderr == subprocess.STDOUT:
+            stderr = None
+        return(self.run(cmd, log, log, stderr)[0])
+
+    def output(self, cmd, log = None, stderr = None):
+        # Like subprocess.check_output(cmd, stderr = stderr); log (if given) just gets the timestamps.
+        status, out = self.run(cmd, log, subprocess.PIPE, stderr)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, cmd, out)
+        return(out)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return(f.read())
+
+    def write(self, path, data, append = False):
+        with open(path, ('a' if append else 'w') + ('b' if isinstance(data, bytes) else '')) as f:
+            f.write(data)
+        return()
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok = True)
+        return()
+
+    def symlink(self, target, path):
+        os.symlink(target, path)
+        return()
+
+    def remove(self, path):
+        os.remove(path)
+        return()
+
+    def rmtree(self, path):
+        shutil.rmtree(path, ignore_errors = True)
+        return()
+
+    def rename(self, src, dest):
+        os.replace(src, dest)
+        return()
+
+    def copy(self, src, dest):
+        shutil.copy2(src, dest)
+        return()
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+        return()
+
+    def chown(self, path, uid, gid):
+        os.chown(path, uid, gid)
+        return()
+
+    def utime(self, path):
+        os.utime(path)
+        return()
+
+    def chroot(self, path):
+        # Returns what unchroot() needs to get back out.
+        real_root = os.open('/', os.O_RDONLY)
+        os.chroot(path)
+        return(real_root)
+
+    def unchroot(self, real_root):
+        os.fchdir(real_root)
+        os.chroot('.')
+        os.close(real_root)
+        return()
+
+    def bind(self, func):
+        # func, but run in the calling thread's phase (for handing to a worker thread).
+        phase = getattr(phaselocal, 'phase', None)
+        def inner(*args, **kwargs):
+            # Not inPhase(); it's the same phase carrying on, not a new one starting. Whatever the thread was in
+            # before is put back after, in case it's run inline (e.g. nested binds).
+            previous = getattr(phaselocal, 'phase', None)
+            phaselocal.phase = phase
+            try:
+                return(func(*args, **kwargs))
+            finally:
+                phaselocal.phase = previous
+        return(inner)
+
+    def report(self, failed = ()):
+        # Everything we ran, rolled up per phase.
+        phases = {}
+        with self.lock:
+            commands = sorted(self.commands, key = lambda c: c['start'])
+        for c in commands:
+            if c['phase'] not in phases.keys():
+                phases[c['phase']] = {'commands': 0, 'failed': 0, 'seconds': 0.0, 'cpu': 0.0, 'written': 0,
+                                      'maxrss': 0, 'start': c['start'], 'end': c['end']}
+            p = phases[c['phase']]
+            p['commands'] += 1
+            p['failed'] += (1 if c['status'] != 0 else 0)
+            p['seconds'] += c['seconds']
+            p['cpu'] += c['cpu']
+            p['written'] += c['written']
+            p['maxrss'] = max(p['maxrss'], c['maxrss'])
+            p['end'] = max(p['end'], c['end'])
+        return({'started': self.started, 'finished': time.time(), 'success': not failed,
+                'failedtasks': [n for n, e in failed], 'phases': phases, 'commands': commands})
+
+    def writeReport(self, dest, report):
+        with open(dest, 'w') as f:
+            json.dump(report, f, indent = 4)
+        return()
+
+    def writeProm(self, dest, report):
+        # A Prometheus textfile (for node_exporter's textfile collector). Written to a tempfile and renamed into
+        # place, since the collector may read it at any moment.
+        metrics = [('aif_phase_commands', 'gauge', 'Commands run in each install phase.', 'commands'),
+                   ('aif_phase_failed_commands', 'gauge', 'Commands that exited non-zero in each install phase.', 'failed'),
+                   ('aif_phase_seconds', 'gauge', 'Time spent running commands in each install phase.', 'seconds'),
+                   ('aif_phase_cpu_seconds', 'gauge', 'CPU time used by commands in each install phase.', 'cpu'),
+                   ('aif_phase_written_bytes', 'gauge', 'Bytes written to storage by commands in each install phase.', 'written'),
+                   ('aif_phase_max_rss_bytes', 'gauge', 'Largest resident set of any command in each install phase.', 'maxrss')]
+        lines = []
+        for name, mtype, helptext, key in metrics:
+            lines.append('# HELP {0} {1}'.format(name, helptext))
+            lines.append('# TYPE {0} {1}'.format(name, mtype))
+            for phase in sorted(report['phases'].keys()):
+                lines.append('{0}{{phase="{1}"}} {2}'.format(name, phase.replace('\\', '\\\\').replace('"', '\\"'),
+                                                             report['phases'][phase][key]))
+        lines.extend(['# HELP aif_install_seconds How long the install took.', '# TYPE aif_install_seconds gauge',
+                      'aif_install_seconds {0}'.format(report['finished'] - report['started']),
+                      '# HELP aif_install_success Whether the install succeeded.', '# TYPE aif_install_success gauge',
+                      'aif_install_success {0}'.format(int(report['success'])),
+                      '# HELP aif_install_finished_timestamp_seconds When the install finished.',
+                      '# TYPE aif_install_finished_timestamp_seconds gauge',
+                      'aif_install_finished_timestamp_seconds {0}'.format(report['finished'])])
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok = True)
+        with open('{0}.{1}.tmp'.format(dest, os.getpid()), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace('{0}.{1}.tmp'.format(dest, os.getpid()), dest)
+        return()
+
+class dryRunExecutor(executor):
+    # Touches nothing: every command and file operation is added to self.plan, in order, instead. Commands "succeed"
+    # with no output. Files "written" are remembered, so reading them back gets what the install would have put
+    # there; anything else is read from the real filesystem if it's there, and is empty if not. The few queries the
+    # plan can't go on without get a placeholder answer (the disks are all taken to be 64GiB).
+    live = False
+    answers = {('sgdisk', '-F'): '2048\n',
+               ('sgdisk', '-E'): '134217694\n'}
+
+    def __init__(self):
+        super().__init__()
+        self.plan = []
+        self.files = {}
+
+    def step(self, op, **fields):
+        fields.update({'op': op, 'phase': currentPhase()})
+        with self.lock:
+            self.plan.append(fields)
+        return()
+
+    def answer(self, cmd, stdout):
+        if stdout != subprocess.PIPE:
+            return(None)
+        return(self.answers.get(tuple([str(c) for c in cmd[:2]]), '').encode('utf-8'))
+
+    def execute(self, cmd, stdout, stderr):
+        self.step('run', cmd = [str(c) for c in cmd])
+        return(0, self.answer(cmd, stdout), None)
+
+    def report(self, failed = ()):
+        report = super().report(failed)
+        report['plan'] = self.plan
+        return(report)
+
+    def read(self, path):
+        with self.lock:
+            if path in self.files.keys():
+                return(self.files[path])
+        try:
+            return(super().read(path))
+        except OSError:
+            return('')
+
+    def write(self, path, data, append = False):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        current = (self.read(path) if append else '')
+        with self.lock:
+            self.files[path] = current + data
+        self.step('write', path = path, bytes = len(data.encode('utf-8')), append = append)
+        return()
+
+    def makedirs(self, path):
+        self.step('makedirs', path = path)
+        return()
+
+    def symlink(self, target, path):
+        self.step('symlink', target = target, path = path)
+        return()
+
+    def remove(self, path):
+        self.step('remove', path = path)
+        return()
+
+    def rmtree(self, path):
+        self.step('rmtree', path = path)
+        return()
+
+    def rename(self, src, dest):
+        self.step('rename', src = src, dest = dest)
+        return()
+
+    def copy(self, src, dest):
+        data = self.read(src)
+        with self.lock:
+            self.files[dest] = data
+        self.step('copy', src = src, dest = dest)
+        return()
+
+    def chmod(self, path, mode):
+        self.step('chmod', path = path, mode = oct(mode))
+        return()
+
+    def chown(self, path, uid, gid):
+        self.step('chown', path = path, uid = uid, gid = gid)
+        return()
+
+    def utime(self, path):
+        self.step('utime', path = path)
+        return()
+
+    def chroot(self, path):
+        self.step('chroot', path = path)
+        return(None)
+
+    def unchroot(self, real_root):
+        self.step('unchroot')
+        return()
+
+class replayExecutor(dryRunExecutor):
+    # A dry run in which each command gives back the exit status and output it had in a real install's report (see
+    # runInstall()), after taking as long as it took then (divided by speed). Commands the report doesn't have are
+    # answered as in a plain dry run, at once. Identical commands are answered in the order they were recorded.
+    def __init__(self, reportfile, speed = 1.0):
+        super().__init__()
+        self.speed = float(speed)
+        self.recorded = {}
+        self.missing = 0
+        with open(reportfile, 'r') as f:
+            report = json.load(f)
+        for c in report['commands']:
+            self.recorded.setdefault(json.dumps(c['cmd']), collections.deque()).append(c)
+
+    def execute(self, cmd, stdout, stderr):
+        self.step('run', cmd = [str(c) for c in cmd])
+        with self.lock:
+            queue = self.recorded.get(json.dumps([str(c) for c in cmd]))
+            rec = None
+            if queue:
+                rec = (queue.popleft() if len(queue) > 1 else queue[0])
+            else:
+                self.missing += 1
+        if not rec:
+            return(0, self.answer(cmd, stdout), None)
+        if self.speed > 0:
+            time.sleep(rec['seconds'] / self.speed)
+        out = None
+        if stdout == subprocess.PIPE:
+            out = rec.get('output', '').encode('utf-8')
+        return(rec['status'], out, None)
+
+    def report(self, failed = ()):
+        report = super().report(failed)
+        report['unrecorded'] = self.missing
+        return(report)
+
+class installJournal(object):
+    # Records which install steps have finished, and a hash of what went into each, so an install that failed part
+    # of the way through can pick up where it left off (see archInstall.resumeGraph()). It's kept on the new install
+    # (once its root is mounted) and mirrored on the host. Both are written through directory descriptors opened
+    # beforehand, so saving works the same from inside the chroot.
+    def __init__(self, chrootpath, rootdev = False):
+        self.chrootpath = chrootpath
+        self.rootdev = rootdev
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.hostdir = os.open(os.path.dirname(hostjournal), os.O_RDONLY | os.O_DIRECTORY)
+        self.targetdir = None
+
+    @staticmethod
+    def digest(inputs):
+        return(hashlib.sha256(json.dumps(inputs, sort_keys = True, default = str).encode('utf-8')).hexdigest())
+
+    def load(self):
+        # From the host if we've got it (i.e. we're trying again without a reboot), otherwise from the new install's
+        # root filesystem, which is mounted (read-only) just long enough to look. Returns whether we found one.
+        paths = [hostjournal]
+        mnt = False
+        if not os.path.isfile(hostjournal) and not os.path.ismount(self.chrootpath) and self.rootdev:
+            mnt = True
+            os.makedirs(self.chrootpath, exist_ok = True)
+            if subprocess.call(['mount', '-o', 'ro', self.rootdev, self.chrootpath],
+                               stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) != 0:
+                return(False)
+        paths.append(self.chrootpath + journalfile)
+        try:
+            for path in paths:
+                try:
+                    with open(path, 'r') as f:
+                        journal = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                with self.lock:
+                    self.steps = journal['steps']
+                return(True)
+        finally:
+            if mnt:
+                subprocess.call(['umount', self.chrootpath], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        return(False)
+
+    def done(self, name, digest):
+        # The recorded result of step name if it finished with these inputs, as (True, result); else (False, None).
+        with self.lock:
+            entry = self.steps.get(name)
+        if entry and entry['hash'] == digest:
+            return(True, entry['result'])
+        return(False, None)
+
+    def record(self, name, digest, result = None):
+        with self.lock:
+            self.steps[name] = {'hash': digest, 'finished': time.time(), 'result': result}
+        self.save()
+        return()
+
+    def forget(self, names):
+        with self.lock:
+            for n in list(self.steps.keys()):
+                if n in names or n.split('.')[0] in names:
+                    del(self.steps[n])
+        self.save()
+        return()
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'version': 1, 'steps': self.steps}, indent = 4)
+            if self.targetdir is None and os.path.ismount(self.chrootpath):
+                os.makedirs(self.chrootpath + os.path.dirname(journalfile), exist_ok = True)
+                self.targetdir = os.open(self.chrootpath + os.path.dirname(journalfile), os.O_RDONLY | os.O_DIRECTORY)
+            for dirfd, name in ((self.hostdir, os.path.basename(hostjournal)),
+                                (self.targetdir, os.path.basename(journalfile))):
+                if dirfd is None:
+                    continue
+                tmp = '.{0}.tmp'.format(name)
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600, dir_fd = dirfd)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, name, src_dir_fd = dirfd, dst_dir_fd = dirfd)
+        return()
+
+class taskGraph(object):
+    # Runs named tasks as soon as everything they depend on has finished, up to maxjobs at a time.
+    # A task may also name resources it uses; at most capacity[resource] (default 1) tasks hold a resource at
+    # once. Exclusive resources (chroot) mean nothing else runs at the same time at all.
+    exclusive = ('chroot',)
+
+    def __init__(self, maxjobs = 4, capacity = False):
+        self.maxjobs = max(1, int(maxjobs))
+        if not capacity:
+            capacity = {}
+        self.capacity = capacity
+        self.tasks = {}
+        self.order = []
+        self.started = False
+
+    def add(self, name, func, deps = (), resources = ()):
+        if name in self.tasks.keys():
+            raise ValueError('task {0} was added twice'.format(name))
+        self.tasks[name] = {'func': func, 'deps': list(deps), 'resources': list(resources),
+                            'start': None, 'end': None, 'result': None, 'error': None}
+        self.order.append(name)
+        return()
+
+    def result(self, name):
+        return(self.tasks[name]['result'])
+
+    def toposort(self):
+        # Returns the task names in an order that respects their dependencies; raises ValueError on unknown
+        # dependencies or cycles.
+        for name in self.order:
+            for d in self.tasks[name]['deps']:
+                if d not in self.tasks.keys():
+                    raise ValueError('task {0} depends on {1}, which does not exist'.format(name, d))
+        ordered = []
+        state = {}
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return()
+            if state.get(name) == 'visiting':
+                raise ValueError('dependency cycle: {0}'.format(' -> '.join(path + [name])))
+            state[name] = 'visiting'
+            for d in self.tasks[name]['deps']:
+                visit(d, path + [name])
+            state[name] = 'done'
+            ordered.append(name)
+        for name in self.order:
+            visit(name, [])
+        return(ordered)
+
+    def runnable(self, name, done, running, held):
+        task = self.tasks[name]
+        if not all([d in done for d in task['deps']]):
+            return(False)
+        if running and any([r in self.exclusive for r in task['resources']]):
+            return(False)
+        for other in running.values():
+            if any([r in self.exclusive for r in self.tasks[other]['resources']]):
+                return(False)
+        for r in task['resources']:
+            if held.get(r, 0) >= self.capacity.get(r, 1):
+                return(False)
+        return(True)
+
+    def call(self, name):
+        task = self.tasks[name]
+        task['start'] = time.monotonic()
+        try:
+            with inPhase(name):
+                task['result'] = task['func']()
+        except (Exception, SystemExit) as e:
+            task['error'] = e
+        task['end'] = time.monotonic()
+        return(name)
+
+    def run(self):
+        # Runs everything; returns a list of (name, error) for the tasks that failed. Once one fails, nothing
+        # new is started (what's running is left to finish).
+        self.toposort()
+        self.started = time.monotonic()
+        pending = list(self.order)
+        running = {}
+        held = {}
+        done = set()
+        failed = []
+        with ThreadPoolExecutor(max_workers = self.maxjobs) as pool:
+            while pending or running:
+                if not failed:
+                    for name in list(pending):
+                        if len(running) >= self.maxjobs:
+                            break
+                        if self.runnable(name, done, running, held):
+                            pending.remove(name)
+                            for r in self.tasks[name]['resources']:
+                                held[r] = held.get(r, 0) + 1
+                            running[pool.submit(self.call, name)] = name
+                if not running:
+                    break
+                finished, notyet = wait(list(running.keys()), return_when = FIRST_COMPLETED)
+                for f in finished:
+                    name = running.pop(f)
+                    for r in self.tasks[name]['resources']:
+                        held[r] -= 1
+                    if self.tasks[name]['error'] is not None:
+                        failed.append((name, self.tasks[name]['error']))
+                    else:
+                        done.add(name)
+        return(failed)
+
+    def criticalPath(self):
+        # The chain of dependent tasks that took the longest, end to end; returns (names, seconds).
+        finish = {}
+        prev = {}
+        for name in self.toposort():
+            task = self.tasks[name]
+            if task['start'] is None:
+                continue
+            before = [d for d in task['deps'] if d in finish.keys()]
+            longest = max(before, key = lambda d: finish[d]) if before else None
+            prev[name] = longest
+            finish[name] = (task['end'] - task['start']) + (finish[longest] if longest else 0)
+        if not finish:
+            return([], 0)
+        name = max(finish.keys(), key = lambda n: finish[n])
+        total = finish[name]
+        path = []
+        while name:
+            path.insert(0, name)
+            name = prev[name]
+        return(path, total)
+
+    def report(self):
+        lines = []
+        for name in self.order:
+            task = self.tasks[name]
+            if task['start'] is None:
+                lines.append('Task {0}: not run'.format(name))
+                continue
+            status = 'ok' if task['error'] is None else 'FAILED: {0}'.format(task['error'])
+            lines.append('Task {0}: started at +{1:.3f}s, took {2:.3f}s ({3})'.format(name, task['start'] - self.started,
+                                                                                  task['end'] - task['start'], status))
+        path, total = self.criticalPath()
+        ends = [t['end'] for t in self.tasks.values() if t['end'] is not None]
+        elapsed = (max(ends) - self.started) if ends else 0
+        lines.append('Critical path: {0} ({1:.3f}s of {2:.3f}s total)'.format(' -> '.join(path), total, elapsed))
+        return('\n'.join(lines) + '\n')
+
 class archInstall(object):
-    def __init__(self, aifdict):
+    def __init__(self, aifdict, session = False, args = False):
         for k, v in aifdict.items():
             setattr(self, k, v)
+        # The kernel args (see aif.kernelargs()), for the few knobs that affect the install itself.
+        if not args:
+            args = {}
+        self.diskjobs = max(1, int(args.get('aif_diskjobs', 4)))
+        self.jobs = max(1, int(args.get('aif_jobs', 4)))
+        # The shared package cache; the kernel args win over the config.
+        self.pkgcache = args.get('aif_pkgcache') or self.software.get('cachedir', False)
+        self.pkgcachesize = int(args.get('aif_pkgcachesize') or self.software.get('cachesize') or 0)
+        self.rootfscache = args.get('aif_rootfscache', False)
+        self.rankmirrors = args.get('aif_rankmirrors', False)
+        self.promfile = args.get('aif_promfile', False)
+        self.resume = bool(args.get('aif_resume', False))
+        self.journal = False  # See resumeGraph().
+        # Every command the install runs (and every change it makes to a filesystem) goes through this; see
+        # runInstall() for the report.
+        execmode = args.get('aif_exec') or 'live'
+        if execmode in ('dryrun', True):
+            self.ex = dryRunExecutor()
+        elif execmode.startswith('replay:'):
+            self.ex = replayExecutor(execmode.split(':', 1)[1], args.get('aif_execspeed') or 1.0)
+        else:
+            self.ex = executor(args.get('aif_cmdjobs') or 8)
+        if self.rankmirrors is True:
+            self.rankmirrors = 5
+        # Share the aif instance's session (and its open connections/credentials) if we were handed one.
+        if not session:
+            session = fetchSession()
+        self.session = session
 
     def format(self):
-        # NOTE: the following is a dict of fstype codes to their description.
-        fstypes = {'0700': 'Microsoft basic data', '0c01': 'Microsoft reserved', '2700': 'Windows RE', '3000': 'ONIE config', '3900': 'Plan 9', '4100': 'PowerPC PReP boot', '4200': 'Windows LDM data', '4201': 'Windows LDM metadata', '4202': 'Windows Storage Spaces', '7501': 'IBM GPFS', '7f00': 'ChromeOS kernel', '7f01': 'ChromeOS root', '7f02': 'ChromeOS reserved', '8200': 'Linux swap', '8300': 'Linux filesystem', '8301': 'Linux reserved', '8302': 'Linux /home', '8303': 'Linux x86 root (/)', '8304': 'Linux x86-64 root (/', '8305': 'Linux ARM64 root (/)', '8306': 'Linux /srv', '8307': 'Linux ARM32 root (/)', '8400': 'Intel Rapid Start', '8e00': 'Linux LVM', 'a500': 'FreeBSD disklabel', 'a501': 'FreeBSD boot', 'a502': 'FreeBSD swap', 'a503': 'FreeBSD UFS', 'a504': 'FreeBSD ZFS', 'a505': 'FreeBSD Vinum/RAID', 'a580': 'Midnight BSD data', 'a581': 'Midnight BSD boot', 'a582': 'Midnight BSD swap', 'a583': 'Midnight BSD UFS', 'a584': 'Midnight BSD ZFS', 'a585': 'Midnight BSD Vinum', 'a600': 'OpenBSD disklabel', 'a800': 'Apple UFS', 'a901': 'NetBSD swap', 'a902': 'NetBSD FFS', 'a903': 'NetBSD LFS', 'a904': 'NetBSD concatenated', 'a905': 'NetBSD encrypted', 'a906': 'NetBSD RAID', 'ab00': 'Recovery HD', 'af00': 'Apple HFS/HFS+', 'af01': 'Apple RAID', 'af02': 'Apple RAID offline', 'af03': 'Apple label', 'af04': 'AppleTV recovery', 'af05': 'Apple Core Storage', 'bc00': 'Acronis Secure Zone', 'be00': 'Solaris boot', 'bf00': 'Solaris root', 'bf01': 'Solaris /usr & Mac ZFS', 'bf02': 'Solaris swap', 'bf03': 'Solaris backup', 'bf04': 'Solaris /var', 'bf05': 'Solaris /home', 'bf06': 'Solaris alternate sector', 'bf07': 'Solaris Reserved 1', 'bf08': 'Solaris Reserved 2', 'bf09': 'Solaris Reserved 3', 'bf0a': 'Solaris Reserved 4', 'bf0b': 'Solaris Reserved 5', 'c001': 'HP-UX data', 'c002': 'HP-UX service', 'ea00': 'Freedesktop $BOOT', 'eb00': 'Haiku BFS', 'ed00': 'Sony system partition', 'ed01': 'Lenovo system partition', 'ef00': 'EFI System', 'ef01': 'MBR partition scheme', 'ef02': 'BIOS boot partition', 'f800': 'Ceph OSD', 'f801': 'Ceph dm-crypt OSD', 'f802': 'Ceph journal', 'f803': 'Ceph dm-crypt journal', 'f804': 'Ceph disk in creation', 'f805': 'Ceph dm-crypt disk in creation', 'fb00': 'VMWare VMFS', 'fb01': 'VMWare reserved', 'fc00': 'VMWare kcore crash protection', 'fd00': 'Linux RAID'}
-        # We want to build a mapping of commands to run after partitioning. This will be fleshed out in the future to hopefully include more.
-        formatting = {}
-        # TODO: we might want to provide a way to let users specify extra options here.
-        # TODO: label support?
-        formatting['ef00'] = ['mkfs.vfat', '-F', '32', '%PART%']
-        formatting['ef01'] = formatting['ef00']
-        formatting['ef02'] = formatting['ef00']
-        formatting['8200'] = ['mkswap', '-c', '%PART%']
-        formatting['8300'] = ['mkfs.ext4', '-c', '-q', '%PART%']  # some people are DEFINITELY not going to be happy about this. we need to figure out a better way to customize this.
-        for fs in ('8301', '8302', '8303', '8304', '8305', '8306', '8307'):
-            formatting[fs] = formatting['8300']
-        #formatting['8e00'] = FOO  # TODO: LVM configuration
-        #formatting['fd00'] = FOO  # TODO: MDADM configuration
-        cmds = []
-        for d in self.disk:
-            partnums = [int(x) for x in self.disk[d]['parts'].keys()]
-            partnums.sort()
-            cmds.append(['sgdisk', '-Z', d])
-            if self.disk[d]['fmt'] == 'gpt':
-                diskfmt = 'gpt'
-                if len(partnums) >= 129 or partnums[-1] >= 129:
-                    exit('GPT only supports 128 partitions (and partition allocations).')
-                cmds.append(['sgdisk', '-og', d])
-            elif self.disk[d]['fmt'] == 'bios':
-                diskfmt = 'msdos'
-                cmds.append(['sgdisk', '-om', d])
-            cmds.append(['parted', d, '--script', '-a', 'optimal'])
-            with open(logfile, 'a') as log:
-                for c in cmds:
-                    subprocess.call(c, stdout = log, stderr = subprocess.STDOUT)
-            cmds = []
-            disksize = {}
-            disksize['start'] = subprocess.check_output(['sgdisk', '-F', d])
-            disksize['max'] = subprocess.check_output(['sgdisk', '-E', d])
-            for p in partnums:
-                # Need to do some mathz to get the actual sectors if we're using percentages.
-                for s in ('start', 'stop'):
-                    val = self.disk[d]['parts'][str(p)][s]
-                    if '%' in val:
-                        stripped = val.replace('%', '')
-                        modifier = re.sub('[0-9]+%', '', val)
-                        percent = re.sub('(-|\+)*', '', stripped)
-                        decimal = float(percent) / float(100)
-                        newval = int(float(disksize['max']) * decimal)
-                        if s == 'start':
-                            newval = newval + int(disksize['start'])
-                        self.disk[d]['parts'][str(p)][s] = modifier + str(newval)
-            if self.disk[d]['fmt'] == 'gpt':
-                for p in partnums:
-                    size = {}
-                    size['start'] = self.disk[d]['parts'][str(p)]['start']
-                    size['end'] = self.disk[d]['parts'][str(p)]['stop']
-                    fstype = self.disk[d]['parts'][str(p)]['fstype'].lower()
-                    if fstype not in fstypes.keys():
-                        print('Filesystem type {0} is not valid. Must be a code from:\nCODE:FILESYSTEM'.format(fstype))
-                        for k, v in fstypes.items():
-                            print(k + ":" + v)
-                        exit()
-                    cmds.append(['sgdisk',
-                                 '-n', '{0}:{1}:{2}'.format(str(p),
-                                                            self.disk[d]['parts'][str(p)]['start'],
-                                                            self.disk[d]['parts'][str(p)]['stop']),
-                                 #'-c', '{0}:"{1}"'.format(str(p), self.disk[d]['parts'][str(p)]['label']),  # TODO: add support for partition labels
-                                 '-t', '{0}:{1}'.format(str(p), fstype),
-                                 d])
-                    mkformat = formatting[fstype]
-                    for x, y in enumerate(mkformat):
-                        if y == '%PART%':
-                            mkformat[x] = d + str(p)
-                    cmds.append(mkformat)
-                # TODO: add non-gpt stuff here?
+        # Each disk is zapped, partitioned and formatted by its own worker (up to diskjobs at once), logging to its
+        # own file. Nothing gets mounted until every disk is done.
+        disks = list(self.disk.keys())
+        disks.sort()
+        results = {}
+        if disks:
+            with ThreadPoolExecutor(max_workers = min(self.diskjobs, len(disks))) as pool:
+                futures = dict([(d, pool.submit(self.ex.bind(self.formatDisk), d)) for d in disks])
+                for d in disks:
+                    try:
+                        results[d] = futures[d].result()
+                    except (Exception, SystemExit) as e:  # partPlan() exit()s on bad partition types
+                        results[d] = e
+        failures = []
+        with open(logfile, 'a') as log:
+            # Fold the per-disk logs into the main one, in a stable order.
+            for d in disks:
+                devlog = self.diskLog(d)
+                log.write('== {0} ==\n'.format(d))
+                if os.path.isfile(devlog):
+                    with open(devlog, 'r') as f:
+                        shutil.copyfileobj(f, log)
+                if isinstance(results[d], BaseException):
+                    failures.append('{0}: {1}'.format(d, results[d]))
+                    log.write('FAILED: {0}\n'.format(results[d]))
+                else:
+                    log.write('Finished in {0:.3f}s\n'.format(results[d]))
+            log.flush()
+            if failures:
+                exit('Could not set up the following disk(s):\n\t{0}'.format('\n\t'.join(failures)))
+        self.mountAll()
+        return()
+
+    def mountAll(self):
+        # Mounts (and swapons) everything in the config, in order. Anything already mounted is left alone, so this
+        # is also how a resumed install gets its filesystems back.
         with open(logfile, 'a') as log:
-            for p in cmds:
-                subprocess.call(p, stdout = log, stderr = subprocess.STDOUT)
             usermntidx = list(self.mount.keys())
             usermntidx.sort()  # We want to make sure we do this in order.
             for k in usermntidx:
                 if self.mount[k]['mountpt'] == 'swap':
-                    subprocess.call(['swapon', self.mount[k]['device']], stdout = log, stderr = subprocess.STDOUT)
+                    self.ex.call(['swapon', self.mount[k]['device']], log)
+                elif os.path.ismount(self.mount[k]['mountpt']):
+                    continue
                 else:
-                    os.makedirs(self.mount[k]['mountpt'], exist_ok = True)
-                    os.chown(self.mount[k]['mountpt'], 0, 0)
+                    self.ex.makedirs(self.mount[k]['mountpt'])
+                    self.ex.chown(self.mount[k]['mountpt'], 0, 0)
                     cmd = ['mount']
                     if self.mount[k]['fstype']:
                         cmd.extend(['-t', self.mount[k]['fstype']])
                     if self.mount[k]['opts']:
                         cmd.extend(['-o', self.mount[k]['opts']])
                     cmd.extend([self.mount[k]['device'], self.mount[k]['mountpt']])
-                    subprocess.call(cmd, stdout = log, stderr = subprocess.STDOUT)
+                    self.ex.call(cmd, log)
         return()
 
-    def mounts(self):
+    def diskLog(self, d):
+        return('{0}.{1}'.format(logfile, os.path.basename(d)))
+
+    def partDevice(self, d, num):
+        # The kernel puts a "p" between the disk and the partition number if the disk's name ends in a digit
+        # (/dev/loop0p1, /dev/nvme0n1p1, /dev/mmcblk0p1), but not otherwise (/dev/sda1, /dev/vdb1).
+        return('{0}{1}{2}'.format(d, ('p' if d[-1].isdigit() else ''), num))
+
+    def formatDisk(self, d):
+        # Zaps, partitions and formats one disk; returns how long it took. Safe to run alongside other disks.
+        start = time.monotonic()
+        partnums = [int(x) for x in self.disk[d]['parts'].keys()]
+        partnums.sort()
+        cmds = [['sgdisk', '-Z', d]]
+        if self.disk[d]['fmt'] == 'gpt':
+            if len(partnums) >= 129 or partnums[-1] >= 129:
+                exit('GPT only supports 128 partitions (and partition allocations).')
+            cmds.append(['sgdisk', '-og', d])
+        elif self.disk[d]['fmt'] == 'bios':
+            cmds.append(['sgdisk', '-om', d])
+        cmds.append(['parted', d, '--script', '-a', 'optimal'])
+        with open(self.diskLog(d), 'a') as log:
+            for c in cmds:
+                self.ex.call(c, log)
+            disksize = {}
+            disksize['start'] = self.ex.output(['sgdisk', '-F', d], log)
+            disksize['max'] = self.ex.output(['sgdisk', '-E', d], log)
+            for c in self.partPlan(d, disksize):
+                self.ex.call(c, log)
+        return(time.monotonic() - start)
+
+    def partPlan(self, d, disksize):
+        # Works out the partitioning and mkfs commands for disk d, given its first usable and last sectors
+        # (disksize['start'] and disksize['max'], as sgdisk -F/-E report them). Doesn't touch the disk.
+        # NOTE: the following is a dict of fstype codes to their description.
+        fstypes = {'0700': 'Microsoft basic data', '0c01': 'Microsoft reserved', '2700': 'Windows RE', '3000': 'ONIE config', '3900': 'Plan 9', '4100': 'PowerPC PReP boot', '4200': 'Windows LDM data', '4201': 'Windows LDM metadata', '4202': 'Windows Storage Spaces', '7501': 'IBM GPFS', '7f00': 'ChromeOS kernel', '7f01': 'ChromeOS root', '7f02': 'ChromeOS reserved', '8200': 'Linux swap', '8300': 'Linux filesystem', '8301': 'Linux reserved', '8302': 'Linux /home', '8303': 'Linux x86 root (/)', '8304': 'Linux x86-64 root (/', '8305': 'Linux ARM64 root (/)', '8306': 'Linux /srv', '8307': 'Linux ARM32 root (/)', '8400': 'Intel Rapid Start', '8e00': 'Linux LVM', 'a500': 'FreeBSD disklabel', 'a501': 'FreeBSD boot', 'a502': 'FreeBSD swap', 'a503': 'FreeBSD UFS', 'a504': 'FreeBSD ZFS', 'a505': 'FreeBSD Vinum/RAID', 'a580': 'Midnight BSD data', 'a581': 'Midnight BSD boot', 'a582': 'Midnight BSD swap', 'a583': 'Midnight BSD UFS', 'a584': 'Midnight BSD ZFS', 'a585': 'Midnight BSD Vinum', 'a600': 'OpenBSD disklabel', 'a800': 'Apple UFS', 'a901': 'NetBSD swap', 'a902': 'NetBSD FFS', 'a903': 'NetBSD LFS', 'a904': 'NetBSD concatenated', 'a905': 'NetBSD encrypted', 'a906': 'NetBSD RAID', 'ab00': 'Recovery HD', 'af00': 'Apple HFS/HFS+', 'af01': 'Apple RAID', 'af02': 'Apple RAID offline', 'af03': 'Apple label', 'af04': 'AppleTV recovery', 'af05': 'Apple Core Storage', 'bc00': 'Acronis Secure Zone', 'be00': 'Solaris boot', 'bf00': 'Solaris root', 'bf01': 'Solaris /usr & Mac ZFS', 'bf02': 'Solaris swap', 'bf03': 'Solaris backup', 'bf04': 'Solaris /var', 'bf05': 'Solaris /home', 'bf06': 'Solaris alternate sector', 'bf07': 'Solaris Reserved 1', 'bf08': 'Solaris Reserved 2', 'bf09': 'Solaris Reserved 3', 'bf0a': 'Solaris Reserved 4', 'bf0b': 'Solaris Reserved 5', 'c001': 'HP-UX data', 'c002': 'HP-UX service', 'ea00': 'Freedesktop $BOOT', 'eb00': 'Haiku BFS', 'ed00': 'Sony system partition', 'ed01': 'Lenovo system partition', 'ef00': 'EFI System', 'ef01': 'MBR partition scheme', 'ef02': 'BIOS boot partition', 'f800': 'Ceph OSD', 'f801': 'Ceph dm-crypt OSD', 'f802': 'Ceph journal', 'f803': 'Ceph dm-crypt journal', 'f804': 'Ceph disk in creation', 'f805': 'Ceph dm-crypt disk in creation', 'fb00': 'VMWare VMFS', 'fb01': 'VMWare reserved', 'fc00': 'VMWare kcore crash protection', 'fd00': 'Linux RAID'}
+        cmds = []
+        partnums = [int(x) for x in self.disk[d]['parts'].keys()]
+        partnums.sort()
+        for p in partnums:
+            # Need to do some mathz to get the actual sectors if we're using percentages.
+            for s in ('start', 'stop'):
+                val = self.disk[d]['parts'][str(p)][s]
+                if '%' in val:
+                    stripped = val.replace('%', '')
+                    modifier = re.sub('[0-9]+%', '', val)
+                    percent = re.sub('(-|\+)*', '', stripped)
+                    decimal = float(percent) / float(100)
+                    newval = int(float(disksize['max']) * decimal)
+                    if s == 'start':
+                        newval = newval + int(disksize['start'])
+                    self.disk[d]['parts'][str(p)][s] = modifier + str(newval)
+        if self.disk[d]['fmt'] == 'gpt':
+            for p in partnums:
+                fstype = self.disk[d]['parts'][str(p)]['fstype'].lower()
+                if fstype not in fstypes.keys():
+                    print('Filesystem type {0} is not valid. Must be a code from:\nCODE:FILESYSTEM'.format(fstype))
+                    for k, v in fstypes.items():
+                        print(k + ":" + v)
+                    exit('Filesystem type {0} (partition {1}) is not valid.'.format(fstype, p))
+                sgdisk = ['sgdisk',
+                          '-n', '{0}:{1}:{2}'.format(str(p),
+                                                     self.disk[d]['parts'][str(p)]['start'],
+                                                     self.disk[d]['parts'][str(p)]['stop']),
+                          '-t', '{0}:{1}'.format(str(p), fstype)]
+                if self.disk[d]['parts'][str(p)].get('label'):
+                    sgdisk.extend(['-c', '{0}:{1}'.format(str(p), self.disk[d]['parts'][str(p)]['label'])])
+                sgdisk.append(d)
+                cmds.append(sgdisk)
+                mkfs = self.mkfsCmd(self.partDevice(d, p), self.disk[d]['parts'][str(p)])
+                if mkfs:
+                    cmds.append(mkfs)
+            # TODO: add non-gpt stuff here?
+        return(cmds)
+
+    def mkfsCmd(self, dev, part):
+        # Returns the command to format dev as described by part (a partition's dict), or False if it shouldn't be.
+        # The "fast" profile (the default) skips the badblocks scan and initialises ext4's inode tables and
+        # journal lazily, after mounting; "thorough" scans for bad blocks first (ext4 and swap only) and
+        # initialises everything up front. discard, if set, turns TRIMming the partition at mkfs time on or off;
+        # otherwise it's left to the tool.
+        fs = part.get('fs') or fsdefaults.get(part['fstype'].lower(), 'none')
+        thorough = (part.get('profile') == 'thorough')
+        discard = part.get('discard')
+        label = part.get('label')
+        if fs == 'none':
+            return(False)
+        elif fs == 'vfat':
+            cmd = ['mkfs.vfat', '-F', '32']
+            if label:
+                cmd.extend(['-n', label[:11].upper()])
+        elif fs == 'swap':
+            cmd = ['mkswap']
+            if thorough:
+                cmd.append('-c')
+            if label:
+                cmd.extend(['-L', label])
+        elif fs == 'ext4':
+            cmd = ['mkfs.ext4', '-q', '-F']
+            if thorough:
+                cmd.append('-c')
+                extopts = ['lazy_itable_init=0', 'lazy_journal_init=0']
+            else:
+                extopts = ['lazy_itable_init=1', 'lazy_journal_init=1']
+            if discard is not None:
+                extopts.append('discard' if discard else 'nodiscard')
+            cmd.extend(['-E', ','.join(extopts)])
+            if label:
+                cmd.extend(['-L', label[:16]])
+        elif fs in ('xfs', 'btrfs'):
+            cmd = ['mkfs.{0}'.format(fs), '-f']
+            if discard is False:
+                cmd.append('-K')
+            if label:
+                cmd.extend(['-L', (label[:12] if fs == 'xfs' else label)])
+        elif fs == 'f2fs':
+            cmd = ['mkfs.f2fs', '-f']
+            if discard is not None:
+                cmd.extend(['-t', ('1' if discard else '0')])
+            if label:
+                cmd.extend(['-l', label])
+        else:
+            exit('Filesystem {0} (for {1}) is not supported. Must be one of vfat, swap, ext4, xfs, btrfs, f2fs or none.'.format(fs, dev))
+        if part.get('fsopts'):
+            cmd.extend(shlex.split(part['fsopts']))
+        cmd.append(dev)
+        return(cmd)
+
+    def mounts(self, procmounts = False):
+        # procmounts is the contents of /proc/mounts; it's read if not given.
         mntorder = list(self.mount.keys())
         mntorder.sort()
         for m in mntorder:
@@ -476,8 +2121,9 @@ class archInstall(object):
 #            for p in cmd:
 #                subprocess.call(p, stdout = DEVNULL, stderr = subprocess.STDOUT)
         # And we need to add some extra mounts to support a chroot. We also need to know what was mounted before.
-        with open('/proc/mounts', 'r') as f:
-            procmounts = f.read()
+        if not procmounts:
+            with open('/proc/mounts', 'r') as f:
+                procmounts = f.read()
         mountlist = {}
         for i in procmounts.splitlines():
             mountlist[i.split()[1]] = i
@@ -519,68 +2165,203 @@ class archInstall(object):
         if '/tmp' in mountlist.keys():
             if (chrootdir + '/tmp') not in mountlist.keys():
                 cmounts['tmp'] = ['/bin/mount', '-t', 'tmpfs', '-o', 'mode=1777,strictatime,nodev,nosuid', 'tmp', chrootdir + '/tmp']
+        # The shared package cache (see pkgCacheSetup()), and the host side of it if it's a device or an NFS export.
+        # Either may already be there if we're resuming.
+        cmounts['pkgcachesrc'] = None
+        cmounts['pkgcache'] = None
+        if self.pkgcache:
+            src = self.pkgcache
+            if src.startswith('/dev/') or re.match('^[^/]+:/', src):
+                if pkgcachemnt not in mountlist.keys():
+                    cmounts['pkgcachesrc'] = ['mount'] + ([] if src.startswith('/dev/') else ['-t', 'nfs']) + [src, pkgcachemnt]
+                src = pkgcachemnt
+            if (chrootdir + '/var/cache/pacman/pkg') not in mountlist.keys():
+                cmounts['pkgcache'] = ['mount', '--bind', src, chrootdir + '/var/cache/pacman/pkg']
         # Because the order of these mountpoints is so ridiculously important, we hardcode it.
         # Yeah, python 3.6 has ordered dicts, but do we really want to risk it?
         # Okay. So we finally have all the mounts bound. Whew.
         return(cmounts)
     
-    def setup(self, mounts = False):
-        # TODO: could we leverage https://github.com/hartwork/image-bootstrap somehow? I want to keep this close
-        # to standard Python libs, though, to reduce dependency requirements.
-        hostscript = []
-        chrootcmds = []
-        locales = []
-        locale = []
-        if not mounts:
-            mounts = self.mounts()
-        # Get the necessary fstab additions for the guest
-        chrootfstab = subprocess.check_output(['genfstab', '-U', self.system['chrootpath']])
-        # Set up the time, and then kickstart the guest install.
-        hostscript.append(['timedatectl', 'set-ntp', 'true'])
-        # Also start haveged if we have it.
+    def timeSync(self):
+        # Set up the time, and also start haveged if we have it.
+        with open(logfile, 'a') as log:
+            self.ex.call(['timedatectl', 'set-ntp', 'true'], log)
         try:
-            with open(os.devnull, 'w') as devnull:
-                subprocess.call(['haveged'], stderr = devnull)
+            self.ex.call(['haveged'], None, subprocess.DEVNULL)
         except:
             pass
+        return()
+
+    def keyring(self):
         # Make sure we get the keys, in case we're running from a minimal live env.
-        hostscript.append(['pacman-key', '--init'])
-        hostscript.append(['pacman-key', '--populate'])
-        hostscript.append(['pacstrap', self.system['chrootpath'], 'base'])
-        # Run the basic host prep
-        #with open(os.devnull, 'w') as DEVNULL:
         with open(logfile, 'a') as log:
-            for c in hostscript:
-                subprocess.call(c, stdout = log, stderr = subprocess.STDOUT)
-        with open('{0}/etc/fstab'.format(self.system['chrootpath']), 'a') as f:
-            f.write('# Generated by AIF-NG.\n')
-            f.write(chrootfstab.decode('utf-8'))
+            for c in (['pacman-key', '--init'], ['pacman-key', '--populate']):
+                self.ex.call(c, log)
+        return()
+
+    def pacstrap(self):
+        # With a rootfs cache, the base system is restored from an image of an earlier pacstrap of the exact same
+        # package versions if we have one (one bulk write instead of resolving and installing every package), and
+        # an image is made for next time if we don't.
+        key = False
+        if self.rootfscache:
+            key = self.rootfsKey()
+        with open(logfile, 'a') as log:
+            if key and self.rootfsRestore(key, log):
+                return()
+            self.ex.call(['pacstrap', self.system['chrootpath']] + basepkgs, log)
+            if key:
+                self.rootfsStore(key, log)
+        return()
+
+    def rootfsImage(self, key):
+        return(os.path.join(self.rootfscache, 'rootfs-{0}.tar.zst'.format(key)))
+
+    def rootfsKey(self):
+        # The SHA256 of the architecture and every package (and version) pacstrap would install right now. The
+        # resolving is done against a scratch pacman DB (with freshly synced repos), so neither what the host has
+        # installed nor how stale its sync DBs are makes a difference. Returns False if we couldn't resolve it.
+        dbpath = tempfile.mkdtemp(prefix = '.aif.rootfs.')
+        try:
+            with open(logfile, 'a') as log:
+                if self.ex.call(['pacman', '-Sy', '--dbpath', dbpath], log) != 0:
+                    log.write('WARNING: could not sync a package DB to resolve the base system; not using the rootfs cache.\n')
+                    return(False)
+                try:
+                    resolved = self.ex.output(['pacman', '-Sp', '--dbpath', dbpath, '--print-format', '%n %v'] + basepkgs,
+                                                 log, log)
+                except subprocess.CalledProcessError:
+                    return(False)
+            pkgs = sorted(resolved.decode('utf-8').splitlines())
+        finally:
+            shutil.rmtree(dbpath, ignore_errors = True)
+        hasher = hashlib.sha256()
+        hasher.update('{0}\n'.format(os.uname().machine).encode('utf-8'))
+        hasher.update('\n'.join(pkgs).encode('utf-8'))
+        return(hasher.hexdigest())
+
+    def rootfsRestore(self, key, log):
+        # Extracts the image for key into the chroot. Returns False if there isn't one (or it wouldn't extract, in
+        # which case pacstrap is run over whatever made it out).
+        image = self.rootfsImage(key)
+        if not os.path.isfile(image):
+            log.write('No rootfs image for {0}; running pacstrap.\n'.format(key))
+            log.flush()
+            return(False)
+        log.write('Restoring the base system from {0}.\n'.format(image))
+        log.flush()
+        if self.ex.call(['tar', '--zstd', '--xattrs', '--xattrs-include=*', '--acls', '--numeric-owner', '-xpf',
+                            image, '-C', self.system['chrootpath']], log) != 0:
+            log.write('WARNING: could not restore {0}; running pacstrap.\n'.format(image))
+            log.flush()
+            return(False)
+        self.ex.utime(image)  # So pruning keeps the ones in use.
+        return(True)
+
+    def rootfsStore(self, key, log):
+        # Images the freshly pacstrapped chroot (minus the packages, which are in the package cache if there is one)
+        # for next time, then prunes all but the rootfskeep most recently used images.
+        self.ex.makedirs(self.rootfscache)
+        image = self.rootfsImage(key)
+        # Concurrent installs may be building the same image; the last one to finish wins, which is fine.
+        tmp = '{0}.{1}.tmp'.format(image, os.getpid())
+        if self.ex.call(['tar', '--zstd', '--xattrs', '--xattrs-include=*', '--acls', '--numeric-owner',
+                            '--exclude=./var/cache/pacman/pkg/*', '--exclude=./lost+found', '-cpf', tmp,
+                            '-C', self.system['chrootpath'], '.'], log) != 0:
+            log.write('WARNING: could not build a rootfs image.\n')
+            if os.path.isfile(tmp):
+                self.ex.remove(tmp)
+            return()
+        self.ex.rename(tmp, image)
+        if self.ex.live:
+            log.write('Stored the base system as {0}.\n'.format(image))
+        # In a dry run, the cache may not be there at all.
+        if not os.path.isdir(self.rootfscache):
+            return()
+        images = [os.path.join(self.rootfscache, f) for f in os.listdir(self.rootfscache)
+                  if f.startswith('rootfs-') and f.endswith('.tar.zst')]
+        images.sort(key = os.path.getmtime, reverse = True)
+        for i in images[rootfskeep:]:
+            self.ex.remove(i)
+        return()
+
+    def writeBlock(self, path, block):
+        # Adds block (whose first line marks it as ours) to the end of path, in place of whatever an earlier run of
+        # the same step added, so the step can be run again (e.g. when resuming) without doubling anything up.
+        try:
+            lines = self.ex.read(path).splitlines(keepends = True)
+        except OSError:
+            lines = []
+        marker = block.splitlines(keepends = True)[0]
+        if marker in lines:
+            lines = lines[:lines.index(marker)]
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        self.ex.write(path, ''.join(lines) + block)
+        return()
+
+    def relink(self, target, path):
+        # A symlink that replaces whatever's at path already.
+        if os.path.lexists(path):
+            self.ex.remove(path)
+        self.ex.symlink(target, path)
+        return()
+
+    def fstab(self):
+        # Get the necessary fstab additions for the guest
+        chrootfstab = self.ex.output(['genfstab', '-U', self.system['chrootpath']])
+        self.writeBlock('{0}/etc/fstab'.format(self.system['chrootpath']),
+                        '# Generated by AIF-NG.\n' + chrootfstab.decode('utf-8'))
+        return()
+
+    def chrootMounts(self, mounts = False):
+        if not mounts:
+            mounts = self.mounts()
         with open(logfile, 'a') as log:
             for m in ('resolv', 'proc', 'sys', 'efi', 'dev', 'pts', 'shm', 'run', 'tmp'):
                 if mounts[m]:
-                    subprocess.call(mounts[m], stdout = log, stderr = subprocess.STDOUT)
+                    self.ex.call(mounts[m], log)
+        return()
 
+    def hostInfo(self):
+        # The things we need to ask the host about to configure the guest.
+        self.hostinfo = {'timezones': [], 'rtclocal': False, 'autoiface': False}
         # Validating this would be better with pytz, but it's not stdlib. dateutil would also work, but same problem.
         # https://stackoverflow.com/questions/15453917/get-all-available-timezones
-        tzlist = subprocess.check_output(['timedatectl', 'list-timezones']).decode('utf-8').splitlines()
-        if self.system['timezone'] not in tzlist:
-            print('WARNING (non-fatal): {0} does not seem to be a valid timezone, but we\'re continuing anyways.'.format(self.system['timezone']))
-        tzfile = '{0}/etc/localtime'.format(self.system['chrootpath'])
-        if os.path.lexists(tzfile):
-            os.remove(tzfile)
-        os.symlink('/usr/share/zoneinfo/{0}'.format(self.system['timezone']), tzfile)
+        self.hostinfo['timezones'] = self.ex.output(['timedatectl', 'list-timezones']).decode('utf-8').splitlines()
         # This is an ugly hack. TODO: find a better way of determining if the host is set to UTC in the RTC. maybe the datetime module can do it.
-        utccheck = subprocess.check_output(['timedatectl', 'status']).decode('utf-8').splitlines()
+        utccheck = self.ex.output(['timedatectl', 'status']).decode('utf-8').splitlines()
         utccheck = [x.strip(' ') for x in utccheck]
         for i, v in enumerate(utccheck):
             if v.startswith('RTC in local'):
-                utcstatus = (v.split(': ')[1]).lower() in ('yes')
+                self.hostinfo['rtclocal'] = (v.split(': ')[1]).lower() in ('yes')
                 break
-        if utcstatus:
+        # Ideally we'd find a better way to do... all of this. Patches welcome. TODO.
+        if 'auto' in self.network['ifaces'].keys():
+            # Get the default route interface.
+            for line in self.ex.output(['ip', '-oneline', 'route', 'show']).decode('utf-8').splitlines():
+                line = line.split()
+                if line[0] == 'default':
+                    self.hostinfo['autoiface'] = line[4]
+                    break
+        return(self.hostinfo)
+
+    def configure(self):
+        # Writes the guest's configuration (after pacstrap, with hostInfo() done); returns the commands that
+        # still need to be run in the chroot.
+        chrootcmds = []
+        locales = []
+        locale = []
+        if self.system['timezone'] not in self.hostinfo['timezones']:
+            print('WARNING (non-fatal): {0} does not seem to be a valid timezone, but we\'re continuing anyways.'.format(self.system['timezone']))
+        self.relink('/usr/share/zoneinfo/{0}'.format(self.system['timezone']),
+                    '{0}/etc/localtime'.format(self.system['chrootpath']))
+        if self.hostinfo['rtclocal']:
             chrootcmds.append(['hwclock', '--systohc'])
         # We need to check the locale, and set up locale.gen.
-        with open('{0}/etc/locale.gen'.format(self.system['chrootpath']), 'r') as f:
-            localeraw = f.readlines()
+        localeraw = self.ex.read('{0}/etc/locale.gen'.format(self.system['chrootpath'])).splitlines(keepends = True)
+        if localeraw and localeraw[0] == '# Modified by AIF-NG.\n':
+            localeraw.pop(0)  # From an earlier run.
         for line in localeraw:
             if not line.startswith('# '):  # Comments, thankfully, have a space between the leading octothorpe and the comment. Locales have no space.
                 i = line.strip().strip('#')
@@ -594,35 +2375,94 @@ class archInstall(object):
             for x in locale:
                 if v.startswith('#{0}'.format(x)):
                     localeraw[i] = x + '\n'
-        with open('{0}/etc/locale.gen'.format(self.system['chrootpath']), 'w') as f:
-            f.write('# Modified by AIF-NG.\n')
-            f.write(''.join(localeraw))
-        with open('{0}/etc/locale.conf'.format(self.system['chrootpath']), 'a') as f:
-            f.write('# Added by AIF-NG.\n')
-            f.write('LANG={0}\n'.format(locale[0].split()[0]))
+        self.ex.write('{0}/etc/locale.gen'.format(self.system['chrootpath']), '# Modified by AIF-NG.\n' + ''.join(localeraw))
+        if not locale:
+            # Not in locale.gen (or there isn't one, e.g. in a dry run); it's up to locale-gen to complain.
+            locale.append(self.system['locale'])
+        self.writeBlock('{0}/etc/locale.conf'.format(self.system['chrootpath']),
+                        '# Added by AIF-NG.\nLANG={0}\n'.format(locale[0].split()[0]))
         chrootcmds.append(['locale-gen'])
         # Set up the kbd layout.
         # Currently there is NO validation on this. TODO.
         if self.system['kbd']:
-            with open('{0}/etc/vconsole.conf'.format(self.system['chrootpath']), 'a') as f:
-                f.write('# Generated by AIF-NG.\nKEYMAP={0}\n'.format(self.system['kbd']))
+            self.writeBlock('{0}/etc/vconsole.conf'.format(self.system['chrootpath']),
+                            '# Generated by AIF-NG.\nKEYMAP={0}\n'.format(self.system['kbd']))
         # Set up the hostname.
-        with open('{0}/etc/hostname'.format(self.system['chrootpath']), 'w') as f:
-            f.write('# Generated by AIF-NG.\n')
-            f.write(self.network['hostname'] + '\n')
-        with open('{0}/etc/hosts'.format(self.system['chrootpath']), 'a') as f:
-            f.write('# Added by AIF-NG.\n127.0.0.1\t{0}\t{1}\n'.format(self.network['hostname'],
-                                                                       (self.network['hostname']).split('.')[0]))
+        self.ex.write('{0}/etc/hostname'.format(self.system['chrootpath']),
+                      '# Generated by AIF-NG.\n{0}\n'.format(self.network['hostname']))
+        self.writeBlock('{0}/etc/hosts'.format(self.system['chrootpath']),
+                        '# Added by AIF-NG.\n127.0.0.1\t{0}\t{1}\n'.format(self.network['hostname'],
+                                                                           (self.network['hostname']).split('.')[0]))
         # Set up networking.
-        ifaces = []
-        # Ideally we'd find a better way to do... all of this. Patches welcome. TODO.
-        if 'auto' in self.network['ifaces'].keys():
-            # Get the default route interface.
-            for line in subprocess.check_output(['ip', '-oneline', 'route', 'show']).decode('utf-8').splitlines():
-                line = line.split()
-                if line[0] == 'default':
-                    autoiface = line[4]
-                    break
+        for ifacedev, iftype, netprofile in self.netProfiles(self.hostinfo['autoiface']):
+            filename = '{0}/etc/netctl/{1}'.format(self.system['chrootpath'], ifacedev)
+            sysdfile = '{0}/etc/systemd/system/netctl@{1}.service'.format(self.system['chrootpath'], ifacedev)
+            # The good news is since it's a clean install, we only have to account for our own data, not pre-existing.
+            self.ex.write(filename, '# Generated by AIF-NG.\n' + netprofile)
+            self.ex.write(sysdfile, ('# Generated by AIF-NG.\n' +
+                                     '.include /usr/lib/systemd/system/netctl@.service\n\n[Unit]\n' +
+                                     'Description=A basic {0} ethernet connection\n' +
+                                     'BindsTo=sys-subsystem-net-devices-{1}.device\n' +
+                                     'After=sys-subsystem-net-devices-{1}.device\n').format(iftype, ifacedev))
+            self.relink('/etc/systemd/system/netctl@{0}.service'.format(ifacedev),
+                        '{0}/etc/systemd/system/multi-user.target.wants/netctl@{1}.service'.format(self.system['chrootpath'], ifacedev))
+        self.relink('/usr/lib/systemd/system/netctl.service',
+                    '{0}/etc/systemd/system/multi-user.target.wants/netctl.service'.format(self.system['chrootpath']))
+        # Root password
+        if self.users['root']['password']:
+            roothash = self.users['root']['password']
+        else:
+            roothash = '!'
+        shadow = []
+        for line in self.ex.read('{0}/etc/shadow'.format(self.system['chrootpath'])).splitlines(keepends = True):
+            linelst = line.split(':')
+            if linelst[0] == 'root':
+                linelst[1] = roothash
+            shadow.append(':'.join(linelst))
+        self.ex.write('{0}/etc/shadow'.format(self.system['chrootpath']), ''.join(shadow))
+        # Add users
+        for user in self.users.keys():
+            # We already handled root user
+            if user != 'root':
+                cmd = ['useradd']
+                if self.users[user]['home']['create']:
+                    cmd.append('-m')
+                if self.users[user]['home']['path']:
+                    cmd.append('-d {0}'.format(self.users[user]['home']['path']))
+                if self.users[user]['comment']:
+                    cmd.append('-c "{0}"'.format(self.users[user]['comment']))
+                if self.users[user]['gid']:
+                    cmd.append('-g {0}'.format(self.users[user]['gid']))
+                if self.users[user]['uid']:
+                    cmd.append('-u {0}'.format(self.users[user]['uid']))
+                if self.users[user]['password']:
+                    cmd.append('-p "{0}"'.format(self.users[user]['password']))
+                cmd.append(user)
+                chrootcmds.append(cmd)
+                # Add groups
+                if self.users[user]['xgroup']:
+                    for group in self.users[user]['xgroup'].keys():
+                        gcmd = False
+                        if self.users[user]['xgroup'][group]['create']:
+                            gcmd = ['groupadd']
+                            if self.users[user]['xgroup'][group]['gid']:
+                                gcmd.append('-g {0}'.format(self.users[user]['xgroup'][group]['gid']))
+                            gcmd.append(group)
+                            chrootcmds.append(gcmd)
+                    chrootcmds.append(['usermod', '-aG', '{0}'.format(','.join(self.users[user]['xgroup'].keys())), user])
+                # Handle sudo
+                if self.users[user]['sudo']:
+                    self.ex.makedirs('{0}/etc/sudoers.d'.format(self.system['chrootpath']))
+                    self.ex.chmod('{0}/etc/sudoers.d'.format(self.system['chrootpath']), 0o750)
+                    self.ex.write('{0}/etc/sudoers.d/{1}'.format(self.system['chrootpath'], user),
+                                  '# Generated by AIF-NG.\nDefaults:{0} !lecture\n{0} ALL=(ALL) ALL\n'.format(user))
+        # The initramfs is (re)built once, after the package transaction; see packagecmds().
+        return(chrootcmds)
+    
+    def netProfiles(self, autoiface = False):
+        # Builds the netctl profile for each interface; returns a list of (device, type, profile text).
+        # autoiface is the device the 'auto' iface (if any) maps to (the host's default route).
+        profiles = []
         ifaces = list(self.network['ifaces'].keys())
         ifaces.sort()
         if autoiface in ifaces:
@@ -672,73 +2512,9 @@ class archInstall(object):
             # DNS resolvers
             if resolvers:
                 netprofile += 'DNS=(\'{0}\')\n'.format('\' \''.join(resolvers))
-            filename = '{0}/etc/netctl/{1}'.format(self.system['chrootpath'], ifacedev)
-            sysdfile = '{0}/etc/systemd/system/netctl@{1}.service'.format(self.system['chrootpath'], ifacedev)
-            # The good news is since it's a clean install, we only have to account for our own data, not pre-existing.
-            with open(filename, 'w') as f:
-                f.write('# Generated by AIF-NG.\n')
-                f.write(netprofile)
-            with open(sysdfile, 'w') as f:
-                f.write('# Generated by AIF-NG.\n')
-                f.write(('.include /usr/lib/systemd/system/netctl@.service\n\n[Unit]\n' +
-                         'Description=A basic {0} ethernet connection\n' +
-                         'BindsTo=sys-subsystem-net-devices-{1}.device\n' +
-                         'After=sys-subsystem-net-devices-{1}.device\n').format(iftype, ifacedev))
-            os.symlink('/etc/systemd/system/netctl@{0}.service'.format(ifacedev),
-                       '{0}/etc/systemd/system/multi-user.target.wants/netctl@{1}.service'.format(self.system['chrootpath'], ifacedev))
-        os.symlink('/usr/lib/systemd/system/netctl.service',
-                   '{0}/etc/systemd/system/multi-user.target.wants/netctl.service'.format(self.system['chrootpath']))
-        # Root password
-        if self.users['root']['password']:
-            roothash = self.users['root']['password']
-        else:
-            roothash = '!'
-        with fileinput.input('{0}/etc/shadow'.format(self.system['chrootpath']), inplace = True) as f:
-            for line in f:
-                linelst = line.split(':')
-                if linelst[0] == 'root':
-                    linelst[1] = roothash
-                print(':'.join(linelst), end = '')
-        # Add users
-        for user in self.users.keys():
-            # We already handled root user
-            if user != 'root':
-                cmd = ['useradd']
-                if self.users[user]['home']['create']:
-                    cmd.append('-m')
-                if self.users[user]['home']['path']:
-                    cmd.append('-d {0}'.format(self.users[user]['home']['path']))
-                if self.users[user]['comment']:
-                    cmd.append('-c "{0}"'.format(self.users[user]['comment']))
-                if self.users[user]['gid']:
-                    cmd.append('-g {0}'.format(self.users[user]['gid']))
-                if self.users[user]['uid']:
-                    cmd.append('-u {0}'.format(self.users[user]['uid']))
-                if self.users[user]['password']:
-                    cmd.append('-p "{0}"'.format(self.users[user]['password']))
-                cmd.append(user)
-                chrootcmds.append(cmd)
-                # Add groups
-                if self.users[user]['xgroup']:
-                    for group in self.users[user]['xgroup'].keys():
-                        gcmd = False
-                        if self.users[user]['xgroup'][group]['create']:
-                            gcmd = ['groupadd']
-                            if self.users[user]['xgroup'][group]['gid']:
-                                gcmd.append('-g {0}'.format(self.users[user]['xgroup'][group]['gid']))
-                            gcmd.append(group)
-                            chrootcmds.append(gcmd)
-                    chrootcmds.append(['usermod', '-aG', '{0}'.format(','.join(self.users[user]['xgroup'].keys())), user])
-                # Handle sudo
-                if self.users[user]['sudo']:
-                    os.makedirs('{0}/etc/sudoers.d'.format(self.system['chrootpath']), exist_ok = True)
-                    os.chmod('{0}/etc/sudoers.d'.format(self.system['chrootpath']), 0o750)
-                    with open('{0}/etc/sudoers.d/{1}'.format(self.system['chrootpath'], user), 'w') as f:
-                        f.write('# Generated by AIF-NG.\nDefaults:{0} !lecture\n{0} ALL=(ALL) ALL\n'.format(user))
-        # Base configuration- initcpio, etc.
-        chrootcmds.append(['mkinitcpio', '-p', 'linux'])
-        return(chrootcmds)
-    
+            profiles.append((ifacedev, iftype, netprofile))
+        return(profiles)
+
     def bootloader(self):
         # Bootloader configuration
         btldr = self.system['bootloader']['type']
@@ -746,21 +2522,25 @@ class archInstall(object):
         chrootpath = self.system['chrootpath']
         bttarget = self.system['bootloader']['target']
         if btldr == 'grub':
-            bootcmds.append(['pacman', '--needed', '--noconfirm', '-S', 'grub', 'efibootmgr'])
+            # grub and efibootmgr are installed along with everything else; see packageList().
             bootcmds.append(['grub-install'])
-            if self.system['bootloader']['efi']:
-                bootcmds[1].extend(['--target=x86_64-efi', '--efi-directory={0}'.format(bttarget), '--bootloader-id=Arch'])
+            # It's the attribute as given, so "false" would be true as-is.
+            if xmlbool(self.system['bootloader'].get('efi')):
+                bootcmds[0].extend(['--target=x86_64-efi', '--efi-directory={0}'.format(bttarget), '--bootloader-id=Arch'])
+                grubdir = bttarget
             else:
-                bootcmds[1].extend(['--target=i386-pc', bttarget])
-            bootcmds.append(['grub-mkconfig', '-o', '{0}/grub/grub.cfg'.format(bttarget)])
+                # The target's a disk here, so the config goes where grub-install puts everything else.
+                bootcmds[0].extend(['--target=i386-pc', bttarget])
+                grubdir = '/boot'
+            bootcmds.append(['grub-mkconfig', '-o', '{0}/grub/grub.cfg'.format(grubdir)])
         elif btldr == 'systemd':
             if self.system['bootloader']['target'] != '/boot':
-                shutil.copy2('{0}/boot/vmlinuz-linux'.format(chrootpath),
+                self.ex.copy('{0}/boot/vmlinuz-linux'.format(chrootpath),
                              '{0}/{1}/vmlinuz-linux'.format(chrootpath, bttarget))
-                shutil.copy2('{0}/boot/initramfs-linux.img'.format(chrootpath),
+                self.ex.copy('{0}/boot/initramfs-linux.img'.format(chrootpath),
                              '{0}/{1}/initramfs-linux.img'.format(chrootpath, bttarget))
-                with open('{0}/{1}/loader/loader.conf'.format(chrootpath, bttarget), 'w') as f:
-                    f.write('# Generated by AIF-NG.\ndefault arch\ntimeout 4\neditor 0\n')
+                self.ex.write('{0}/{1}/loader/loader.conf'.format(chrootpath, bttarget),
+                              '# Generated by AIF-NG.\ndefault arch\ntimeout 4\neditor 0\n')
                 # Gorram, I wish there was a better way to get the partition UUID in stdlib.
                 majmindev = os.lstat('{0}/{1}'.format(chrootpath, bttarget)).st_dev
                 majdev = os.major(majmindev)
@@ -774,43 +2554,47 @@ class archInstall(object):
                         break
                 if not partuuid:
                     exit('ERROR: Cannot determine PARTUUID for /dev/{0}.'.format(btdev))
-                with open('{0}/{1}/loader/entries/arch.conf'.format(chrootpath, bttarget)) as f:
-                    f.write(('# Generated by AIF-NG.\ntitle\t\tArch Linux\nlinux /vmlinuz-linux\n') +
-                            ('initrd /initramfs-linux.img\noptions root=PARTUUID={0} rw\n').format(partuuid))
+                self.ex.write('{0}/{1}/loader/entries/arch.conf'.format(chrootpath, bttarget),
+                              ('# Generated by AIF-NG.\ntitle\t\tArch Linux\nlinux /vmlinuz-linux\n') +
+                              ('initrd /initramfs-linux.img\noptions root=PARTUUID={0} rw\n').format(partuuid))
             bootcmds.append(['bootctl', '--path={0}', 'install'])
         # TODO: Add a bit here to alter EFI boot order so we boot right to the newly-installed env.
         # should probably be optional.
         return(bootcmds)
 
     def scriptcmds(self, scripttype):
+        # The scripts were already streamed to disk by aif.buildDict(). pkg and post scripts get copied into the
+        # new install by stageScripts() before we chroot, so the same paths work in there.
         t = scripttype
-        if t in self.scripts.keys():
-            for i, s in enumerate(self.scripts[t]):
-                dirpath = '/root/scripts/{0}'.format(t)
-                os.makedirs(dirpath, exist_ok = True)
-                filepath = '{0}/{1}'.format(dirpath, i)
-                with open(filepath, 'w') as f:
-                    f.write(s)
-                os.chmod(filepath, 0o700)
-                os.chown(filepath, 0, 0)  # shouldn't be necessary, but just in case the umask's messed up or something.
-        if t in ('pre', 'pkg'):
-            # We want to run these right away.
-            with open(logfile, 'a') as log:
-                for i, s in enumerate(self.scripts[t]):
-                    subprocess.call('/root/scripts/{0}/{1}'.format(t, i),
-                                    stdout = log,
-                                    stderr = subprocess.STDOUT)
+        if t in self.scripts.keys() and self.scripts[t]:
+            with open(logfile, 'a') as log, inPhase('{0}scripts'.format(t)):
+                for s in self.scripts[t]:
+                    self.ex.chmod(s, 0o700)
+                    self.ex.chown(s, 0, 0)  # shouldn't be necessary, but just in case the umask's messed up or something.
+                    self.ex.call([s], log)
+        return()
+
+    def stageScripts(self):
+        # This should be run outside the chroot.
+        for t in ('pkg', 'post'):
+            if t in self.scripts.keys() and self.scripts[t]:
+                for s in self.scripts[t]:
+                    dest = '{0}/{1}'.format(self.system['chrootpath'], s)
+                    self.ex.makedirs(os.path.dirname(dest))
+                    self.ex.copy(s, dest)
         return()
 
     def pacmanSetup(self):
         # This should be run outside the chroot.
         conf = '{0}/etc/pacman.conf'.format(self.system['chrootpath'])
-        with open(conf, 'r') as f:
-            confdata = f.readlines()
+        confdata = self.ex.read(conf).splitlines(keepends = True)
         # This... is not 100% sane, and we need to change it if the pacman.conf upstream changes order of the default repos.
         # Here be dragons; you have been warned. TODO.
-        idx = confdata.index('#[testing]\n')
-        shutil.copy2(conf, '{0}.arch'.format(conf))
+        if '#[testing]\n' in confdata:
+            idx = confdata.index('#[testing]\n')
+        else:
+            idx = len(confdata)
+        self.ex.copy(conf, '{0}.arch'.format(conf))
         newconf = confdata[:idx]
         newconf.append('# Modified by AIF-NG.\n')
         for r in self.software['repos']:
@@ -827,41 +2611,260 @@ class archInstall(object):
                 newentry = ["#" + i for i in newentry]
             newentry.append('\n')
             newconf.extend(newentry)
-        with open(conf, 'w') as f:
-            f.write(''.join(newconf))
+        self.ex.write(conf, ''.join(newconf))
         if self.software['mirrors']:
             mirrorlst = '{0}/etc/pacman.d/mirrorlist'.format(self.system['chrootpath'])
-            shutil.copy2(mirrorlst, '{0}.arch'.format(mirrorlst))
+            self.ex.copy(mirrorlst, '{0}.arch'.format(mirrorlst))
             # TODO: file vs. server?
-            with open(mirrorlst, 'w') as f:
-                for m in self.software['mirrors']:
-                    if m.startswith('file://'):
-                        mirror = 'Include = {0}'.format(re.sub('^file://', '', m))
-                    else:
-                        mirror = 'Server = {0}'.format(m)
-                    f.write('{0}\n'.format(mirror))
+            mirrors = []
+            for m in self.software['mirrors']:
+                if m.startswith('file://'):
+                    mirrors.append('Include = {0}\n'.format(re.sub('^file://', '', m)))
+                else:
+                    mirrors.append('Server = {0}\n'.format(m))
+            self.ex.write(mirrorlst, ''.join(mirrors))
         return()
 
+    def probeMirror(self, mirror, timeout):
+        # Times fetching the first mirrorsample bytes of mirror's core.db: how long until it answers, and how fast it
+        # sends. Returns the estimated seconds to fetch mirrorsample bytes, or None if it failed or took longer than
+        # timeout to answer.
+        uri = '{0}/core.db'.format(mirror.replace('$repo', 'core').replace('$arch', os.uname().machine).rstrip('/'))
+        req = urlrequest.Request(uri, headers = {'Range': 'bytes=0-{0}'.format(mirrorsample - 1)})
+        start = time.monotonic()
+        try:
+            with urlrequest.urlopen(req, timeout = timeout) as f:
+                answered = time.monotonic()
+                got = 0
+                # Servers that ignore the Range get cut off once we have enough (or run out of time).
+                while got < mirrorsample and time.monotonic() - answered < timeout:
+                    chunk = f.read(min(fetchchunk, mirrorsample - got))
+                    if not chunk:
+                        break
+                    got += len(chunk)
+        except (urlerror.URLError, httpclient.HTTPException, OSError) as e:
+            return(None, str(e))
+        done = time.monotonic()
+        if not got:
+            return(None, 'empty response')
+        rate = got / max(done - answered, 1e-6)
+        return((answered - start) + (mirrorsample / rate), '{0:.0f}ms to answer, {1:.1f} KiB/s'.format(
+                                                                 (answered - start) * 1000, rate / 1024))
+
+    def rankMirrors(self):
+        # Probes every configured mirror at once (see probeMirror()), and reorders software['mirrors'] fastest-first
+        # without the ones that didn't answer. file:// mirrors (Includes) can't be probed and stay at the top. The
+        # live environment's mirrorlist is replaced with the ranked one too, so pacstrap gets the benefit; the
+        # original is kept as mirrorlist.aif.
+        if not self.rankmirrors or not self.software['mirrors']:
+            return()
+        timeout = float(self.rankmirrors)
+        includes = [m for m in self.software['mirrors'] if m.startswith('file://')]
+        servers = [m for m in self.software['mirrors'] if not m.startswith('file://')]
+        if not servers:
+            return()
+        with ThreadPoolExecutor(max_workers = min(fetchthreads, len(servers))) as pool:
+            results = list(pool.map(lambda m: self.probeMirror(m, timeout), servers))
+        ranked = [m for t, i, m in sorted([(r[0], i, m) for i, (r, m) in enumerate(zip(results, servers))
+                                          if r[0] is not None])]
+        with open(logfile, 'a') as log:
+            for m, (t, detail) in zip(servers, results):
+                log.write('Mirror {0}: {1}\n'.format(m, detail if t is not None else 'dropped ({0})'.format(detail)))
+            if not ranked:
+                log.write('WARNING: no mirror answered; leaving the mirrorlist as it is.\n')
+                return()
+        self.software['mirrors'] = includes + ranked
+        hostlist = '/etc/pacman.d/mirrorlist'
+        if not os.path.isfile('{0}.aif'.format(hostlist)):
+            self.ex.copy(hostlist, '{0}.aif'.format(hostlist))
+        # The Includes are paths on the new system, so they're left out here.
+        self.ex.write(hostlist, '# Ranked by AIF-NG.\n' + ''.join(['Server = {0}\n'.format(m) for m in ranked]))
+        return()
+
+    def pkgCacheSetup(self):
+        # Points the target's /var/cache/pacman/pkg at the shared package cache (so pacstrap and the in-chroot
+        # pacman both use it) by bind-mounting it there. The cache can be a directory on the host (which may be
+        # NFS or anything else already mounted), a block device, or an NFS export (host:/path); the latter two
+        # are mounted on the host first. Should run after format() and before pacstrap.
+        if not self.pkgcache:
+            return()
+        mounts = self.mounts()
+        src = self.pkgcache
+        with open(logfile, 'a') as log:
+            if src.startswith('/dev/') or re.match('^[^/]+:/', src):
+                src = pkgcachemnt
+                if mounts['pkgcachesrc']:
+                    self.ex.makedirs(pkgcachemnt)
+                    if self.ex.call(mounts['pkgcachesrc'], log) != 0:
+                        log.write('WARNING: could not mount package cache {0}; not using it.\n'.format(self.pkgcache))
+                        self.pkgcache = False
+                        return()
+            self.ex.makedirs(src)
+            # Partial downloads left by an install that was interrupted can't be trusted.
+            self.pkgCachePrune(src, 0)
+            if mounts['pkgcache']:
+                self.ex.makedirs(mounts['pkgcache'][-1])
+                self.ex.call(mounts['pkgcache'], log)
+        self.pkgcachedir = src
+        return()
+
+    def pkgCachePrune(self, cachedir = False, maxsize = False):
+        # Removes partial downloads, then the least recently used packages (and their signatures) until the cache
+        # is no bigger than maxsize bytes (if given). Packages themselves are verified against their repo's
+        # signatures by pacman each time they're used, so nothing else needs checking.
+        if not cachedir:
+            cachedir = getattr(self, 'pkgcachedir', False)
+        if maxsize is False:
+            maxsize = self.pkgcachesize
+        if not cachedir or not os.path.isdir(cachedir):
+            return()
+        pkgs = []
+        total = 0
+        removed = 0
+        for f in os.listdir(cachedir):
+            path = os.path.join(cachedir, f)
+            if not os.path.isfile(path):
+                continue
+            if f.endswith('.part'):
+                # Another install sharing the cache may still be downloading it; only stale ones go.
+                if time.time() - os.path.getmtime(path) > 3600:
+                    self.ex.remove(path)
+                continue
+            if '.pkg.tar' in f and not f.endswith('.sig'):
+                st = os.stat(path)
+                size = st.st_size
+                if os.path.isfile(path + '.sig'):
+                    size += os.path.getsize(path + '.sig')
+                pkgs.append((max(st.st_atime, st.st_mtime), size, path))
+                total += size
+        if maxsize:
+            pkgs.sort()
+            for used, size, path in pkgs:
+                if total <= maxsize:
+                    break
+                for p in (path, path + '.sig'):
+                    if os.path.isfile(p):
+                        self.ex.remove(p)
+                total -= size
+                removed += 1
+            with open(logfile, 'a') as log:
+                log.write('Package cache {0}: {1} package(s) pruned, {2} left ({3:.1f} MiB).\n'.format(
+                              cachedir, removed, len(pkgs) - removed, total / 1048576))
+        return()
+
+    def packageList(self, warn = False):
+        # Every package to install, deduplicated, as (name, repo) in the order they were given. A name may carry its
+        # own repo ("core/foo"); a repo given either way wins over none. The bootloader's packages are included so
+        # everything goes in one transaction.
+        pkgs = {}
+        wanted = []
+        if self.software['packages']:
+            wanted.extend([(p, self.software['packages'][p]['repo']) for p in self.software['packages'].keys()])
+        if self.system['bootloader'].get('type') == 'grub':
+            wanted.extend([('grub', None), ('efibootmgr', None)])
+        for name, repo in wanted:
+            if '/' in name:
+                repo, name = name.split('/', 1)
+            if name not in pkgs.keys():
+                pkgs[name] = repo
+            elif repo and not pkgs[name]:
+                pkgs[name] = repo
+            elif repo and repo != pkgs[name] and warn:
+                with open(logfile, 'a') as log:
+                    log.write('WARNING: package {0} was asked for from both {1} and {2}; using {1}.\n'.format(name,
+                                                                                                       pkgs[name],
+                                                                                                       repo))
+        return(list(pkgs.items()))
+
+    def rootless(self):
+        # Whether the packages can be installed into the new system from the host (with pacman --sysroot) instead of from
+        # inside the chroot. Not if another package utility is doing it, or if there are pkg scripts (which are
+        # there to set up the new system for installing packages, from the inside).
+        return(not self.software['command'] and not self.scripts.get('pkg'))
+
+    def pacmanArgs(self):
+        # The options that point the host's pacman at the new system. With --sysroot, pacman chroots into it before
+        # reading anything, so it uses the new system's pacman.conf (see pacmanSetup()), DB, cache, keyring, hooks and
+        # log as they are (--root is documented as unsuitable for a mounted guest). Scriptlets and hooks run in there
+        # too, so the chroot mounts need to be in place.
+        return(['--sysroot', self.system['chrootpath']])
+
     def packagecmds(self):
+        # Run in the chroot, apart from the transaction itself if it can be done from the host (see rootless() and
+        # packageInstall()).
+        # Everything is installed in a single transaction, so the sync DBs are read (and hooks run) once. The
+        # initramfs is rebuilt exactly once, afterwards: the mkinitcpio hook is masked during the transaction.
         pkgcmds = []
-        # This should be run in the chroot, unless we find a way to pacstrap
-        # packages separate from chrooting
-        if self.software['command']:
-            pkgr = shlex.split(self.software['command'])
-        else:
-            pkgr = ['pacman', '--needed', '--noconfirm', '-S']
-        if self.software['packages']:
-            for p in self.software['packages'].keys():
-                if self.software['packages'][p]['repo']:
-                    pkgname = '{0}/{1}'.format(self.software['packages'][p]['repo'], p)
-                else:
-                    pkgname = p
-                pkgr.append(pkgname)
-                pkgcmds.append(pkgr)
+        hook = '/etc/pacman.d/hooks/90-mkinitcpio-install.hook'
+        pkgs = self.packageList(warn = True)
+        if pkgs and not self.rootless():
+            if self.software['command']:
+                pkgr = shlex.split(self.software['command'])
+            else:
+                # The sync DBs are refreshed first (see inChroot()), so -u brings everything already installed (e.g.
+                # from a restored rootfs image) up to the same snapshot; -y without -u would be a partial upgrade.
+                pkgr = ['pacman', '--needed', '--noconfirm', '-Su']
+            pkgr.extend([('{0}/{1}'.format(repo, name) if repo else name) for name, repo in pkgs])
+            pkgcmds.append(['mkdir', '-p', os.path.dirname(hook)])
+            pkgcmds.append(['ln', '-sf', '/dev/null', hook])
+            pkgcmds.append(pkgr)
+            pkgcmds.append(['rm', '-f', hook])
+        # Base configuration- initcpio, etc.
+        pkgcmds.append(['mkinitcpio', '-p', 'linux'])
         return(pkgcmds)
 
+    def packageInstall(self):
+        # The transaction from packagecmds(), done from the host so it needn't wait for (or hold up) everything else
+        # in the chroot. Needs pacmanSetup() and chrootMounts() done first.
+        if not self.rootless():
+            return()
+        pkgs = self.packageList()
+        if not pkgs:
+            return()
+        args = self.pacmanArgs()
+        hook = '{0}/etc/pacman.d/hooks/90-mkinitcpio-install.hook'.format(self.system['chrootpath'])
+        self.ex.makedirs(os.path.dirname(hook))
+        if os.path.lexists(hook):
+            self.ex.remove(hook)
+        self.ex.symlink('/dev/null', hook)
+        try:
+            # As in the chroot (see packagecmds()): sync, then summarize and upgrade from the same DBs.
+            with open(logfile, 'a') as log:
+                ret = self.ex.call(['pacman'] + args + ['-Sy'], log)
+            if ret == 0:
+                self.packageSummary(args)
+                with open(logfile, 'a') as log:
+                    ret = self.ex.call(['pacman'] + args + ['--needed', '--noconfirm', '-Su'] +
+                                          [('{0}/{1}'.format(repo, name) if repo else name) for name, repo in pkgs], log)
+        finally:
+            self.ex.remove(hook)
+        if ret != 0:
+            raise RuntimeError('pacman exited with {0}'.format(ret))
+        return()
+
+    def packageSummary(self, pacmanargs = False):
+        # Logs how many packages the transaction will install (dependencies included) and how much it will download.
+        # Run in the chroot after the sync DBs are refreshed, or from the host with pacmanargs from pacmanArgs().
+        pkgs = self.packageList()
+        if not pkgs:
+            return()
+        names = [('{0}/{1}'.format(repo, name) if repo else name) for name, repo in pkgs]
+        with open(logfile, 'a') as log:
+            try:
+                out = self.ex.output(['pacman'] + (pacmanargs or []) + ['-Sp', '--needed', '--print-format', '%n %s'] + names,
+                                        log, subprocess.DEVNULL).decode('utf-8').splitlines()
+                sizes = [int(l.split()[1]) for l in out if len(l.split()) == 2 and l.split()[1].isdigit()]
+                log.write('Installing {0} package(s) ({1} requested) in one transaction, {2:.1f} MiB to download.\n'.format(
+                              len(sizes), len(names), sum(sizes) / 1048576))
+            except (subprocess.CalledProcessError, OSError):
+                # e.g. an AUR helper is doing the installing and pacman doesn't know about some of them.
+                log.write('Installing {0} requested package(s) in one transaction.\n'.format(len(names)))
+        return()
+
     def serviceSetup(self):
         # this runs inside the chroot
+        if not self.system['services']:
+            return()
         for s in self.system['services'].keys():
             if not re.match('\.(service|socket|target|timer)$', s):  # i don't bother with .path, .busname, etc.- i might in the future? TODO.
                 svcname = '{0}.service'.format(s)
@@ -869,77 +2872,216 @@ class archInstall(object):
             sysdunit = '/etc/systemd/system/multi-user.target.wants/{0}'.format(svcname)
             if self.system['services'][s]:
                 if not os.path.lexists(sysdunit):
-                    os.symlink(service, sysdunit)
+                    self.ex.symlink(service, sysdunit)
             else:
                 if os.path.lexists(sysdunit):
-                    os.remove(sysdunit)
-        return()
-
-    def chroot(self, chrootcmds = False, bootcmds = False, scriptcmds = False, pkgcmds = False):
-        if not chrootcmds:
-            chrootcmds = self.setup()
-        if not bootcmds:
-            bootcmds = self.bootloader()
-        if not scriptcmds:
-            scripts = self.scripts
-        if not pkgcmds:
-            pkgcmds = self.packagecmds()
-        # Switch in the log, and link.
-        os.rename(logfile, '{0}/{1}'.format(self.system['chrootpath'], logfile))
-        os.symlink('{0}/{1}'.format(self.system['chrootpath'], logfile), logfile)
-        self.pacmanSetup()  # This needs to be done before the chroot
+                    self.ex.remove(sysdunit)
+        return()
+
+    def moveLog(self):
+        # Switch in the log, and link. Nothing else may have the log open while this runs (see installGraph()); the
+        # link is made under another name and renamed into place so the log's path is never a plain file again.
+        dest = '{0}/{1}'.format(self.system['chrootpath'], logfile)
+        tmplink = '{0}.aif-link'.format(logfile)
+        self.ex.rename(logfile, dest)
+        self.ex.symlink(dest, tmplink)
+        self.ex.rename(tmplink, logfile)
+        return()
+
+    def inChroot(self, chrootcmds, bootcmds, pkgcmds):
+        # Everything that runs inside the new install. os.chroot() changes the root of the whole process, so
+        # nothing else may be running while we're in here.
         # We don't need this currently, but we might down the road.
         #chrootscript = '#!/bin/bash\n# https://aif.square-r00t.net/\n\n'
         #with open('{0}/root/aif.sh'.format(self.system['chrootpath']), 'w') as f:
         #    f.write(chrootscript)
         #os.chmod('{0}/root/aif.sh'.format(self.system['chrootpath']), 0o700)
-        real_root = os.open("/", os.O_RDONLY)
-        os.chroot(self.system['chrootpath'])
-        # Does this even work with an os.chroot()? Let's hope so!
-        with open(logfile, 'a') as log:
-            for c in chrootcmds:
-                subprocess.call(c, stdout = log, stderr = subprocess.STDOUT)
-            if scripts['pkg']:
-                self.scriptcmds('pkg')
-                for i, s in enumerate(scripts['pkg']):
-                    subprocess.call('/root/scripts/pkg/{0}'.format(i),
-                                    stdout = log,
-                                    stderr = subprocess.STDOUT)
-            for p in pkgcmds:
-                subprocess.call(p, stdout = log, stderr = subprocess.STDOUT)
-            for b in bootcmds:
-                subprocess.call(b, stdout = log, stderr = subprocess.STDOUT)
-            if scripts['post']:
-                self.scriptcmds('post')
-                for i, s in enumerate(scripts['post']):
-                    subprocess.call('/root/scripts/post/{0}'.format(i),
-                                    stdout = log,
-                                    stderr = subprocess.STDOUT)
-            self.serviceSetup()
-        #os.system('{0}/root/aif-pre.sh'.format(self.system['chrootpath']))
-        #os.system('{0}/root/aif-post.sh'.format(self.system['chrootpath']))
-        os.fchdir(real_root)
-        os.chroot('.')
-        os.close(real_root)
+        real_root = self.ex.chroot(self.system['chrootpath'])
+        try:
+            # Does this even work with an os.chroot()? Let's hope so!
+            with open(logfile, 'a') as log:
+                def configure():
+                    with inPhase('configure'):
+                        for c in chrootcmds:
+                            self.ex.call(c, log)
+                def packages():
+                    with inPhase('packages'):
+                        if not self.rootless() and self.packageList():
+                            # Its own step, so the summary comes from the same DBs the transaction uses.
+                            self.ex.call(['pacman', '-Sy'], log)
+                            self.packageSummary()
+                        log.flush()
+                        for p in pkgcmds:
+                            self.ex.call(p, log)
+                def bootloader():
+                    with inPhase('bootloader'):
+                        for b in bootcmds:
+                            self.ex.call(b, log)
+                # Each of these is journalled (see resumeGraph()) if it ran without any command failing; once one
+                # has to run, so does everything after it.
+                steps = [('configure', chrootcmds, configure),
+                         ('pkgscripts', self.scriptDigest('pkg'), lambda: self.scriptcmds('pkg')),
+                         ('packages', pkgcmds, packages),
+                         ('bootloader', bootcmds, bootloader),
+                         ('postscripts', self.scriptDigest('post'), lambda: self.scriptcmds('post')),
+                         ('services', self.system['services'], self.serviceSetup)]
+                rerun = False
+                for name, inputs, func in steps:
+                    name = 'chroot.{0}'.format(name)
+                    digest = installJournal.digest(inputs)
+                    if self.journal and not rerun and self.journal.done(name, digest)[0]:
+                        log.write('Resuming: {0} already done.\n'.format(name))
+                        continue
+                    rerun = True
+                    mark = len(self.ex.commands)
+                    func()
+                    if self.journal and not [c for c in self.ex.commands[mark:] if c['status'] != 0]:
+                        self.journal.record(name, digest)
+            #os.system('{0}/root/aif-pre.sh'.format(self.system['chrootpath']))
+            #os.system('{0}/root/aif-post.sh'.format(self.system['chrootpath']))
+        finally:
+            self.ex.unchroot(real_root)
         if not os.path.isfile('{0}/sbin/init'.format(self.system['chrootpath'])):
-            os.symlink('../lib/systemd/systemd', '{0}/sbin/init'.format(self.system['chrootpath']))
+            self.ex.symlink('../lib/systemd/systemd', '{0}/sbin/init'.format(self.system['chrootpath']))
         return()
-    
+
+    def installGraph(self):
+        # The install as a graph of tasks, so the ones that don't depend on each other can overlap. Resources keep
+        # tasks that would trample each other apart; see taskGraph.
+        graph = taskGraph(self.jobs, {'network': 2})
+        graph.add('prescripts', lambda: self.scriptcmds('pre'))
+        graph.add('timesync', self.timeSync, ['prescripts'], ['network'])
+        graph.add('keyring', self.keyring, ['timesync'])
+        graph.add('hostinfo', self.hostInfo, ['prescripts'])
+        graph.add('format', self.format, ['prescripts'], ['disk'])
+        graph.add('pkgcache', self.pkgCacheSetup, ['format'], ['network'])
+        graph.add('rankmirrors', self.rankMirrors, ['timesync'], ['network'])
+        graph.add('pacstrap', self.pacstrap, ['format', 'keyring', 'pkgcache', 'rankmirrors'], ['disk', 'network'])
+        # Everything after pacstrap that writes to the log waits for it to be moved into the new install.
+        graph.add('movelog', self.moveLog, ['pacstrap', 'hostinfo', 'packages'])
+        graph.add('fstab', self.fstab, ['pacstrap', 'movelog'])
+        graph.add('chrootmounts', self.chrootMounts, ['pacstrap', 'movelog'])
+        graph.add('configure', self.configure, ['pacstrap', 'hostinfo', 'movelog'])
+        graph.add('pacmanconf', self.pacmanSetup, ['pacstrap', 'movelog'])
+        graph.add('stagescripts', self.stageScripts, ['pacstrap', 'movelog'])
+        graph.add('bootloader', self.bootloader, ['pacstrap', 'fstab', 'movelog'])
+        graph.add('packages', self.packagecmds)
+        # After configure, which rewrites files (/etc/shadow, /etc/hosts, etc.) that package scriptlets and hooks edit.
+        graph.add('pkginstall', self.packageInstall, ['pacmanconf', 'chrootmounts', 'movelog', 'configure'], ['network'])
+        graph.add('chroot',
+                  lambda: self.inChroot(graph.result('configure'), graph.result('bootloader'), graph.result('packages')),
+                  ['configure', 'pacmanconf', 'stagescripts', 'bootloader', 'packages', 'chrootmounts', 'fstab',
+                   'movelog', 'pkginstall'],
+                  ['chroot'])
+        graph.add('pkgcacheprune', self.pkgCachePrune, ['chroot'], ['disk'])
+        self.resumeGraph(graph)
+        return(graph)
+
+    def scriptDigest(self, t):
+        # What the t scripts are, by content.
+        digests = []
+        if t in self.scripts.keys() and self.scripts[t]:
+            for path in self.scripts[t]:
+                with open(path, 'rb') as f:
+                    digests.append(hashlib.sha256(f.read()).hexdigest())
+        return(digests)
+
+    def stepInputs(self):
+        # The steps that leave something behind on the disks (or have run scripts), and what each depends on from the
+        # config. The rest (mounting, syncing the clock, etc.) are always run again.
+        return({'prescripts': self.scriptDigest('pre'),
+                'format': [self.disk, self.mount],
+                'pacstrap': basepkgs,
+                'fstab': self.mount,
+                'configure': [self.system, self.network, self.users],
+                'pacmanconf': [self.software['repos'], self.software['mirrors']],
+                'stagescripts': [self.scriptDigest('pkg'), self.scriptDigest('post')],
+                'bootloader': self.system['bootloader'],
+                'pkginstall': [self.software['command'], self.software['packages'], self.system['bootloader']]})
+
+    def resumeGraph(self, graph):
+        # Has each step in stepInputs() record itself in the journal when it finishes. When resuming, a step that
+        # already finished with the same inputs is skipped (with the result it had last time), unless something it
+        # depends on has to run again. A skipped format still mounts everything. Steps inside the chroot are
+        # journalled by inChroot(). Dry runs don't keep one.
+        if not self.ex.live:
+            return()
+        rootdev = False
+        for m in self.mount.values():
+            if m['mountpt'] == self.system['chrootpath']:
+                rootdev = m['device']
+        self.journal = installJournal(self.system['chrootpath'], rootdev)
+        if not (self.resume and self.journal.load()):
+            self.journal.forget(list(graph.tasks.keys()))
+        inputs = self.stepInputs()
+        rerun = {}
+        with open(logfile, 'a') as log:
+            for name in graph.toposort():
+                task = graph.tasks[name]
+                rerun[name] = any([rerun[d] for d in task['deps']])
+                if name not in inputs.keys():
+                    continue
+                digest = self.journal.digest(inputs[name])
+                done, result = self.journal.done(name, digest)
+                if done and not rerun[name]:
+                    log.write('Resuming: {0} already done.\n'.format(name))
+                    task['func'] = (self.remount if name == 'format' else (lambda r = result: r))
+                    continue
+                rerun[name] = True
+                task['func'] = self.journalled(name, digest, task['func'])
+        if rerun['chroot']:
+            self.journal.forget(['chroot'])
+        return()
+
+    def remount(self):
+        # In place of a format that's already done.
+        self.mountAll()
+        self.journal.save()  # Now that the new install's root is mounted, the journal can go back on it.
+        return()
+
+    def journalled(self, name, digest, func):
+        def inner():
+            result = func()
+            self.journal.record(name, digest, result)
+            return(result)
+        return(inner)
+
     def unmount(self):
         with open(logfile, 'a') as log:
-            subprocess.call(['umount', '-lR', self.system['chrootpath']], stdout = log, stderr = subprocess.STDOUT)
+            # This gets the chroot mounts and the package cache's bind mount too.
+            self.ex.call(['umount', '-lR', self.system['chrootpath']], log)
+            if getattr(self, 'pkgcachedir', False) == pkgcachemnt:
+                self.ex.call(['umount', '-l', pkgcachemnt], log)
         # We should also remove the (now dead) log symlink.
         #Note that this does NOT delete the logfile on the installed system.
-        os.remove(logfile)
+        self.ex.remove(logfile)
         return()
                 
-def runInstall(confdict):
-    install = archInstall(confdict)
-    install.scriptcmds('pre')
-    install.format()
-    install.chroot()
+def runInstall(confdict, session = False, args = False):
+    install = archInstall(confdict, session, args)
+    if args:
+        events.configure(args.get('aif_events'))
+    events.emit('install-start', hostname = confdict['network']['hostname'])
+    graph = install.installGraph()
+    failed = graph.run()
+    events.emit('install-end', success = not failed, failed = [n for n, e in failed])
+    events.close()
+    with open(logfile, 'a') as log:
+        log.write(graph.report())
+        # After moveLog(), the log (and so the report) is in the new install.
+        report = install.ex.report(failed)
+        dest = '{0}.json'.format(os.path.realpath(logfile))
+        install.ex.writeReport(dest, report)
+        log.write('Wrote the command report to {0}.\n'.format(dest))
+        if install.promfile and install.ex.live:
+            install.ex.writeProm(install.promfile, report)
+            log.write('Wrote the Prometheus metrics to {0}.\n'.format(install.promfile))
+    if failed:
+        install.ex.close()
+        exit('The install failed:\n\t{0}'.format('\n\t'.join(['{0}: {1}'.format(n, e) for n, e in failed])))
     install.unmount()
-    return()
+    install.ex.close()
+    return(install)
 
 def main():
     if os.getuid() != 0:
@@ -950,8 +3092,9 @@ def main():
         import pprint
         with open(logfile, 'a') as log:
             pprint.pprint(instconf, stream = log)
-    runInstall(instconf)
-    if instconf['system']['reboot']:
+    install = runInstall(instconf, conf.session, conf.args)
+    conf.session.close()
+    if instconf['system']['reboot'] and install.ex.live:
         subprocess.run(['reboot'])
 
 if __name__ == "__main__":
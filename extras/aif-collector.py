@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# A reference collector for the AIF-NG client's progress events (the aif_events kernel parameter). It takes
+# events over HTTP (POSTed batches) and UDP (plain JSON or syslog), keeps track of where each host's install is
+# at, and shows that over HTTP: GET / for a table, GET /hosts for JSON.
+#
+# e.g.:
+#   ./aif-collector.py -l 0.0.0.0 -p 8123 -u 8124
+# and boot the clients with one of:
+#   aif_events=http://collector.domain.tld:8123/events
+#   aif_events=udp://collector.domain.tld:8124
+#   aif_events=syslog://collector.domain.tld:8124
+
+import argparse
+import datetime
+import http.server
+import json
+import socketserver
+import threading
+import time
+
+class progress(object):
+    def __init__(self, stuck = 600):
+        self.stuck = stuck
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def add(self, host, install, evt):
+        # Events can arrive out of order (UDP, or batches from retried POSTs), so they're applied by seq.
+        with self.lock:
+            if host not in self.hosts.keys() or self.hosts[host]['install'] != install:
+                self.hosts[host] = {'install': install, 'hostname': None, 'started': None, 'finished': None,
+                                    'success': None, 'phases': {}, 'done': [], 'lastcmd': None, 'failedcmds': 0,
+                                    'events': 0, 'lastseq': 0, 'lastseen': None}
+            h = self.hosts[host]
+            h['events'] += 1
+            h['lastseen'] = time.time()
+            h['lastseq'] = max(h['lastseq'], evt.get('seq', 0))
+            etype = evt.get('type')
+            if etype == 'install-start':
+                h['started'] = evt.get('ts')
+                h['hostname'] = evt.get('hostname')
+            elif etype == 'install-end':
+                h['finished'] = evt.get('ts')
+                h['success'] = evt.get('success')
+                h['phases'] = {}
+            elif etype == 'phase-start':
+                h['phases'][evt.get('phase')] = evt.get('ts')
+            elif etype == 'phase-end':
+                h['phases'].pop(evt.get('phase'), None)
+                h['done'].append({'phase': evt.get('phase'), 'seconds': evt.get('seconds'), 'error': evt.get('error')})
+            elif etype == 'command-exit':
+                h['lastcmd'] = {'cmd': ' '.join(evt.get('cmd', [])), 'status': evt.get('status'),
+                                'seconds': evt.get('seconds'), 'ts': evt.get('ts')}
+                if evt.get('status'):
+                    h['failedcmds'] += 1
+        return()
+
+    def state(self, h):
+        if h['finished']:
+            return('done' if h['success'] else 'FAILED')
+        if h['lastseen'] and time.time() - h['lastseen'] > self.stuck:
+            return('STUCK?')
+        return('running')
+
+    def summary(self):
+        with self.lock:
+            out = {}
+            for host, h in self.hosts.items():
+                out[host] = dict(h, state = self.state(h), done = len(h['done']),
+                                 errors = [d for d in h['done'] if d['error']])
+            return(out)
+
+    def table(self):
+        lines = ['{0:<24} {1:<8} {2:>8} {3:<32} {4}'.format('HOST', 'STATE', 'ELAPSED', 'IN', 'LAST COMMAND')]
+        for host, h in sorted(self.summary().items()):
+            elapsed = ''
+            if h['started']:
+                elapsed = '{0:.0f}s'.format((h['finished'] or time.time()) - h['started'])
+            current = ', '.join(sorted(h['phases'].keys(), key = lambda p: h['phases'][p]))
+            last = ''
+            if h['lastcmd']:
+                last = '{0} (exit {1})'.format(h['lastcmd']['cmd'][:60], h['lastcmd']['status'])
+            lines.append('{0:<24} {1:<8} {2:>8} {3:<32} {4}'.format(h['hostname'] or host, h['state'], elapsed,
+                                                                   current[:32], last))
+        return('\n'.join(lines) + '\n')
+
+def parseDatagram(data, addr):
+    # A bare JSON event, or a syslog message with one as its message.
+    text = data.decode('utf-8', 'replace').strip()
+    if text.startswith('<'):
+        text = text[text.find('{'):]
+    evt = json.loads(text)
+    return(evt.get('host', addr[0]), evt.get('install'), evt)
+
+def httpHandler(prog):
+    class handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code, body, ctype = 'text/plain'):
+            body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            try:
+                batch = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                for evt in batch['events']:
+                    prog.add(batch['host'], batch.get('install'), evt)
+            except (ValueError, KeyError, TypeError) as e:
+                return(self.reply(400, 'Bad batch: {0}\n'.format(e)))
+            self.reply(204, '')
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/hosts':
+                return(self.reply(200, json.dumps(prog.summary(), indent = 2), 'application/json'))
+            self.reply(200, prog.table())
+
+        def log_message(self, fmt, *args):
+            pass
+    return(handler)
+
+def udpHandler(prog):
+    class handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                prog.add(*parseDatagram(self.request[0], self.client_address))
+            except (ValueError, AttributeError):
+                pass
+    return(handler)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Collect progress events from AIF-NG clients.')
+    args.add_argument('-l',
+                      '--listen',
+                      dest = 'listen',
+                      default = '0.0.0.0',
+                      help = 'The address to listen on. The default is %(default)s.')
+    args.add_argument('-p',
+                      '--port',
+                      dest = 'port',
+                      type = int,
+                      default = 8123,
+                      help = 'The HTTP port (for POSTed events and the status page). The default is %(default)s.')
+    args.add_argument('-u',
+                      '--udp-port',
+                      dest = 'udpport',
+                      type = int,
+                      default = 8124,
+                      help = 'The UDP port (for udp:// and syslog:// events). 0 disables it. The default is %(default)s.')
+    args.add_argument('-s',
+                      '--stuck',
+                      dest = 'stuck',
+                      type = int,
+                      default = 600,
+                      help = ('How many seconds a host can go without sending anything before it\'s marked as ' +
+                              'possibly stuck. The default is %(default)s.'))
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    prog = progress(args['stuck'])
+    if args['udpport']:
+        udp = socketserver.ThreadingUDPServer((args['listen'], args['udpport']), udpHandler(prog))
+        threading.Thread(target = udp.serve_forever, daemon = True).start()
+    web = http.server.ThreadingHTTPServer((args['listen'], args['port']), httpHandler(prog))
+    print('{0}: listening on {1} (HTTP {2}, UDP {3})'.format(datetime.datetime.now().isoformat(timespec = 'seconds'),
+                                                             args['listen'], args['port'], args['udpport'] or 'off'))
+    try:
+        web.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Times (and measures the peak memory of) the pure-python parts of the client -- parsing the config and
+# planning the install -- against synthetic configs of increasing size. Nothing is installed, partitioned
+# or mounted; everything is fetched from file:// URIs in a scratch directory.
+#
+# e.g.:
+#   ./benchmark.py                       # 10, 100, 1000 and 10000 of everything
+#   ./benchmark.py -s 10 -s 500 -r 5     # best of 5 runs at 10 and 500
+#   ./benchmark.py -j > baseline.json    # machine-readable, for comparing runs
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+clientpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aifclient.py')
+
+def loadClient():
+    spec = importlib.util.spec_from_file_location('aifclient', clientpath)
+    aifclient = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aifclient)
+    return(aifclient)
+
+def genXML(n, parts, scriptfile):
+    # n of each of: disks, users, packages, interfaces and scripts. Each disk gets parts partitions.
+    xml = ['<?xml version="1.0" encoding="UTF-8" ?>',
+           '<aif xmlns:aif="https://aif.square-r00t.net" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+           '<storage>']
+    fstypes = ('ef00', '8300', '8200', '8302')
+    for d in range(n):
+        xml.append('<disk device="/dev/vd{0}" diskfmt="gpt">'.format(d))
+        step = 100 // parts
+        for p in range(parts):
+            xml.append('<part num="{0}" start="{1}%" stop="{2}%" fstype="{3}" />'.format(p + 1, p * step,
+                                                                                        (p + 1) * step,
+                                                                                        fstypes[p % len(fstypes)]))
+        xml.append('</disk>')
+        xml.append('<mount source="/dev/vd{0}2" target="/mnt/aif/srv/{0}" order="{1}" />'.format(d, d + 1))
+    xml.append('</storage>')
+    xml.append('<network hostname="bench.example.com">')
+    for i in range(n):
+        xml.append(('<iface device="eth{0}" address="10.{1}.{2}.1/24" netproto="ipv4" gateway="10.{1}.{2}.254" ' +
+                    'resolvers="10.{1}.{2}.53,10.{1}.{2}.54" />').format(i, i // 256, i % 256))
+    xml.append('</network>')
+    xml.append('<system timezone="UTC" locale="en_US.UTF-8" chrootpath="/mnt/aif" reboot="0">')
+    xml.append('<users rootpass="!">')
+    for i in range(n):
+        xml.append(('<user name="user{0}" sudo="false" uid="{1}" comment="Benchmark user {0}">' +
+                    '<home path="/home/user{0}" create="true" /><xgroup name="grp{0}" create="true" />' +
+                    '<xgroup name="users" /></user>').format(i, 2000 + i))
+    xml.append('</users>')
+    xml.append('<service name="sshd" status="1" />')
+    xml.append('</system>')
+    xml.append('<pacman><repos>')
+    xml.append('<repo name="core" enabled="true" siglevel="default" mirror="file:///etc/pacman.d/mirrorlist" />')
+    xml.append('</repos><mirrorlist><mirror>http://mirror.example.com/$repo/os/$arch</mirror></mirrorlist><software>')
+    for i in range(n):
+        xml.append('<package name="pkg{0}" repo="{1}" />'.format(i, ('core' if i % 2 else '')))
+    xml.append('</software></pacman>')
+    xml.append('<bootloader type="grub" target="/boot" efi="true" />')
+    xml.append('<scripts>')
+    for i in range(n):
+        xml.append('<script uri="file://{0}" order="{1}" execution="{2}" />'.format(scriptfile, i,
+                                                                                   ('pre', 'post', 'pkg')[i % 3]))
+    xml.append('</scripts>')
+    xml.append('</aif>')
+    return('\n'.join(xml))
+
+def genProcMounts(n):
+    # Enough of the host's /proc/mounts for mounts() to chew on.
+    lines = ['proc /proc proc rw 0 0', 'sys /sys sysfs rw 0 0', 'dev /dev devtmpfs rw 0 0',
+             'run /run tmpfs rw 0 0', 'tmpfs /tmp tmpfs rw 0 0', 'shm /dev/shm tmpfs rw 0 0']
+    for i in range(n):
+        lines.append('/dev/vd{0}2 /mnt/aif/srv/{0} ext4 rw,relatime 0 0'.format(i))
+    return('\n'.join(lines) + '\n')
+
+def stages(aifclient, cfgpath, procmounts):
+    # Returns a list of (name, prep, func) to be run in order. prep (untimed) gets the latest parsing stage's
+    # result and returns func's argument. The parsing stages' results are handed on; the planning stages all
+    # work from buildDict's.
+    client = aifclient.aif()
+    disksize = {'start': b'2048\n', 'max': b'1953525134\n'}
+    def passthru(prev):
+        return(prev)
+    def installer(prev):
+        # A fresh archInstall (and copy of the config) each time, since planning fills in the sector math in place.
+        return(aifclient.archInstall(json.loads(json.dumps(prev)), session = client.session))
+    def fetch(prev):
+        return(client.getConfig(client.kernelargs('aif aif_url=file://{0} aif_retries=0'.format(cfgpath))))
+    def model(xmlobj):
+        client.buildModel(xmlobj)
+        return(xmlobj)
+    def fmt(inst):
+        for d in inst.disk:
+            inst.partPlan(d, disksize)
+    return([('fetch', passthru, fetch),
+            ('parse', passthru, client.getXML),
+            ('buildModel', passthru, model),
+            ('buildDict', passthru, client.buildDict),
+            ('format', installer, fmt),
+            ('packagecmds', installer, lambda inst: inst.packagecmds()),
+            ('mounts', installer, lambda inst: inst.mounts(procmounts)),
+            ('netprofiles', installer, lambda inst: inst.netProfiles())])
+
+def runStages(stagelist, begin, end):
+    # Yields (name, end(begin())) around each stage's func.
+    prev = None
+    for name, prep, func in stagelist:
+        arg = prep(prev)
+        token = begin()
+        out = func(arg)
+        yield((name, end(token)))
+        if name in ('fetch', 'parse', 'buildModel', 'buildDict'):
+            prev = out
+
+def bench(aifclient, n, parts, repeat):
+    tmpdir = tempfile.mkdtemp(prefix = '.aifbench.')
+    try:
+        # Keep the client's side effects (logs, fetched scripts) in the scratch dir.
+        aifclient.logfile = os.path.join(tmpdir, 'aif.log')
+        aifclient.scriptdir = os.path.join(tmpdir, 'scripts')
+        scriptfile = os.path.join(tmpdir, 'script.sh')
+        with open(scriptfile, 'w') as f:
+            f.write('#!/bin/sh\ntrue\n')
+        cfgpath = os.path.join(tmpdir, 'aif.xml')
+        with open(cfgpath, 'w') as f:
+            f.write(genXML(n, parts, scriptfile))
+        procmounts = genProcMounts(n)
+        results = {}
+        # Timing runs; we keep the best.
+        for r in range(repeat):
+            for name, elapsed in runStages(stages(aifclient, cfgpath, procmounts),
+                                           time.perf_counter, lambda start: time.perf_counter() - start):
+                if name not in results or elapsed < results[name]['seconds']:
+                    results[name] = {'seconds': elapsed}
+        # One more under tracemalloc (which slows things down a lot) for the peak memory of each stage,
+        # over and above what was already allocated going in.
+        def memstart():
+            tracemalloc.reset_peak()
+            return(tracemalloc.get_traced_memory()[0])
+        tracemalloc.start()
+        for name, peakbytes in runStages(stages(aifclient, cfgpath, procmounts),
+                                         memstart, lambda base: tracemalloc.get_traced_memory()[1] - base):
+            results[name]['peakbytes'] = peakbytes
+        tracemalloc.stop()
+        results['_config'] = {'bytes': os.path.getsize(cfgpath)}
+        return(results)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark the AIF-NG client\'s config parsing and install planning.')
+    args.add_argument('-s',
+                      '--size',
+                      dest = 'sizes',
+                      type = int,
+                      action = 'append',
+                      help = ('How many disks/users/packages/interfaces/scripts to generate. May be given more than once. ' +
+                              'The default is 10, 100, 1000 and 10000.'))
+    args.add_argument('-p',
+                      '--parts',
+                      dest = 'parts',
+                      type = int,
+                      default = 4,
+                      help = 'How many partitions each disk gets (max 128). The default is %(default)s.')
+    args.add_argument('-r',
+                      '--repeat',
+                      dest = 'repeat',
+                      type = int,
+                      default = 3,
+                      help = 'How many timing runs to do at each size; the best is reported. The default is %(default)s.')
+    args.add_argument('-j',
+                      '--json',
+                      dest = 'json',
+                      action = 'store_true',
+                      help = 'Print the results as JSON instead of a table.')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    if not args['sizes']:
+        args['sizes'] = [10, 100, 1000, 10000]
+    if not 1 <= args['parts'] <= 128:
+        exit('--parts must be between 1 and 128.')
+    aifclient = loadClient()
+    report = {}
+    for n in args['sizes']:
+        report[n] = bench(aifclient, n, args['parts'], max(1, args['repeat']))
+        if not args['json']:
+            print('== {0} of each ({1} partitions, {2} byte config) =='.format(n, n * args['parts'],
+                                                                             report[n]['_config']['bytes']))
+            for stage, r in report[n].items():
+                if not stage.startswith('_'):
+                    print('{0:>14}: {1:10.4f}s {2:12.1f} KiB peak'.format(stage, r['seconds'], r['peakbytes'] / 1024))
+            sys.stdout.flush()
+    if args['json']:
+        print(json.dumps(report, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# Times a whole install -- partitioning, formatting, pacstrap, the package install, the bootloader, everything --
+# onto sparse image files attached as loop devices, from a local package repository, so changes to mkfs options,
+# mirrors or parallelism can be measured against each other. Nothing goes over the network. Each run's per-step
+# timings (from the client's JSON report; see the README's Logging section) are added to a results file.
+#
+# The repository is a directory laid out like a mirror: <repo>/<name>/os/<arch>/<name>.db and the packages, e.g.
+# from rsyncing a mirror beforehand, or repo-add'ing a package cache. While the install runs, the host's
+# /etc/pacman.d/mirrorlist points at it (the original is put back afterwards), since that's what pacstrap uses and
+# copies into the new install.
+#
+# e.g.:
+#   ./loopbench.py -r /srv/archrepo -l baseline                  # one 8GiB disk
+#   ./loopbench.py -r /srv/archrepo -l xfs -d 2 -f xfs -j 8      # two disks, XFS, 8 install jobs
+#   ./loopbench.py -r /srv/archrepo -l plan -n                   # a dry run; no root, no loop devices
+#   ./loopbench.py -c                                            # compare the runs in loopbench.json
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+clientpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aifclient.py')
+hostmirrorlist = '/etc/pacman.d/mirrorlist'
+
+def loadClient():
+    spec = importlib.util.spec_from_file_location('aifclient', clientpath)
+    aifclient = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aifclient)
+    return(aifclient)
+
+def partDevice(d, num):
+    # As archInstall.partDevice().
+    return('{0}{1}{2}'.format(d, ('p' if d[-1].isdigit() else ''), num))
+
+def genXML(devices, chrootpath, args):
+    # The first disk gets a BIOS boot partition and the root filesystem; any others get one partition each, on
+    # /srv/<n>. grub is installed for BIOS onto the first disk: an EFI install would add a boot entry to the host's
+    # firmware.
+    fsattrs = ' fs="{0}"'.format(args['fs']) if args['fs'] else ''
+    fsattrs += ' profile="{0}"'.format(args['profile'])
+    xml = ['<?xml version="1.0" encoding="UTF-8" ?>',
+           '<aif xmlns:aif="https://aif.square-r00t.net" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+           '<storage>']
+    for i, d in enumerate(devices):
+        xml.append('<disk device="{0}" diskfmt="gpt">'.format(d))
+        if i == 0:
+            xml.append('<part num="1" start="0%" stop="1%" fstype="ef02" fs="none" />')
+            xml.append('<part num="2" start="1%" stop="100%" fstype="8300"{0} />'.format(fsattrs))
+        else:
+            xml.append('<part num="1" start="0%" stop="100%" fstype="8300"{0} />'.format(fsattrs))
+        xml.append('</disk>')
+    xml.append('<mount source="{0}" target="{1}" order="1" />'.format(partDevice(devices[0], 2), chrootpath))
+    for i, d in enumerate(devices[1:]):
+        xml.append('<mount source="{0}" target="{1}/srv/{2}" order="{3}" />'.format(partDevice(d, 1), chrootpath,
+                                                                                   i + 1, i + 2))
+    xml.append('</storage>')
+    xml.append('<network hostname="loopbench.example.com">')
+    xml.append('<iface device="eth0" address="auto" netproto="ipv4" />')
+    xml.append('</network>')
+    xml.append('<system timezone="UTC" locale="en_US.UTF-8" chrootpath="{0}" reboot="0">'.format(chrootpath))
+    xml.append('<users rootpass="!" />')
+    xml.append('</system>')
+    xml.append('<pacman><repos>')
+    for r in args['repos']:
+        xml.append('<repo name="{0}" enabled="true" siglevel="{1}" mirror="file://{2}" />'.format(r, args['siglevel'],
+                                                                                               hostmirrorlist))
+    xml.append('</repos><software>')
+    for p in args['packages']:
+        xml.append('<package name="{0}" />'.format(p))
+    xml.append('</software></pacman>')
+    xml.append('<bootloader type="grub" target="{0}" efi="false" />'.format(devices[0]))
+    xml.append('</aif>')
+    return('\n'.join(xml))
+
+def findRepos(repo):
+    # The repositories in a local mirror, i.e. every <name> with a <name>/os/<arch>/<name>.db.
+    arch = os.uname().machine
+    repos = []
+    for r in sorted(os.listdir(repo)):
+        if os.path.isfile(os.path.join(repo, r, 'os', arch, '{0}.db'.format(r))):
+            repos.append(r)
+    return(repos)
+
+def attach(images, size):
+    # Makes each image (sparse, so only what the install writes takes up space) and attaches it with partition
+    # scanning on, so the kernel picks up the partitions sgdisk makes. Returns the loop devices.
+    devices = []
+    for i in images:
+        with open(i, 'wb') as f:
+            f.truncate(size)
+        devices.append(subprocess.run(['losetup', '--find', '--show', '--partscan', i], check = True,
+                                      stdout = subprocess.PIPE).stdout.decode('utf-8').strip())
+    return(devices)
+
+def detach(devices, chrootpath):
+    # Undoes whatever the install left behind if it didn't finish (it unmounts everything itself if it did).
+    for d in devices:
+        for p in range(1, 3):
+            subprocess.run(['swapoff', partDevice(d, p)], stderr = subprocess.DEVNULL)
+    if os.path.ismount(chrootpath):
+        subprocess.run(['umount', '-R', chrootpath])
+    for d in devices:
+        subprocess.run(['losetup', '-d', d])
+    return()
+
+def readReport(aifclient, rootdev, chrootpath):
+    # The report is written next to the log, which by the end is in the new install. If the install worked, it's
+    # unmounted by now, so the root filesystem is mounted (read-only) again just long enough to read it.
+    if os.path.lexists(aifclient.logfile):
+        with open('{0}.json'.format(os.path.realpath(aifclient.logfile)), 'r') as f:
+            return(json.load(f))
+    if not rootdev:
+        return(False)
+    os.makedirs(chrootpath, exist_ok = True)
+    subprocess.run(['mount', '-o', 'ro', rootdev, chrootpath], check = True)
+    try:
+        with open('{0}/{1}.json'.format(chrootpath, aifclient.logfile), 'r') as f:
+            return(json.load(f))
+    except OSError:
+        return(False)
+    finally:
+        subprocess.run(['umount', chrootpath])
+
+def summarize(report):
+    # Each step's wall time (first command started to last one finished) and what its commands used.
+    phases = {}
+    for name, p in report['phases'].items():
+        phases[name] = {'seconds': p['end'] - p['start'], 'cmdseconds': p['seconds'], 'cpu': p['cpu'],
+                        'written': p['written'], 'commands': p['commands'], 'failed': p['failed']}
+    return(phases)
+
+def bench(aifclient, args):
+    workdir = tempfile.mkdtemp(prefix = '.aifloop.', dir = args['workdir'])
+    chrootpath = os.path.join(workdir, 'root')
+    # Keep the client's own files (logs, scripts, the journal) in the scratch dir.
+    aifclient.logfile = os.path.join(workdir, 'aif.log')
+    aifclient.scriptdir = os.path.join(workdir, 'scripts')
+    aifclient.hostjournal = os.path.join(workdir, 'aif.journal.json')
+    images = [os.path.join(workdir, 'disk{0}.img'.format(i)) for i in range(args['disks'])]
+    devices = []
+    mirrorbak = '{0}.loopbench'.format(hostmirrorlist)
+    result = {'label': args['label'], 'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+              'disks': args['disks'], 'size': args['size'], 'fs': args['fs'] or 'default', 'profile': args['profile'],
+              'jobs': args['jobs'], 'diskjobs': args['diskjobs'], 'repos': args['repos'],
+              'packages': args['packages'], 'dryrun': args['dryrun']}
+    try:
+        if args['dryrun']:
+            devices = ['/dev/loop{0}'.format(100 + i) for i in range(args['disks'])]
+        else:
+            devices = attach(images, args['size'])
+            shutil.copy2(hostmirrorlist, mirrorbak)
+            with open(hostmirrorlist, 'w') as f:
+                f.write('# Written by loopbench.py; the original is {0}.\n'.format(mirrorbak))
+                f.write('Server = file://{0}/$repo/os/$arch\n'.format(args['repo']))
+        cfgpath = os.path.join(workdir, 'aif.xml')
+        with open(cfgpath, 'w') as f:
+            f.write(genXML(devices, chrootpath, args))
+        client = aifclient.aif()
+        cmdline = ['aif', 'aif_url=file://{0}'.format(cfgpath), 'aif_retries=0',
+                   'aif_jobs={0}'.format(args['jobs']), 'aif_diskjobs={0}'.format(args['diskjobs'])]
+        if args['dryrun']:
+            cmdline.append('aif_exec=dryrun')
+        kargs = client.kernelargs(' '.join(cmdline))
+        confdict = client.buildDict(client.getXML(client.getConfig(kargs)))
+        start = time.perf_counter()
+        try:
+            aifclient.runInstall(confdict, client.session, kargs)
+            result['success'] = True
+        except SystemExit as e:
+            result['success'] = False
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        client.session.close()
+        report = readReport(aifclient, (False if args['dryrun'] else partDevice(devices[0], 2)), chrootpath)
+        if report:
+            result['phases'] = summarize(report)
+            result['failedcommands'] = len([c for c in report['commands'] if c['status'] != 0])
+            if args['dryrun']:
+                result['plansteps'] = len(report['plan'])
+        if not args['dryrun']:
+            result['allocated'] = sum([os.stat(i).st_blocks * 512 for i in images])
+        return(result)
+    finally:
+        if not args['dryrun']:
+            if os.path.isfile(mirrorbak):
+                os.replace(mirrorbak, hostmirrorlist)
+            detach(devices, chrootpath)
+        if args['keep']:
+            print('Kept {0}.'.format(workdir), file = sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+def loadResults(path):
+    if not os.path.isfile(path):
+        return([])
+    with open(path, 'r') as f:
+        return(json.load(f))
+
+def compare(results):
+    # One column per run, one row per step (in the order they first show up).
+    if not results:
+        return('No results yet.\n')
+    steps = []
+    for r in results:
+        for s in sorted(r.get('phases', {}).keys(), key = lambda s: r['phases'][s]['seconds'], reverse = True):
+            if s not in steps:
+                steps.append(s)
+    labels = [r['label'][:12] for r in results]
+    lines = ['{0:>16} '.format('') + ' '.join(['{0:>12}'.format(l) for l in labels])]
+    for s in steps:
+        cells = []
+        for r in results:
+            p = r.get('phases', {}).get(s)
+            cells.append('{0:>11.2f}s'.format(p['seconds']) if p else '{0:>12}'.format('-'))
+        lines.append('{0:>16} '.format(s[:16]) + ' '.join(cells))
+    lines.append('{0:>16} '.format('TOTAL') + ' '.join(['{0:>11.2f}s'.format(r['seconds']) for r in results]))
+    lines.append('{0:>16} '.format('worked') + ' '.join(['{0:>12}'.format(str(r['success'])) for r in results]))
+    return('\n'.join(lines) + '\n')
+
+def parseSize(size):
+    units = {'K': 1024, 'M': 1048576, 'G': 1073741824, 'T': 1099511627776}
+    if size[-1].upper() in units.keys():
+        return(int(float(size[:-1]) * units[size[-1].upper()]))
+    return(int(size))
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Benchmark whole AIF-NG installs onto loop devices.')
+    args.add_argument('-r',
+                      '--repo',
+                      dest = 'repo',
+                      help = 'The local package repository (laid out like a mirror) to install from. Required unless -c.')
+    args.add_argument('-l',
+                      '--label',
+                      dest = 'label',
+                      default = 'run',
+                      help = 'What to call this run in the results. The default is %(default)s.')
+    args.add_argument('-o',
+                      '--results',
+                      dest = 'results',
+                      default = 'loopbench.json',
+                      help = 'The results file; each run is added to it. The default is %(default)s.')
+    args.add_argument('-d',
+                      '--disks',
+                      dest = 'disks',
+                      type = int,
+                      default = 1,
+                      help = 'How many disks to install onto. The default is %(default)s.')
+    args.add_argument('-s',
+                      '--size',
+                      dest = 'size',
+                      default = '8G',
+                      help = 'How big each (sparse) disk is, e.g. 8G or 512M. The default is %(default)s.')
+    args.add_argument('-f',
+                      '--fs',
+                      dest = 'fs',
+                      default = None,
+                      help = 'The filesystem for the root (and /srv) partitions, e.g. ext4, xfs or btrfs. The default is the client\'s.')
+    args.add_argument('-m',
+                      '--mkfs-profile',
+                      dest = 'profile',
+                      choices = ('fast', 'thorough'),
+                      default = 'fast',
+                      help = 'The mkfs profile for the root (and /srv) partitions. The default is %(default)s.')
+    args.add_argument('-j',
+                      '--jobs',
+                      dest = 'jobs',
+                      type = int,
+                      default = 4,
+                      help = 'aif_jobs for the install. The default is %(default)s.')
+    args.add_argument('-J',
+                      '--disk-jobs',
+                      dest = 'diskjobs',
+                      type = int,
+                      default = 4,
+                      help = 'aif_diskjobs for the install. The default is %(default)s.')
+    args.add_argument('-p',
+                      '--package',
+                      dest = 'packages',
+                      action = 'append',
+                      default = [],
+                      help = 'A package to install on top of the base system. May be given more than once.')
+    args.add_argument('-S',
+                      '--siglevel',
+                      dest = 'siglevel',
+                      default = 'default',
+                      help = 'The SigLevel for the repositories (e.g. "Never" for unsigned ones). The default is %(default)s.')
+    args.add_argument('-w',
+                      '--workdir',
+                      dest = 'workdir',
+                      default = '/var/tmp',
+                      help = 'Where to put the disk images and the install\'s logs. The default is %(default)s.')
+    args.add_argument('-k',
+                      '--keep',
+                      dest = 'keep',
+                      action = 'store_true',
+                      help = 'Keep the disk images and logs afterwards.')
+    args.add_argument('-n',
+                      '--dry-run',
+                      dest = 'dryrun',
+                      action = 'store_true',
+                      help = 'Plan the install (aif_exec=dryrun) without making or attaching any disks.')
+    args.add_argument('-c',
+                      '--compare',
+                      dest = 'compare',
+                      action = 'store_true',
+                      help = 'Just print the runs in the results file side by side.')
+    return(args)
+
+def main():
+    args = vars(parseArgs().parse_args())
+    if args['compare']:
+        print(compare(loadResults(args['results'])), end = '')
+        return()
+    if not args['repo']:
+        exit('--repo is required.')
+    if not args['dryrun'] and os.getuid() != 0:
+        exit('This must be run as root (or with -n).')
+    if args['disks'] < 1:
+        exit('--disks must be at least 1.')
+    args['repo'] = os.path.abspath(args['repo'])
+    args['size'] = parseSize(args['size'])
+    args['repos'] = findRepos(args['repo'])
+    if not args['repos'] and args['dryrun']:
+        args['repos'] = ['core']
+    elif not args['repos']:
+        exit('No repositories found in {0} (looked for <name>/os/{1}/<name>.db).'.format(args['repo'],
+                                                                                        os.uname().machine))
+    aifclient = loadClient()
+    result = bench(aifclient, args)
+    results = loadResults(args['results'])
+    results.append(result)
+    with open(args['results'], 'w') as f:
+        json.dump(results, f, indent = 4)
+    print(compare(results[-5:]), end = '')
+    if not result['success']:
+        exit(result.get('error') or 'The install failed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as etree
+
+clientpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aifclient.py')
+example = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs', 'examples', 'aif.xml')
+
+def loadClient():
+    spec = importlib.util.spec_from_file_location('aifclient', clientpath)
+    aifclient = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aifclient)
+    return(aifclient)
+
+class installPlanTest(unittest.TestCase):
+    # The example config, installed with a dry run (and replayed from its report) into a scratch dir. Nothing is
+    # fetched: the example's scripts are on the network, so they're left out.
+    def setUp(self):
+        self.aifclient = loadClient()
+        self.tmpdir = tempfile.mkdtemp(prefix = '.aiftest.')
+        self.aifclient.logfile = os.path.join(self.tmpdir, 'aif.log')
+        self.aifclient.scriptdir = os.path.join(self.tmpdir, 'scripts')
+        self.aifclient.hostjournal = os.path.join(self.tmpdir, 'aif.journal.json')
+        xml = etree.parse(example).getroot()
+        xml.remove(xml.find('scripts'))
+        self.conf = self.aifclient.aif().buildDict(xml)
+        chrootpath = self.conf['system']['chrootpath']
+        self.conf['system']['chrootpath'] = os.path.join(self.tmpdir, 'root')
+        for m in self.conf['mount'].values():
+            if m['mountpt'].startswith(chrootpath):
+                m['mountpt'] = self.conf['system']['chrootpath'] + m['mountpt'][len(chrootpath):]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def install(self, args):
+        # Runs the install graph; returns the install and its tasks.
+        install = self.aifclient.archInstall(self.conf, args = args)
+        graph = install.installGraph()
+        failed = graph.run()
+        install.ex.close()
+        self.assertEqual(failed, [])
+        return(install, graph.tasks)
+
+    def byPhase(self, plan):
+        phases = {}
+        for s in plan:
+            phases.setdefault(s['phase'], []).append(json.dumps(s, sort_keys = True))
+        # Tasks in the same phase (e.g. formatting partitions) may interleave differently from run to run.
+        return(dict([(p, sorted(s)) for p, s in phases.items()]))
+
+    def test_ordering(self):
+        install, tasks = self.install({'aif_exec': 'dryrun'})
+        def after(name):
+            # Everything name waits for, directly or not.
+            deps = set()
+            for d in tasks[name]['deps']:
+                deps.update([d] + list(after(d)))
+            return(deps)
+        def before(first, then):
+            # A dry run is quick enough that tasks could finish in order by chance, so the dependency has to be
+            # declared too.
+            self.assertIn(first, after(then), '{0} before {1}'.format(first, then))
+            self.assertLessEqual(tasks[first]['end'], tasks[then]['start'], '{0} before {1}'.format(first, then))
+        before('format', 'pacstrap')
+        for t in ('pacmanconf', 'chrootmounts', 'configure'):
+            before(t, 'pkginstall')
+        for t in tasks.keys():
+            if t not in ('chroot', 'pkgcacheprune'):
+                before(t, 'chroot')
+        before('chroot', 'pkgcacheprune')
+        # And the plan itself: nothing is installed until the disks are ready.
+        phases = [s['phase'] for s in install.ex.plan]
+        self.assertLess(len(phases) - 1 - phases[::-1].index('format'), phases.index('pacstrap'))
+        self.assertIn({'op': 'chroot', 'path': self.conf['system']['chrootpath'], 'phase': 'chroot'}, install.ex.plan)
+
+    def test_rootfscache(self):
+        # The cache dir doesn't exist (and isn't made) in a dry run.
+        install, tasks = self.install({'aif_exec': 'dryrun', 'aif_rootfscache': os.path.join(self.tmpdir, 'rootfs')})
+        self.assertTrue([s for s in install.ex.plan if s['phase'] == 'pacstrap' and s['op'] == 'rename'])
+
+    def test_replay(self):
+        # Replaying a dry run's report gives the same plan, with every command found in it.
+        install, tasks = self.install({'aif_exec': 'dryrun'})
+        reportfile = os.path.join(self.tmpdir, 'report.json')
+        install.ex.writeReport(reportfile, install.ex.report())
+        replay, tasks = self.install({'aif_exec': 'replay:{0}'.format(reportfile), 'aif_execspeed': '1000'})
+        self.assertEqual(replay.ex.missing, 0)
+        self.assertEqual(self.byPhase(replay.ex.plan), self.byPhase(install.ex.plan))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+clientpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aifclient.py')
+
+def loadClient():
+    spec = importlib.util.spec_from_file_location('aifclient', clientpath)
+    aifclient = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aifclient)
+    return(aifclient)
+
+class scriptCmdsTest(unittest.TestCase):
+    def setUp(self):
+        self.aifclient = loadClient()
+        self.tmpdir = tempfile.mkdtemp(prefix = '.aiftest.')
+        self.aifclient.logfile = os.path.join(self.tmpdir, 'aif.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_script_argv(self):
+        # Each script is run as a command of its own, not split up into its characters.
+        script = os.path.join(self.tmpdir, 'pre.sh')
+        install = self.aifclient.archInstall({'software': {}, 'scripts': {'pre': [script]}},
+                                             args = {'aif_exec': 'dryrun'})
+        install.scriptcmds('pre')
+        runs = [s for s in install.ex.plan if s['op'] == 'run']
+        self.assertEqual(runs, [{'op': 'run', 'cmd': [script], 'phase': 'prescripts'}])
+        self.assertEqual([c['cmd'] for c in install.ex.commands], [[script]])
+
+if __name__ == '__main__':
+    unittest.main()